@@ -16,9 +16,11 @@
 import os
 import re
 import socket
+import threading
 import traceback
 import time
 import datetime
+import json
 import psutil
 import urlparse
 import xml.dom.minidom as minidom
@@ -52,6 +54,9 @@ MonitoringInterval = 60 * MonitoringIntervalInMinute
 AzureTableDelayInMinute = 5 #Five minute
 AzureTableDelay = 60 * AzureTableDelayInMinute
 
+#Storage accounts not answering within this are reported without data
+StorageQueryTimeout = 30
+
 AzureEnhancedMonitorVersion = "2.0.0"
 LibDir = "/var/lib/AzureEnhancedMonitor"
 
@@ -201,9 +206,9 @@ class AzureDiagnosticData(object):
         return self.memoryPercent
 
 class AzureDiagnosticMetric(object):
-    def __init__(self, config):
+    def __init__(self, config, hwFacts=None):
         self.config = config
-        self.linux = LinuxMetric(self.config)
+        self.linux = LinuxMetric(self.config, hwFacts)
         self.azure = AzureDiagnosticData(self.config)
         self.timestamp = int(time.time()) - AzureTableDelay
 
@@ -374,11 +379,87 @@ def sameList(l1, l2):
             return False
     return True
 
+def getMonotonicTime():
+    #Seconds since boot, unlike time.time() it never jumps
+    try:
+        return float(waagent.GetFileContents("/proc/uptime").split()[0])
+    except (TypeError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+ProcNetDev = "/proc/net/dev"
+class NetworkCounterSampler(object):
+    """
+    Keeps the byte counters of all the NICs from the previous sample, so the
+    rates cover the whole time between two collections. One read of
+    /proc/net/dev samples all the NICs. Only the very first sample waits
+    for a short window, as there is nothing to compare it with.
+    """
+    BootstrapInterval = 0.2
+    #Samples closer than this reuse the last rates
+    MinSampleInterval = 1
+
+    def __init__(self, procNetDev=ProcNetDev):
+        self.procNetDev = procNetDev
+        self.lastTime = None
+        self.lastCounters = None
+        self.rates = {}
+
+    def readCounters(self):
+        counters = {}
+        content = waagent.GetFileContents(self.procNetDev)
+        if content is None:
+            return counters
+        for line in content.split("\n")[2:]:
+            if ":" not in line:
+                continue
+            nicName, fields = line.split(":", 1)
+            fields = fields.split()
+            if len(fields) < 9:
+                continue
+            #(bytes sent, bytes received), the order of psutil
+            counters[nicName.strip()] = (long(fields[8]), long(fields[0]))
+        return counters
+
+    def sample(self):
+        if self.lastTime is None:
+            self.lastTime = getMonotonicTime()
+            self.lastCounters = self.readCounters()
+            time.sleep(NetworkCounterSampler.BootstrapInterval)
+        now = getMonotonicTime()
+        interval = now - self.lastTime
+        if interval < NetworkCounterSampler.MinSampleInterval and self.rates:
+            return
+        counters = self.readCounters()
+        rates = {}
+        for nicName, (bytesSent, bytesRecv) in counters.iteritems():
+            last = self.lastCounters.get(nicName)
+            if last is None or interval <= 0:
+                continue
+            #A counter going back means the NIC was reset, count from zero
+            sent = bytesSent - last[0] if bytesSent >= last[0] else bytesSent
+            recv = bytesRecv - last[1] if bytesRecv >= last[1] else bytesRecv
+            rates[nicName] = (sent / interval, recv / interval)
+        self.lastTime = now
+        self.lastCounters = counters
+        self.rates = rates
+
+    def getNicNames(self):
+        return self.lastCounters.keys() if self.lastCounters is not None else []
+
+    def getWriteRate(self, nicName):
+        return self.rates[nicName][0] if nicName in self.rates else 0
+
+    def getReadRate(self, nicName):
+        return self.rates[nicName][1] if nicName in self.rates else 0
+
+networkCounterSampler = NetworkCounterSampler()
+
 class NetworkInfo(object):
-    def __init__(self):
-        self.nics = psutil.net_io_counters(pernic=True)
+    def __init__(self, sampler=None):
+        self.sampler = sampler if sampler is not None else networkCounterSampler
+        self.sampler.sample()
         self.nicNames = []
-        for nicName, stat in self.nics.iteritems():
+        for nicName in sorted(self.sampler.getNicNames()):
             if nicName != 'lo':
                 self.nicNames.append(nicName)
 
@@ -386,40 +467,10 @@ class NetworkInfo(object):
         return self.nicNames
 
     def getNetworkReadBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_recv1 = net[adapterId][1]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_recv2 = net[adapterId][1]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_recv2 - bytes_recv1) / interval
-        else:
-            return 0
+        return self.sampler.getReadRate(adapterId)
 
     def getNetworkWriteBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_sent1 = net[adapterId][0]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_sent2 = net[adapterId][0]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_sent2 - bytes_sent1) / interval
-        else:
-            return 0
+        return self.sampler.getWriteRate(adapterId)
 
     def getNetstat(self):
         retCode, output = waagent.RunGetOutput("netstat -s", chk_err=False)
@@ -470,24 +521,128 @@ class HardwareChangeInfo(object):
         else:
             return oldTime
 
+BootIdFile = "/proc/sys/kernel/random/boot_id"
+def getBootId():
+    bootId = waagent.GetFileContents(BootIdFile)
+    return bootId.strip() if bootId is not None else None
+
+def getOnlineCPUCount():
+    try:
+        return os.sysconf("SC_NPROCESSORS_ONLN")
+    except (ValueError, OSError):
+        return None
+
+def getCurrentCPUFrequency():
+    cpuinfo = waagent.GetFileContents("/proc/cpuinfo")
+    if cpuinfo is None:
+        return None
+    freqMatch = re.search("cpu MHz\s+:\s+(.*)\s", cpuinfo)
+    if freqMatch:
+        return float(freqMatch.group(1))
+    return None
+
+HwFactsFile = os.path.join(LibDir, "HwFacts")
+class HardwareFacts(object):
+    """
+    The facts that only change with the hardware, the cpu description and
+    the hypervisor. They are collected once and kept in memory and in
+    HwFactsFile, until HardwareChangeInfo reports a new hardware change, the
+    VM is rebooted, which a resize does, or the number of online cpus
+    changes.
+    """
+    def __init__(self, factsFile=None):
+        self.factsFile = factsFile if factsFile is not None else HwFactsFile
+        self.key = None
+        self.facts = None
+        self.cpuInfo = None
+
+    def isLoaded(self):
+        return self.facts is not None
+
+    def refresh(self, lastHardwareChange):
+        key = [lastHardwareChange, getBootId(), getOnlineCPUCount()]
+        if self.facts is not None and self.key == key:
+            return
+        facts = self.loadFacts()
+        if facts is None or facts.get("key") != key:
+            waagent.Log("Collecting hardware facts.")
+            facts = self.collectFacts()
+            facts["key"] = key
+            self.saveFacts(facts)
+        self.facts = facts
+        self.key = key
+        self.cpuInfo = CPUInfo(facts["cpuinfo"], facts["lscpu"])
+
+    def collectFacts(self):
+        cpuinfo = waagent.GetFileContents("/proc/cpuinfo")
+        ret, lscpu = waagent.RunGetOutput("lscpu")
+        hvInfo = HvInfo()
+        return {
+            "cpuinfo": cpuinfo,
+            "lscpu": lscpu,
+            "hvName": hvInfo.getHvName(),
+            "hvVersion": hvInfo.getHvVersion()
+        }
+
+    def loadFacts(self):
+        if not os.path.isfile(self.factsFile):
+            return None
+        try:
+            return json.loads(waagent.GetFileContents(self.factsFile))
+        except (TypeError, ValueError):
+            waagent.Warn("Ignoring unreadable {0}".format(self.factsFile))
+            return None
+
+    def saveFacts(self, facts):
+        if waagent.SetFileContents(self.factsFile, json.dumps(facts)) is None:
+            waagent.Warn(("Failed to save hardware facts to {0}, they are "
+                          "collected again after a restart"
+                          "").format(self.factsFile))
+
+    def getCPUInfo(self):
+        return self.cpuInfo
+
+    def getHvName(self):
+        return self.facts["hvName"]
+
+    def getHvVersion(self):
+        return self.facts["hvVersion"]
+
+def getHardwareFacts(hwFacts):
+    #Data sources used on their own collect the facts for the current hardware
+    if hwFacts is None:
+        hwFacts = HardwareFacts()
+    if not hwFacts.isLoaded():
+        networkInfo = NetworkInfo()
+        lastHardwareChange = HardwareChangeInfo(networkInfo).getLastHardwareChange()
+        hwFacts.refresh(lastHardwareChange)
+    return hwFacts
+
 class LinuxMetric(object):
-    def __init__(self, config):
+    def __init__(self, config, hwFacts=None):
         self.config = config
-        #CPU
-        self.cpuInfo = CPUInfo.getCPUInfo()
         #Memory
         self.memInfo = MemoryInfo()
         #Network
         self.networkInfo = NetworkInfo()
         #Detect hardware change
         self.hwChangeInfo = HardwareChangeInfo(self.networkInfo)
+        self.lastHardwareChange = self.hwChangeInfo.getLastHardwareChange()
+        #CPU
+        self.hwFacts = hwFacts if hwFacts is not None else HardwareFacts()
+        self.hwFacts.refresh(self.lastHardwareChange)
+        self.cpuInfo = self.hwFacts.getCPUInfo()
         self.timestamp = int(time.time())
 
     def getTimestamp(self):
         return self.timestamp
 
     def getCurrHwFrequency(self):
-        return self.cpuInfo.getFrequency()
+        #The frequency is the only cpu fact that changes between collections
+        frequency = getCurrentCPUFrequency()
+        if frequency is None:
+            frequency = self.cpuInfo.getFrequency()
+        return frequency
 
     def getMaxHwFrequency(self):
         return self.getCurrHwFrequency()
@@ -562,18 +717,19 @@ class LinuxMetric(object):
         return self.networkInfo.getNetworkPacketRetransmitted()
   
     def getLastHardwareChange(self):
-        return self.hwChangeInfo.getLastHardwareChange()
+        return self.lastHardwareChange
 
 class VMDataSource(object):
-    def __init__(self, config):
+    def __init__(self, config, hwFacts=None):
         self.config = config
+        self.hwFacts = hwFacts
 
     def collect(self):
         counters = []
         if self.config.isLADEnabled():
-            metrics = AzureDiagnosticMetric(self.config)
+            metrics = AzureDiagnosticMetric(self.config, self.hwFacts)
         else:
-            metrics = LinuxMetric(self.config)
+            metrics = LinuxMetric(self.config, self.hwFacts)
 
         #CPU
         counters.append(self.createCounterCurrHwFrequency(metrics))
@@ -809,12 +965,23 @@ def getStorageTableKeyRange():
     startTime = endTime - MonitoringInterval
     return getStorageTimestamp(startTime), getStorageTimestamp(endTime)
 
+TableServices = {}
+TableServicesLock = threading.Lock()
+def getTableService(account, key, hostBase):
+    #The connection to an account is reused by the following collections
+    with TableServicesLock:
+        tableService = TableServices.get((account, key, hostBase))
+        if tableService is None:
+            tableService = TableService(account_name = account,
+                                        account_key = key,
+                                        host_base = hostBase)
+            TableServices[(account, key, hostBase)] = tableService
+        return tableService
+
 def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
     try:
         waagent.Log("Retrieve storage metrics data.")
-        tableService = TableService(account_name = account, 
-                                    account_key = key,
-                                    host_base = hostBase)
+        tableService = getTableService(account, key, hostBase)
         ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}'"
                    "").format(startKey, endKey)
         oselect = ("TotalRequests,TotalIngress,TotalEgress,AverageE2ELatency,"
@@ -905,37 +1072,45 @@ def isUserWrite(op):
             return True
     return False
 
-def storageStat(metrics, opFilter):
-    stat = {}
-    stat['bytes'] = None
-    stat['ops'] = None
-    stat['e2eLatency'] = None
-    stat['serverLatency'] = None
-    stat['throughput'] = None
+def storageStats(metrics, opFilters):
+    """
+    Aggregates the metrics matching each filter, in one pass over them.
+    """
+    stats = []
+    for opFilter in opFilters:
+        stats.append({
+            'bytes': None,
+            'ops': None,
+            'e2eLatency': None,
+            'serverLatency': None,
+            'throughput': None
+        })
     if metrics is None:
-        return stat
-
-    metrics = filter(lambda x : opFilter(x.RowKey), metrics)
-    stat['bytes'] = sum(map(lambda x : x.TotalIngress + x.TotalEgress, 
-                            metrics))
-    stat['ops'] = sum(map(lambda x : x.TotalRequests, metrics))
-    if stat['ops'] != 0:
-        stat['e2eLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                x.AverageE2ELatency, 
-                                     metrics)) / stat['ops']
-        stat['serverLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                   x.AverageServerLatency, 
-                                        metrics)) / stat['ops']
-    #Convert to MB/s
-    stat['throughput'] = float(stat['bytes']) / (1024 * 1024) / 60 
-    return stat
+        return stats
+
+    sums = [[0, 0, 0, 0] for opFilter in opFilters]
+    for metric in metrics:
+        for i in range(0, len(opFilters)):
+            if opFilters[i](metric.RowKey):
+                sums[i][0] += metric.TotalIngress + metric.TotalEgress
+                sums[i][1] += metric.TotalRequests
+                sums[i][2] += metric.TotalRequests * metric.AverageE2ELatency
+                sums[i][3] += metric.TotalRequests * metric.AverageServerLatency
+    for stat, (totalBytes, ops, e2eLatency, serverLatency) in zip(stats, sums):
+        stat['bytes'] = totalBytes
+        stat['ops'] = ops
+        if ops != 0:
+            stat['e2eLatency'] = e2eLatency / ops
+            stat['serverLatency'] = serverLatency / ops
+        #Convert to MB/s
+        stat['throughput'] = float(totalBytes) / (1024 * 1024) / 60
+    return stats
 
 class AzureStorageStat(object):
 
     def __init__(self, metrics):
         self.metrics = metrics
-        self.rStat = storageStat(metrics, isUserRead)
-        self.wStat = storageStat(metrics, isUserWrite)
+        self.rStat, self.wStat = storageStats(metrics, [isUserRead, isUserWrite])
 
     def getReadBytes(self):
         return self.rStat['bytes']
@@ -968,9 +1143,81 @@ class AzureStorageStat(object):
         return self.wStat['throughput']
 
 
+class StorageMetricsCollector(object):
+    """
+    Queries the storage accounts concurrently, an account that does not
+    answer within the timeout is reported without data and is not queried
+    again until it answered. The results are kept by account, table and key
+    range, so a range is only fetched once.
+    """
+    CachedRanges = 32
+
+    def __init__(self, timeout = StorageQueryTimeout):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.pending = {}
+
+    def query(self, account, key, hostBase, table, startKey, endKey):
+        cacheKey = (account, table, startKey, endKey)
+        metrics = getStorageMetrics(account, key, hostBase, table,
+                                    startKey, endKey)
+        with self.lock:
+            if metrics is not None:
+                self.cache[cacheKey] = metrics
+                #Drop the oldest ranges
+                cachedKeys = sorted(self.cache.keys(), key = lambda k : k[2])
+                for oldKey in cachedKeys[:-StorageMetricsCollector.CachedRanges]:
+                    del self.cache[oldKey]
+            del self.pending[account]
+
+    def collect(self, queries):
+        """
+        queries are (account, key, hostBase, table, startKey, endKey),
+        returns the metrics by account, None when they could not be fetched.
+        """
+        results = {}
+        threads = []
+        with self.lock:
+            for query in queries:
+                account, table, startKey, endKey = query[0], query[3], query[4], query[5]
+                cacheKey = (account, table, startKey, endKey)
+                if cacheKey in self.cache:
+                    results[account] = self.cache[cacheKey]
+                elif account in self.pending:
+                    waagent.Warn(("Storage account {0} is still answering an "
+                                  "earlier query").format(account))
+                else:
+                    thread = threading.Thread(target = self.query, args = query)
+                    thread.daemon = True
+                    self.pending[account] = thread
+                    threads.append((query, thread))
+        for query, thread in threads:
+            thread.start()
+        deadline = time.time() + self.timeout
+        for query, thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        with self.lock:
+            for query, thread in threads:
+                account, table, startKey, endKey = query[0], query[3], query[4], query[5]
+                cacheKey = (account, table, startKey, endKey)
+                if cacheKey in self.cache:
+                    results[account] = self.cache[cacheKey]
+                elif thread.is_alive():
+                    waagent.Error(("Storage account {0} did not answer in {1}s"
+                                   "").format(account, self.timeout))
+                    updateLatestErrorRecord(FAILED_TO_RETRIEVE_STORAGE_DATA)
+                    AddExtensionEvent(message=FAILED_TO_RETRIEVE_STORAGE_DATA)
+        for query in queries:
+            results.setdefault(query[0], None)
+        return results
+
+storageMetricsCollector = StorageMetricsCollector()
+
 class StorageDataSource(object):
-    def __init__(self, config):
+    def __init__(self, config, collector = None):
         self.config = config
+        self.collector = collector if collector is not None else storageMetricsCollector
 
     def collect(self):
         counters = []
@@ -989,23 +1236,25 @@ class StorageDataSource(object):
                 counters.append(self.createCounterDiskThroughput(dev, disk.get("throughput")))
 
         accounts = self.config.getStorageAccountNames()
+        accounts = filter(lambda a : self.config.getStorageAccountType(a) == "Standard",
+                          accounts)
+        startKey, endKey = getStorageTableKeyRange()
+        queries = []
+        for account in accounts:
+            queries.append((account,
+                            self.config.getStorageAccountKey(account),
+                            self.config.getStorageHostBase(account),
+                            self.config.getStorageAccountMinuteTable(account),
+                            startKey,
+                            endKey))
+        metrics = self.collector.collect(queries)
         for account in accounts:
-            if self.config.getStorageAccountType(account) == "Standard":
-                counters.extend(self.collectMetrixForStandardStorage(account))
+            counters.extend(self.collectMetrixForStandardStorage(account,
+                                                                 metrics[account]))
         return counters
 
-    def collectMetrixForStandardStorage(self, account):
+    def collectMetrixForStandardStorage(self, account, metrics):
         counters = []
-        startKey, endKey = getStorageTableKeyRange()
-        tableName = self.config.getStorageAccountMinuteTable(account)
-        accountKey = self.config.getStorageAccountKey(account)
-        hostBase = self.config.getStorageHostBase(account)
-        metrics = getStorageMetrics(account, 
-                                    accountKey,
-                                    hostBase,
-                                    tableName,
-                                    startKey,
-                                    endKey)
         stat = AzureStorageStat(metrics)
         counters.append(self.createCounterStorageId(account))
         counters.append(self.createCounterReadBytes(account, stat))
@@ -1174,12 +1423,13 @@ class HvInfo(object):
         return self.hvVersion
 
 class StaticDataSource(object):
-    def __init__(self, config):
+    def __init__(self, config, hwFacts=None):
         self.config = config
+        self.hwFacts = hwFacts
 
     def collect(self):
         counters = []
-        hvInfo = HvInfo()
+        hvInfo = getHardwareFacts(self.hwFacts)
         counters.append(self.createCounterCloudProvider())
         counters.append(self.createCounterCpuOverCommitted())
         counters.append(self.createCounterMemoryOverCommitted())
@@ -1309,10 +1559,13 @@ class PerfCounter(object):
 
 class EnhancedMonitor(object):
     def __init__(self, config):
+        #The hardware facts are refreshed by the VM data source, which runs
+        #first and checks for hardware changes, and shared with the static one
+        self.hwFacts = HardwareFacts()
         self.dataSources = []
-        self.dataSources.append(VMDataSource(config))
+        self.dataSources.append(VMDataSource(config, self.hwFacts))
         self.dataSources.append(StorageDataSource(config))
-        self.dataSources.append(StaticDataSource(config))
+        self.dataSources.append(StaticDataSource(config, self.hwFacts))
         self.writer = PerfCounterWriter()
 
     def run(self):
@@ -19,6 +19,7 @@
 import datetime
 import os
 import json
+import threading
 import unittest
 
 import env
@@ -184,10 +185,47 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(0, len(adapterIds))
         adapterId = adapterIds[0]
         self.assertNotEquals(None, aem.getMacAddress(adapterId))
-        self.assertNotEquals(None, netinfo.getNetworkReadBytes())
-        self.assertNotEquals(None, netinfo.getNetworkWriteBytes())
+        self.assertNotEquals(None, netinfo.getNetworkReadBytes(adapterId))
+        self.assertNotEquals(None, netinfo.getNetworkWriteBytes(adapterId))
         self.assertNotEquals(None, netinfo.getNetworkPacketRetransmitted())
 
+    def test_network_counter_sampler(self):
+        testProcNetDev = "/tmp/net_dev"
+        header = ("Inter-|   Receive                                                |  Transmit\n"
+                  " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n")
+        def setCounters(recv, sent):
+            waagent.SetFileContents(testProcNetDev, header +
+                ("    lo: 100 1 0 0 0 0 0 0 100 1 0 0 0 0 0 0\n"
+                 "  eth0: {0} 5 0 0 0 0 0 0 {1} 5 0 0 0 0 0 0\n").format(recv, sent))
+        now = [100.0]
+        getMonotonicTime = aem.getMonotonicTime
+        aem.getMonotonicTime = lambda : now[0]
+        try:
+            aem.NetworkCounterSampler.BootstrapInterval = 0
+            sampler = aem.NetworkCounterSampler(testProcNetDev)
+            setCounters(1000, 500)
+            netinfo = aem.NetworkInfo(sampler)
+            self.assertEquals(['eth0'], netinfo.getAdapterIds())
+            self.assertEquals(0, netinfo.getNetworkReadBytes('eth0'))
+
+            #The rate covers the whole interval since the last collection
+            now[0] += 60
+            setCounters(7000, 3500)
+            netinfo = aem.NetworkInfo(sampler)
+            self.assertEquals(100, netinfo.getNetworkReadBytes('eth0'))
+            self.assertEquals(50, netinfo.getNetworkWriteBytes('eth0'))
+            self.assertEquals(0, netinfo.getNetworkReadBytes('eth1'))
+
+            #A second sample right away keeps the rates
+            now[0] += 0.1
+            setCounters(7000, 3500)
+            netinfo = aem.NetworkInfo(sampler)
+            self.assertEquals(100, netinfo.getNetworkReadBytes('eth0'))
+        finally:
+            aem.getMonotonicTime = getMonotonicTime
+            aem.NetworkCounterSampler.BootstrapInterval = 0.2
+            os.remove(testProcNetDev)
+
     def test_hwchangeinfo(self):
         netinfo = aem.NetworkInfo()
         testHwInfoFile = "/tmp/HwInfo"
@@ -209,6 +247,53 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, hwChangeInfo.getLastHardwareChange())
 
         
+    def test_hardware_facts(self):
+        testHwFactsFile = "/tmp/HwFacts"
+        if os.path.isfile(testHwFactsFile):
+            os.remove(testHwFactsFile)
+        collected = []
+        def collectFacts():
+            collected.append(1)
+            return {
+                "cpuinfo": "model name\t: Xeon\nvendor_id\t: GenuineIntel\n",
+                "lscpu": "CPU(s):    4\nCPU MHz:    2400.0\n",
+                "hvName": "Microsoft HyperV",
+                "hvVersion": "6.3"
+            }
+        bootId = ["boot1"]
+        getBootId = aem.getBootId
+        aem.getBootId = lambda : bootId[0]
+        try:
+            hwFacts = aem.HardwareFacts(testHwFactsFile)
+            hwFacts.collectFacts = collectFacts
+            hwFacts.refresh(100)
+            hwFacts.refresh(100)
+            self.assertEquals(1, len(collected))
+            self.assertEquals("Xeon, GenuineIntel",
+                              hwFacts.getCPUInfo().getProcessorType())
+            self.assertEquals("Microsoft HyperV", hwFacts.getHvName())
+
+            #A restarted monitor reads the facts from the file
+            hwFacts = aem.HardwareFacts(testHwFactsFile)
+            hwFacts.collectFacts = collectFacts
+            hwFacts.refresh(100)
+            self.assertEquals(1, len(collected))
+            self.assertEquals(2400.0, hwFacts.getCPUInfo().getFrequency())
+            self.assertEquals("6.3", hwFacts.getHvVersion())
+
+            #Hardware changed
+            hwFacts.refresh(200)
+            self.assertEquals(2, len(collected))
+
+            #Rebooted, the VM may have been resized
+            bootId[0] = "boot2"
+            hwFacts.refresh(200)
+            self.assertEquals(3, len(collected))
+        finally:
+            aem.getBootId = getBootId
+            if os.path.isfile(testHwFactsFile):
+                os.remove(testHwFactsFile)
+
     def test_linux_metric(self):
         config = self.test_config()
         metric = aem.LinuxMetric(config)
@@ -299,6 +384,50 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, stat.getWriteOpServerLatency())
         self.assertNotEquals(None, stat.getWriteOpThroughput())
 
+    def test_storage_stats(self):
+        metrics = mock_getStorageMetrics()
+        isRead = lambda rowKey : rowKey.endswith("GetBlob")
+        rStat, wStat = aem.storageStats(metrics, [isRead, lambda x : False])
+        ops = sum(m.TotalRequests for m in metrics if isRead(m.RowKey))
+        self.assertEquals(ops, rStat['ops'])
+        self.assertEquals(0, wStat['ops'])
+        self.assertEquals(None, wStat['e2eLatency'])
+        rStat, wStat = aem.storageStats(None, [isRead, isRead])
+        self.assertEquals(None, rStat['bytes'])
+
+    def test_storage_metrics_collector(self):
+        queried = []
+        answer = threading.Event()
+        def getStorageMetrics(account, *args):
+            queried.append(account)
+            if account == "slow":
+                answer.wait(5)
+                return None
+            return [account]
+        errors = []
+        aemGetStorageMetrics = aem.getStorageMetrics
+        aemUpdateLatestErrorRecord = aem.updateLatestErrorRecord
+        aem.getStorageMetrics = getStorageMetrics
+        aem.updateLatestErrorRecord = errors.append
+        try:
+            collector = aem.StorageMetricsCollector(timeout = 0.5)
+            queries = [("fast", "key", "host", "table", "1", "2"),
+                       ("slow", "key", "host", "table", "1", "2")]
+            metrics = collector.collect(queries)
+            self.assertEquals(["fast"], metrics["fast"])
+            self.assertEquals(None, metrics["slow"])
+
+            #The range of fast is cached, slow is not queried again
+            metrics = collector.collect(queries)
+            self.assertEquals(["fast"], metrics["fast"])
+            self.assertEquals(None, metrics["slow"])
+            self.assertEquals(2, len(queried))
+            self.assertEquals([aem.FAILED_TO_RETRIEVE_STORAGE_DATA], errors)
+        finally:
+            answer.set()
+            aem.getStorageMetrics = aemGetStorageMetrics
+            aem.updateLatestErrorRecord = aemUpdateLatestErrorRecord
+
     def test_disk_info(self):
         config = self.test_config()
         mapping = aem.DiskInfo(config).getDiskMapping()
@@ -18,20 +18,123 @@
 
 import time
 import datetime
+import errno
 import traceback
 try:
     import httplib as httplibs
 except ImportError:
     import http.client as httplibs
+import os
 import shlex
+import socket
 import subprocess
 import sys
+import threading
 from common import CommonVariables
 from subprocess import *
 from Utils.WAAgentUtil import waagent
+from Utils.ConfigStore import ConfigStore
 import Utils.HandlerUtil
 import sys
 
+class BufferedHttpResponse(object):
+    """
+    Response whose body was read up front so that its connection can go back
+    to the pool. Everything except read() is delegated to the real response.
+    """
+    def __init__(self, resp, body):
+        self._resp = resp
+        self._body = body
+
+    def read(self, amt = None):
+        if amt is None:
+            body = self._body
+            self._body = b''
+        else:
+            body = self._body[:amt]
+            self._body = self._body[amt:]
+        return body
+
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
+
+class HttpConnectionPool(object):
+    """
+    Keep-alive connections keyed by (scheme, host, proxy tunnel).
+    A connection is checked out by one caller at a time and handed back only
+    after its response has been fully read. Connections inherited across a
+    fork are dropped, since the child must not share TLS state with the parent.
+    """
+    PoolSizeDefault = 8
+    IdleTimeoutInSecondsDefault = 30
+    MaxBufferedBodyBytes = 1048576 # 1 MB
+
+    def __init__(self, max_idle_per_host = PoolSizeDefault, idle_timeout = IdleTimeoutInSecondsDefault):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pid = os.getpid()
+        self.handshakes = 0
+        self.reuses = 0
+        self.discarded = 0
+
+    def _reset_after_fork(self):
+        if self.pid != os.getpid():
+            self.idle = {}
+            self.pid = os.getpid()
+            self.handshakes = 0
+            self.reuses = 0
+            self.discarded = 0
+
+    def checkout(self, key, factory):
+        now = time.time()
+        with self.lock:
+            self._reset_after_fork()
+            connections = self.idle.get(key, [])
+            while len(connections) > 0:
+                connection, released_at = connections.pop()
+                if now - released_at <= self.idle_timeout:
+                    self.reuses += 1
+                    return connection, True
+                self._close(connection)
+        return self.connect(factory), False
+
+    def connect(self, factory):
+        with self.lock:
+            self.handshakes += 1
+        return factory()
+
+    def checkin(self, key, connection):
+        with self.lock:
+            self._reset_after_fork()
+            connections = self.idle.setdefault(key, [])
+            if len(connections) >= self.max_idle_per_host:
+                self._close(connection)
+            else:
+                connections.append((connection, time.time()))
+
+    def discard(self, connection):
+        with self.lock:
+            self._close(connection)
+
+    def _close(self, connection):
+        self.discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection, released_at in connections:
+                    self._close(connection)
+            self.idle = {}
+
+    def get_stats(self):
+        return 'handshakes: ' + str(self.handshakes) + ' reuses: ' + str(self.reuses) + ' discarded: ' + str(self.discarded)
+
 class HttpUtil(object):
     """description of class"""
     __instance = None
@@ -55,6 +158,15 @@ class HttpUtil(object):
                 cls.__instance.proxyHost = Config.get("HttpProxy.Host")
                 cls.__instance.proxyPort = Config.get("HttpProxy.Port")
             cls.__instance.tmpFile = './tmp_file_FD76C85E-406F-4CFA-8EB0-CF18B123365C'
+            pool_size = HttpConnectionPool.PoolSizeDefault
+            idle_timeout = HttpConnectionPool.IdleTimeoutInSecondsDefault
+            try:
+                config_store = ConfigStore.get_instance()
+                pool_size = config_store.get_int('HttpPoolSize', HttpConnectionPool.PoolSizeDefault)
+                idle_timeout = config_store.get_int('HttpPoolIdleTimeoutInSeconds', HttpConnectionPool.IdleTimeoutInSecondsDefault)
+            except Exception as e:
+                hutil.log("Failed to read http pool settings, using defaults: " + str(e))
+            cls.__instance.pool = HttpConnectionPool(pool_size, idle_timeout)
         else:
             cls.__instance.logger = hutil
             cls.__instance.logger.log("Returning HttpUtil")
@@ -124,24 +236,14 @@ class HttpUtil(object):
             self.logger.log("Entered HttpCallGetResponse, isHostCall: " + str(isHostCall))
 
             if(isHostCall or self.proxyHost == None or self.proxyPort != None):
-                if(isHostCall):
-                    connection = httplibs.HTTPConnection(sasuri_obj.hostname, timeout = 40) # making call with port 80 to make it http call
-                else:
-                    connection = httplibs.HTTPSConnection(sasuri_obj.hostname, timeout = 10)
                 self.logger.log("Details of sas uri object  hostname: " + str(sasuri_obj.hostname) + " path: " + str(sasuri_obj.path))
-                connection.request(method=method, url=(sasuri_obj.path + '?' + sasuri_obj.query), body=data, headers = headers)
-                resp = connection.getresponse()
-                if(responseBodyRequired):
-                    responeBody = resp.read().decode('utf-8-sig')
-                connection.close()
+                url = sasuri_obj.path + '?' + sasuri_obj.query
             else:
-                connection = httplibs.HTTPSConnection(self.proxyHost, self.proxyPort, timeout = 10)
-                connection.set_tunnel(sasuri_obj.hostname, 443)
                 # If proxy is used, full url is needed.
-                path = "https://{0}:{1}{2}".format(sasuri_obj.hostname, 443, (sasuri_obj.path + '?' + sasuri_obj.query))
-                connection.request(method=method, url=(path), body=data, headers=headers)
-                resp = connection.getresponse()
-                connection.close()
+                url = "https://{0}:{1}{2}".format(sasuri_obj.hostname, 443, (sasuri_obj.path + '?' + sasuri_obj.query))
+            resp = self.pooled_request(method, sasuri_obj.hostname, url, data, headers, isHostCall)
+            if(responseBodyRequired):
+                responeBody = resp.read().decode('utf-8-sig')
             result = CommonVariables.success
         except Exception as e:
             errorMsg = str(datetime.datetime.utcnow()) +  " Failed to call http with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
@@ -152,3 +254,78 @@ class HttpUtil(object):
             return result, resp, errorMsg, responeBody
         else:
             return result, resp, errorMsg
+
+    def new_connection(self, hostname, isHostCall):
+        if(isHostCall):
+            return httplibs.HTTPConnection(hostname, timeout = 40) # making call with port 80 to make it http call
+        elif(self.proxyHost == None or self.proxyPort != None):
+            return httplibs.HTTPSConnection(hostname, timeout = 10)
+        else:
+            connection = httplibs.HTTPSConnection(self.proxyHost, self.proxyPort, timeout = 10)
+            connection.set_tunnel(hostname, 443)
+            return connection
+
+    def pooled_request(self, method, hostname, url, data, headers, isHostCall):
+        if(isHostCall):
+            key = ('http', hostname, None)
+        elif(self.proxyHost == None or self.proxyPort != None):
+            key = ('https', hostname, None)
+        else:
+            key = ('https', hostname, (self.proxyHost, self.proxyPort))
+        factory = lambda: self.new_connection(hostname, isHostCall)
+        connection, reused = self.pool.checkout(key, factory)
+        try:
+            resp = self.send_request(connection, method, url, data, headers)
+        except Exception as e:
+            self.pool.discard(connection)
+            if not reused or not self.is_stale_connection_error(e):
+                raise
+            # the server closed the idle keep-alive connection before it read the request, retry once on a fresh one
+            self.logger.log("Pooled connection to " + str(hostname) + " was stale, reconnecting: " + str(e))
+            connection = self.pool.connect(factory)
+            try:
+                resp = self.send_request(connection, method, url, data, headers)
+            except Exception:
+                self.pool.discard(connection)
+                raise
+        return self.release_connection(key, connection, resp)
+
+    def send_request(self, connection, method, url, data, headers):
+        try:
+            connection.request(method=method, url=url, body=data, headers=headers)
+        except socket.timeout:
+            raise
+        except socket.error as e:
+            if e.errno in (errno.ECONNRESET, errno.EPIPE):
+                e.stale_connection = True
+            raise
+        try:
+            return connection.getresponse()
+        except httplibs.BadStatusLine as e:
+            # the connection was closed without an answer, RemoteDisconnected on python 3
+            e.stale_connection = True
+            raise
+
+    def is_stale_connection_error(self, e):
+        """
+        only a request that was never answered on a reused connection is sent again, a timeout
+        is not retried since the server may still be processing the request
+        """
+        return getattr(e, 'stale_connection', False)
+
+    def release_connection(self, key, connection, resp):
+        content_length = resp.getheader('Content-Length')
+        try:
+            content_length = int(content_length) if content_length is not None else None
+        except ValueError:
+            content_length = None
+        if(content_length is None or content_length > HttpConnectionPool.MaxBufferedBodyBytes):
+            # unknown length, chunked included, or large body: keep the old behaviour and let the caller read from the closed connection
+            connection.close()
+            return resp
+        body = resp.read()
+        if(resp.will_close):
+            self.pool.discard(connection)
+        else:
+            self.pool.checkin(key, connection)
+        return BufferedHttpResponse(resp, body)
@@ -1,4 +1,4 @@
-import time
+import json
 import sys
 import os
 import threading
@@ -7,7 +7,13 @@ try:
     import ConfigParser as ConfigParsers
 except ImportError:
     import configparser as ConfigParsers
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 from common import CommonVariables
+from Utils import HandlerUtil
+from Utils.PhaseProfiler import monotonic
 from pwd import getpwuid
 from stat import *
 import traceback
@@ -31,12 +37,14 @@ import traceback
 
 
 class PluginHostError(object):
-    def __init__(self, errorCode, pluginName):
+    def __init__(self, errorCode, pluginName, elapsedInSeconds = None):
         self.errorCode = errorCode
         self.pluginName = pluginName
+        # None when the host stopped waiting before the script completed
+        self.elapsedInSeconds = elapsedInSeconds
 
     def __str__(self):
-        return 'Plugin :- ', self.pluginName , ' ErrorCode :- ' + str(self.errorCode)
+        return 'Plugin :- ' + str(self.pluginName) + ' ErrorCode :- ' + str(self.errorCode) + ' Elapsed :- ' + str(self.elapsedInSeconds)
 
 
 class PluginHostResult(object):
@@ -47,6 +55,8 @@ class PluginHostResult(object):
         self.errorCode = 0
         self.fileCode = []
         self.filePath = []
+        # milliseconds each plugin's script took, None for the ones that did not complete
+        self.timings = {}
 
     def __str__(self):
         errorStr = ''
@@ -72,6 +82,10 @@ class PluginHost(object):
         self.preScriptResult = []
         self.postScriptCompleted = []
         self.postScriptResult = []
+        self.preScriptStarted = []
+        self.preScriptDone = []
+        self.postScriptDone = []
+        self.preDeadline = 0
         self.pollTime = 3
 
     def pre_check(self):
@@ -158,6 +172,9 @@ class PluginHost(object):
                     self.preScriptResult.append(None)
                     self.postScriptCompleted.append(False)
                     self.postScriptResult.append(None)
+                    self.preScriptStarted.append(False)
+                    self.preScriptDone.append(threading.Event())
+                    self.postScriptDone.append(threading.Event())
 
                 len = len - 1
             if self.noOfPlugins != 0:
@@ -197,90 +214,104 @@ class PluginHost(object):
 
             # Runs pre_script() for all plugins and maintains a timer
 
-
-        result = PluginHostResult()
-        curr = 0
-        for plugin in self.plugins:
-            t1 = threading.Thread(target=plugin.pre_script, args=(curr, self.preScriptCompleted, self.preScriptResult))
-            t1.start()
-            curr = curr + 1
-
-        flag = True
-        for i in range(0, int(self.timeoutInSeconds/self.pollTime) + 2): #waiting 10 more seconds to escape race condition between Host and script timing out
-            time.sleep(self.pollTime)
-            flag = True
-            for j in range(0,self.noOfPlugins):
-                flag = flag & self.preScriptCompleted[j]
-            if flag:
-                break
-
-
-        continueBackup = True
-        #Plugin timed out
-        if not flag:
-            ecode = CommonVariables.FailedPrepostPluginhostPreTimeout
-            result.anyScriptFailed = True
-            presult = PluginHostError(errorCode = ecode, pluginName = self.pluginName[j])
-            result.errors.append(presult)
-        else:
-            for j in range(0,self.noOfPlugins):
-                ecode = CommonVariables.FailedPrepostPluginhostPreTimeout
-                continueBackup = continueBackup & self.preScriptResult[j].continueBackup
-                if self.preScriptCompleted[j]:
-                    ecode = self.preScriptResult[j].errorCode
-                if ecode != CommonVariables.PrePost_PluginStatus_Success:
-                    result.anyScriptFailed = True
-                presult = PluginHostError(errorCode = ecode, pluginName = self.pluginName[j])
-                result.errors.append(presult)
-        result.continueBackup = continueBackup
-        self.logger.log('Finished prescript execution from PluginHost side. Continue Backup: '+str(continueBackup),True,'Info')
+        result = self.run_scripts('pre', self.preScriptCompleted, self.preScriptResult, self.preScriptDone, CommonVariables.FailedPrepostPluginhostPreTimeout)
+        self.logger.log('Finished prescript execution from PluginHost side. Continue Backup: '+str(result.continueBackup),True,'Info')
         return result
 
     def post_script(self):
 
             # Runs post_script() for all plugins and maintains a timer
 
-
         result = PluginHostResult()
         if not self.modulesLoaded:
             return result
 
         self.logger.log('Starting postscript for all modules.',True,'Info')
-        curr = 0
-        for plugin in self.plugins:
-            t1 = threading.Thread(target=plugin.post_script, args=(curr, self.postScriptCompleted, self.postScriptResult))
+        result = self.run_scripts('post', self.postScriptCompleted, self.postScriptResult, self.postScriptDone, CommonVariables.FailedPrepostPluginhostPostTimeout)
+        self.logger.log('Finished postscript execution from PluginHost side. Continue Backup: '+str(result.continueBackup),True,'Info')
+        return result
+
+    def run_script(self, phase, index, scriptCompleted, scriptResult, scriptDone, completions):
+        plugin = self.plugins[index]
+        if phase == 'post' and self.preScriptStarted[index] and not self.preScriptDone[index].is_set():
+            # the prescript of this plugin may still be running if the host stopped waiting for it early,
+            # its postscript must not overlap with it
+            self.logger.log('Waiting for the prescript of '+self.pluginName[index]+' to finish before its postscript.',True,'Info')
+            self.preScriptDone[index].wait(max(self.preDeadline - monotonic(), 0))
+        start = monotonic()
+        try:
+            if phase == 'pre':
+                plugin.pre_script(index, scriptCompleted, scriptResult)
+            else:
+                plugin.post_script(index, scriptCompleted, scriptResult)
+        except Exception as err:
+            errMsg = 'Error in running ' + phase + 'script for plugin ' + self.pluginName[index] + ': %s, stack trace: %s' % (str(err), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Error')
+        finally:
+            scriptDone[index].set()
+            completions.put((index, monotonic() - start))
+
+    def run_scripts(self, phase, scriptCompleted, scriptResult, scriptDone, timeoutErrorCode):
+
+            # Starts the script of every plugin on its own thread and waits on their completions,
+            # returning as soon as all have finished, one of them asks to stop the backup,
+            # or the overall deadline passes
+
+        result = PluginHostResult()
+        completions = Queue.Queue()
+        # a few more seconds to escape race condition between Host and script timing out
+        deadline = monotonic() + self.timeoutInSeconds + 2 * self.pollTime
+        if phase == 'pre':
+            self.preDeadline = deadline
+        for index in range(0, self.noOfPlugins):
+            scriptCompleted[index] = False
+            scriptResult[index] = None
+            scriptDone[index].clear()
+            if phase == 'pre':
+                self.preScriptStarted[index] = True
+            t1 = threading.Thread(target=self.run_script, args=(phase, index, scriptCompleted, scriptResult, scriptDone, completions))
             t1.start()
-            curr = curr + 1
-
-        flag = True
-        for i in range(0, int(self.timeoutInSeconds/self.pollTime) + 2): #waiting 10 more seconds to escape race condition between Host and script timing out
-            time.sleep(self.pollTime)
-            flag = True
-            for j in range(0,self.noOfPlugins):
-                flag = flag & self.postScriptCompleted[j]
-            if flag:
+
+        finished = []
+        elapsed = {}
+        aborted = False
+        while len(finished) < self.noOfPlugins and not aborted:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                index, elapsedInSeconds = completions.get(True, remaining)
+            except Queue.Empty:
                 break
+            finished.append(index)
+            elapsed[index] = elapsedInSeconds
+            self.logger.log(phase.capitalize() + 'script for ' + self.pluginName[index] + ' completed in ' + str(int(elapsedInSeconds * 1000)) + ' ms.',True,'Info')
+            if scriptCompleted[index] and scriptResult[index] is not None and not scriptResult[index].continueBackup:
+                self.logger.log(phase.capitalize() + 'script for ' + self.pluginName[index] + ' asked not to continue the backup, not waiting for the other plugins.',True,'Warning')
+                aborted = True
 
         continueBackup = True
-
-        #Plugin timed out
-        if not flag:
-            ecode = CommonVariables.FailedPrepostPluginhostPostTimeout
-            result.anyScriptFailed = True
-            presult = PluginHostError(errorCode = ecode, pluginName = self.pluginName[j])
-            result.errors.append(presult)
-        else:
-            for j in range(0,self.noOfPlugins):
-                ecode = CommonVariables.FailedPrepostPluginhostPostTimeout
-                continueBackup = continueBackup & self.postScriptResult[j].continueBackup
-                if self.postScriptCompleted[j]:
-                    ecode = self.postScriptResult[j].errorCode
-                if ecode != CommonVariables.PrePost_PluginStatus_Success:
-                    result.anyScriptFailed = True
-                presult = PluginHostError(errorCode = ecode, pluginName = self.pluginName[j])
-                result.errors.append(presult)
+        for index in sorted(finished):
+            ecode = timeoutErrorCode
+            if scriptCompleted[index] and scriptResult[index] is not None:
+                continueBackup = continueBackup & scriptResult[index].continueBackup
+                ecode = scriptResult[index].errorCode
+            if ecode != CommonVariables.PrePost_PluginStatus_Success:
+                result.anyScriptFailed = True
+            result.errors.append(PluginHostError(errorCode = ecode, pluginName = self.pluginName[index], elapsedInSeconds = elapsed[index]))
+            result.timings[self.pluginName[index]] = int(elapsed[index] * 1000)
+
+        #Plugins the host stopped waiting for
+        for index in range(0, self.noOfPlugins):
+            if index not in elapsed:
+                result.timings[self.pluginName[index]] = None
+                if aborted:
+                    # not awaited because another plugin stopped the backup, they did not time out
+                    self.logger.log(phase.capitalize() + 'script for ' + self.pluginName[index] + ' was not awaited, the backup was stopped by another plugin.',True,'Info')
+                    continue
+                self.logger.log(phase.capitalize() + 'script for ' + self.pluginName[index] + ' did not complete within ' + str(self.timeoutInSeconds) + ' seconds.',True,'Error')
+                result.anyScriptFailed = True
+                result.errors.append(PluginHostError(errorCode = timeoutErrorCode, pluginName = self.pluginName[index]))
         result.continueBackup = continueBackup
-        self.logger.log('Finished postscript execution from PluginHost side. Continue Backup: '+str(continueBackup),True,'Info')
+        HandlerUtil.HandlerUtility.add_to_telemetery_data(phase + 'ScriptTimingsMs', json.dumps(result.timings))
         return result
-
-
@@ -0,0 +1,167 @@
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import stat
+import tempfile
+import threading
+try:
+    import ConfigParser as ConfigParsers
+except ImportError:
+    import configparser as ConfigParsers
+
+class ConfigStore(object):
+    """
+    In-memory snapshot of /etc/azure/vmbackup.conf.
+    The file is parsed once and re-parsed only when its (inode, mtime, size) changes,
+    so callers such as the loggers can look up settings on every line without
+    touching ConfigParser. Writes go through a temp file and rename.
+    """
+    __instance__ = None
+    default_config_file = '/etc/azure/vmbackup.conf'
+    default_section = 'SnapshotThread'
+
+    def __init__(self, config_file = default_config_file):
+        self.config_file = config_file
+        self.lock = threading.RLock()
+        self.signature = None
+        self.sections = {}
+        self.typed_values = {}
+        self.reload_count = 0
+
+    @staticmethod
+    def get_instance(config_file = default_config_file):
+        if ConfigStore.__instance__ is None or ConfigStore.__instance__.config_file != config_file:
+            ConfigStore.__instance__ = ConfigStore(config_file)
+        return ConfigStore.__instance__
+
+    def _get_signature(self):
+        try:
+            st = os.stat(self.config_file)
+            return (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            return None
+
+    def _load(self, signature):
+        sections = {}
+        if signature is not None:
+            config = ConfigParsers.RawConfigParser()
+            config.read(self.config_file)
+            for section in config.sections():
+                sections[section] = dict(config.items(section))
+        self.sections = sections
+        self.typed_values = {}
+        self.signature = signature
+        self.reload_count += 1
+
+    def revalidate(self):
+        with self.lock:
+            signature = self._get_signature()
+            if signature != self.signature or self.reload_count == 0:
+                try:
+                    self._load(signature)
+                except Exception:
+                    # keep serving the last good snapshot, retry on the next change
+                    self.signature = signature
+            return self.sections
+
+    def _optionxform(self, key):
+        return str(key).lower()
+
+    def get(self, key, section = default_section):
+        return self._lookup(self.revalidate(), key, section)
+
+    def _lookup(self, sections, key, section):
+        options = sections.get(section)
+        if options is None:
+            return None
+        return options.get(self._optionxform(key))
+
+    def has_option(self, key, section = default_section):
+        return self.get(key, section) is not None
+
+    def _get_typed(self, key, default, section, convert):
+        cache_key = (section, self._optionxform(key), convert, default)
+        with self.lock:
+            # one stat per lookup, the value is read from the snapshot the cache belongs to
+            sections = self.revalidate()
+            if cache_key in self.typed_values:
+                return self.typed_values[cache_key]
+            value = self._lookup(sections, key, section)
+            if value is None or value == '':
+                typed = default
+            else:
+                try:
+                    typed = convert(value)
+                except ValueError:
+                    typed = default
+            self.typed_values[cache_key] = typed
+            return typed
+
+    def get_str(self, key, default, section = default_section):
+        return self._get_typed(key, default, section, str)
+
+    def get_int(self, key, default, section = default_section):
+        return self._get_typed(key, default, section, int)
+
+    def get_bool(self, key, default, section = default_section):
+        return self._get_typed(key, default, section, ConfigStore._to_bool)
+
+    @staticmethod
+    def _to_bool(value):
+        value = str(value).strip().lower()
+        if value in ['true', '1', 'yes', 'on']:
+            return True
+        if value in ['false', '0', 'no', 'off']:
+            return False
+        raise ValueError('not a boolean: ' + value)
+
+    def set(self, key, value, section = default_section):
+        with self.lock:
+            config_dir = os.path.dirname(self.config_file)
+            if not os.path.exists(config_dir):
+                os.makedirs(config_dir)
+            # always start from what is on disk, another process may have changed it
+            self._load(self._get_signature())
+            config = ConfigParsers.RawConfigParser()
+            for section_name in sorted(self.sections.keys()):
+                config.add_section(section_name)
+                for option, option_value in self.sections[section_name].items():
+                    config.set(section_name, option, option_value)
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, self._optionxform(key), str(value))
+            self._write_atomic(config)
+            self._load(self._get_signature())
+        return value
+
+    def _write_atomic(self, config):
+        config_dir = os.path.dirname(self.config_file)
+        fd, temp_file = tempfile.mkstemp(prefix='.' + os.path.basename(self.config_file) + '.', dir=config_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                config.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.config_file):
+                os.chmod(temp_file, stat.S_IMODE(os.stat(self.config_file).st_mode))
+            else:
+                os.chmod(temp_file, 0o644)
+            os.rename(temp_file, self.config_file)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
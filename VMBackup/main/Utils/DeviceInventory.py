@@ -0,0 +1,149 @@
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import re
+from common import DeviceItem
+from Utils.MountIndex import MountIndex
+
+class DeviceInventory(object):
+    """
+    Builds the DeviceItem list lsblk would print (NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE)
+    in one pass over sysfs, the mount index and the udev database, without running any process.
+    """
+    sys_block_dir = '/sys/block'
+    sys_class_block_dir = '/sys/class/block'
+    # udev >= 174 keeps its database in /run/udev/data, older releases such as SLES 11 in /dev/.udev/db
+    udev_data_dir = '/run/udev/data'
+    legacy_udev_db_dir = '/dev/.udev/db'
+    by_uuid_dir = '/dev/disk/by-uuid'
+    by_label_dir = '/dev/disk/by-label'
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.mount_index = MountIndex.get_instance(logger)
+
+    def log(self, msg, level = 'Info'):
+        if self.logger is not None:
+            self.logger.log(msg, True, level)
+
+    @staticmethod
+    def natural_key(name):
+        return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+    @staticmethod
+    def read_value(path):
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def is_available(self):
+        return os.path.isdir(DeviceInventory.sys_block_dir) and os.path.isdir(DeviceInventory.sys_class_block_dir)
+
+    def list_kernel_names(self, dev_path):
+        """
+        Kernel names in lsblk list order, every disk followed by its partitions.
+        With dev_path only that device, and its partitions when it is a disk.
+        """
+        names = []
+        for disk in sorted(os.listdir(DeviceInventory.sys_block_dir), key = DeviceInventory.natural_key):
+            disk_dir = os.path.join(DeviceInventory.sys_block_dir, disk)
+            if disk.startswith('loop') and not os.path.exists(os.path.join(disk_dir, 'loop', 'backing_file')):
+                # like lsblk, skip loop devices with nothing attached
+                continue
+            names.append(disk)
+            partitions = [entry for entry in os.listdir(disk_dir) if entry.startswith(disk) and os.path.exists(os.path.join(disk_dir, entry, 'partition'))]
+            names.extend(sorted(partitions, key = DeviceInventory.natural_key))
+        if dev_path is None:
+            return names
+        target = os.path.basename(os.path.realpath(dev_path))
+        if target not in names:
+            return []
+        if os.path.isdir(os.path.join(DeviceInventory.sys_block_dir, target)):
+            return [name for name in names if name == target or (name.startswith(target) and os.path.exists(os.path.join(DeviceInventory.sys_block_dir, target, name, 'partition')))]
+        return [target]
+
+    def read_udev_properties(self, kernel_name, major_minor):
+        properties = {}
+        candidates = []
+        if major_minor is not None:
+            candidates.append(os.path.join(DeviceInventory.udev_data_dir, 'b' + major_minor))
+        candidates.append(os.path.join(DeviceInventory.legacy_udev_db_dir, 'block:' + kernel_name))
+        for candidate in candidates:
+            content = DeviceInventory.read_value(candidate)
+            if content is None:
+                continue
+            for line in content.splitlines():
+                if line.startswith('E:') and '=' in line:
+                    key, value = line[2:].split('=', 1)
+                    properties[key] = value
+            break
+        return properties
+
+    def read_symlink_map(self, directory):
+        # /dev/disk/by-uuid/<uuid> -> ../../sda1 gives kernel name -> uuid
+        result = {}
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            return result
+        for entry in entries:
+            target = os.path.basename(os.path.realpath(os.path.join(directory, entry)))
+            # udev escapes spaces and slashes in labels as \x20 and \x2f
+            result.setdefault(target, re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), entry))
+        return result
+
+    def get_device_items(self, dev_path):
+        self.mount_index.refresh()
+        mounts_by_device = {}
+        for entry in self.mount_index.get_block_mounts():
+            mounts_by_device.setdefault(entry.name, entry)
+        uuids = None
+        labels = None
+        device_items = []
+        for kernel_name in self.list_kernel_names(dev_path):
+            sys_path = os.path.realpath(os.path.join(DeviceInventory.sys_class_block_dir, kernel_name))
+            major_minor = DeviceInventory.read_value(os.path.join(sys_path, 'dev'))
+            device_item = DeviceItem()
+            device_item.name = self.mount_index.get_device_name(sys_path, kernel_name)
+            device_item.type = self.mount_index.get_device_type(sys_path, kernel_name)
+            udev = self.read_udev_properties(kernel_name, major_minor)
+            device_item.file_system = udev.get('ID_FS_TYPE')
+            device_item.label = udev.get('ID_FS_LABEL')
+            device_item.uuid = udev.get('ID_FS_UUID')
+            if device_item.uuid is None:
+                if uuids is None:
+                    uuids = self.read_symlink_map(DeviceInventory.by_uuid_dir)
+                device_item.uuid = uuids.get(kernel_name)
+            if device_item.label is None:
+                if labels is None:
+                    labels = self.read_symlink_map(DeviceInventory.by_label_dir)
+                device_item.label = labels.get(kernel_name)
+            mount = mounts_by_device.get(device_item.name)
+            if mount is not None:
+                device_item.mount_point = mount.mount_point
+                if not device_item.file_system:
+                    device_item.file_system = mount.fstype
+            device_item.model = DeviceInventory.read_value(os.path.join(sys_path, 'device', 'model'))
+            sectors = DeviceInventory.read_value(os.path.join(sys_path, 'size'))
+            if sectors is not None and sectors.isdigit():
+                # sysfs always counts 512 byte sectors
+                device_item.size = int(sectors) * 512
+            device_items.append(device_item)
+            self.log("sysfs MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model))
+        return device_items
@@ -27,17 +27,16 @@ import uuid
 import glob
 from common import DeviceItem
 import Utils.HandlerUtil
+from Utils.ConfigStore import ConfigStore
+from Utils.DeviceInventory import DeviceInventory
 import traceback
-try:
-        import ConfigParser as ConfigParsers
-except ImportError:
-        import configparser as ConfigParsers
 
 class DiskUtil(object):
     __instance__ = None
     patching = None
     logger = None
     mount_output = None
+    device_items_cache = None
 
 
     def __init__(self, patching, logger):
@@ -46,6 +45,7 @@ class DiskUtil(object):
             self.patching = patching
             self.logger = logger
             self.mount_output = None
+            self.device_items_cache = {}
             DiskUtil.__instance__ = self
         else:
             return DiskUtil.__instance__
@@ -74,6 +74,31 @@ class DiskUtil(object):
         return None
 
     def get_device_items_sles(self,dev_path):
+        cache_key = str(dev_path)
+        if(cache_key in self.device_items_cache):
+            self.logger.log("get_device_items_sles : using the device inventory already built for " + str(dev_path), True)
+            return list(self.device_items_cache[cache_key])
+        device_items = None
+        try:
+            inventory = DeviceInventory(self.logger)
+            if(inventory.is_available()):
+                self.logger.log("get_device_items_sles : building the device inventory from sysfs for " + str(dev_path), True)
+                device_items = inventory.get_device_items(dev_path)
+        except Exception as e:
+            errMsg = 'Failed to build the device inventory from sysfs, error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Warning')
+            device_items = None
+        if(device_items is None):
+            # one lsblk call for every property of every device
+            is_lsblk_path_wrong, out_lsblk_output, error_msg = self.get_lsblk_pairs_output(self.patching.lsblk_path, dev_path)
+            if(is_lsblk_path_wrong == False and out_lsblk_output is not None and not (error_msg is not None and error_msg.strip() != "")):
+                device_items = self.parse_lsblk_pairs_output(out_lsblk_output, False)
+        if(device_items is None):
+            device_items = self.get_device_items_sles_per_device(dev_path)
+        self.device_items_cache[cache_key] = device_items
+        return list(device_items)
+
+    def get_device_items_sles_per_device(self,dev_path):
         self.logger.log("get_device_items_sles : getting the blk info from " + str(dev_path), True)
         device_items = []
         #first get all the device names
@@ -161,22 +186,18 @@ class DiskUtil(object):
         # [lsblkUser]
         # username: vmadmin
 
-        configfile = '/etc/azure/vmbackup.conf'
         command_user = ''
         alternate_user = False
 
         try :
-            if os.path.exists(configfile):
-                config = ConfigParsers.ConfigParser()
-                config.read(configfile)
-                if config.has_option('lsblkUser','username'):
-                    lsblk_user = config.get('lsblkUser','username')
-                    command_user = "su - " + lsblk_user + " -c"
-                    if (dev_path is None):
-                        command_user = command_user + ' \'' + 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE' + '\''
-                    else:
-                        command_user = command_user + ' \'' + 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE' + ' ' + dev_path + '\''
-                    alternate_user = True
+            lsblk_user = ConfigStore.get_instance().get('username', 'lsblkUser')
+            if lsblk_user is not None:
+                command_user = "su - " + lsblk_user + " -c"
+                if (dev_path is None):
+                    command_user = command_user + ' \'' + 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE' + '\''
+                else:
+                    command_user = command_user + ' \'' + 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE' + ' ' + dev_path + '\''
+                alternate_user = True
         except Exception as e:
             pass
 
@@ -259,43 +280,48 @@ class DiskUtil(object):
                 device_items = self.get_device_items_from_lsblk_list(lsblk_path, dev_path)
             # else get device_items from parsing the lsblk command output
             elif (out_lsblk_output is not None):
-                lines = out_lsblk_output.splitlines()
-                for i in range(0,len(lines)):
-                    item_value_str = lines[i].strip()
-                    if(item_value_str != ""):
-                        disk_info_item_array =Utils.HandlerUtil.HandlerUtility.split(self.logger, item_value_str)
-                        device_item = DeviceItem()
-                        disk_info_item_array_length = len(disk_info_item_array)
-                        for j in range(0, disk_info_item_array_length):
-                            disk_info_property = disk_info_item_array[j]
-                            property_item_pair = disk_info_property.split('=')
+                device_items = self.parse_lsblk_pairs_output(out_lsblk_output, True)
+            return device_items
+
+    def parse_lsblk_pairs_output(self, out_lsblk_output, only_mounted):
+        device_items = []
+        lines = out_lsblk_output.splitlines()
+        for i in range(0,len(lines)):
+            item_value_str = lines[i].strip()
+            if(item_value_str != ""):
+                disk_info_item_array =Utils.HandlerUtil.HandlerUtility.split(self.logger, item_value_str)
+                device_item = DeviceItem()
+                disk_info_item_array_length = len(disk_info_item_array)
+                for j in range(0, disk_info_item_array_length):
+                    disk_info_property = disk_info_item_array[j]
+                    property_item_pair = disk_info_property.split('=')
 
-                            if(property_item_pair[0] == 'NAME'):
-                                device_item.name = property_item_pair[1].strip('"')
+                    if(property_item_pair[0] == 'NAME'):
+                        device_item.name = property_item_pair[1].strip('"')
 
-                            if(property_item_pair[0] == 'TYPE'):
-                                device_item.type = property_item_pair[1].strip('"')
+                    if(property_item_pair[0] == 'TYPE'):
+                        device_item.type = property_item_pair[1].strip('"')
 
-                            if(property_item_pair[0] == 'FSTYPE'):
-                                device_item.file_system = property_item_pair[1].strip('"')
-                        
-                            if(property_item_pair[0] == 'MOUNTPOINT'):
-                                device_item.mount_point = property_item_pair[1].strip('"')
+                    if(property_item_pair[0] == 'FSTYPE'):
+                        device_item.file_system = property_item_pair[1].strip('"')
+                
+                    if(property_item_pair[0] == 'MOUNTPOINT'):
+                        device_item.mount_point = property_item_pair[1].strip('"')
 
-                            if(property_item_pair[0] == 'LABEL'):
-                                device_item.label = property_item_pair[1].strip('"')
+                    if(property_item_pair[0] == 'LABEL'):
+                        device_item.label = property_item_pair[1].strip('"')
 
-                            if(property_item_pair[0] == 'UUID'):
-                                device_item.uuid = property_item_pair[1].strip('"')
+                    if(property_item_pair[0] == 'UUID'):
+                        device_item.uuid = property_item_pair[1].strip('"')
 
-                            if(property_item_pair[0] == 'MODEL'):
-                                device_item.model = property_item_pair[1].strip('"')
+                    if(property_item_pair[0] == 'MODEL'):
+                        device_item.model = property_item_pair[1].strip('"')
 
-                        self.logger.log("lsblk MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model), True)
-                        
-                        if(device_item.mount_point is not None and device_item.mount_point != "" and device_item.mount_point != " "):
-                            device_items.append(device_item)
-            return device_items
+                self.logger.log("lsblk MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model), True)
+                
+                if(only_mounted == False or (device_item.mount_point is not None and device_item.mount_point != "" and device_item.mount_point != " ")):
+                    device_items.append(device_item)
+        return device_items
 
     def get_mount_command_output(self, mount_path):
         self.logger.log("getting the mount info using mount_path " + str(mount_path), True)
@@ -78,6 +78,8 @@ import platform
 import subprocess
 import datetime
 import Utils.Status
+from Utils.ConfigStore import ConfigStore
+from Utils.StatusPipeline import TelemetryJournal
 from MachineIdentity import MachineIdentity
 import ExtensionErrorCodeHelper
 import traceback
@@ -93,19 +95,23 @@ class HandlerContext:
 class HandlerUtility:
     telemetry_data = {} 
     serializable_telemetry_data = []
+    # facts that do not change while the process runs, collected on the first status report
+    static_telemetry_data = None
+    replayed_task_id = None
     ExtErrorCode = ExtensionErrorCodeHelper.ExtensionErrorCodeEnum.success
     SnapshotConsistency = Utils.Status.SnapshotConsistencyType.none
     HealthStatusCode = -1
     def __init__(self, log, error, short_name):
         self._log = log
         self._error = error
-        self.log_message = ""
+        self.log_message_parts = []
         self._short_name = short_name
         self.patching = None
         self.storageDetailsObj = None
         self.partitioncount = 0
         self.logging_file = None
         self.pre_post_enabled = False
+        self.config_store = ConfigStore.get_instance()
 
     def _get_log_prefix(self):
         return '[%s-%s]' % (self._context._name, self._context._version)
@@ -169,7 +175,7 @@ class HandlerUtility:
             else:
                 self._log(self._get_log_prefix() + message)
             message = "{0}  {1}  {2} \n".format(str(datetime.datetime.utcnow()) , level , message)
-        self.log_message = self.log_message + message
+        self.log_message_parts.append(message)
 
     def log_py3(self, msg):
         if type(msg) is not str:
@@ -185,7 +191,7 @@ class HandlerUtility:
         self._error(self._get_log_prefix() + message)
 
     def fetch_log_message(self):
-        return self.log_message
+        return ''.join(self.log_message_parts)
 
     def _parse_config(self, ctxt):
         config = None
@@ -330,36 +336,23 @@ class HandlerUtility:
     onlyLocalFilesystems = True
 
     seqsnapshot valid values(0-> parallel snapshot, 1-> programatically set sequential snapshot , 2-> customer set it for sequential snapshot)
+    with AdaptiveSnapshotMode (default True) the mode is picked from run history and seqsnapshot=1 only seeds that choice
     '''
 
     def get_value_from_configfile(self, key):
-        global backup_logger
         value = None
-        configfile = '/etc/azure/vmbackup.conf'
         try :
-            if os.path.exists(configfile):
-                config = ConfigParsers.ConfigParser()
-                config.read(configfile)
-                if config.has_option('SnapshotThread',key):
-                    value = config.get('SnapshotThread',key)  
+            value = self.config_store.get(key)
         except Exception as e:
             pass
 
         return value
 
     def get_strvalue_from_configfile(self, key, default):
-        value = self.get_value_from_configfile(key)
-        
-        if value == None or value == '':
-            value = default
-
         try :
-            value_str = str(value)
-        except ValueError :
-            self.log('Not able to parse the read value as string, falling back to default value', 'Warning')
-            value = default
-
-        return value
+            return self.config_store.get_str(key, default)
+        except Exception as e:
+            return default
 
     def get_intvalue_from_configfile(self, key, default):
         value = default
@@ -377,24 +370,9 @@ class HandlerUtility:
         return int(value)
  
     def set_value_to_configfile(self, key, value):
-        configfile = '/etc/azure/vmbackup.conf'
         try :
             self.log('setting ' + str(key)  + 'in config file to ' + str(value) , 'Info')
-            if not os.path.exists(os.path.dirname(configfile)):
-                os.makedirs(os.path.dirname(configfile))
-            config = ConfigParsers.RawConfigParser()
-            if os.path.exists(configfile):
-                config.read(configfile)
-                if config.has_section('SnapshotThread'):
-                    if config.has_option('SnapshotThread', key):
-                        config.remove_option('SnapshotThread', key)
-                else:
-                    config.add_section('SnapshotThread')
-            else:
-                config.add_section('SnapshotThread')
-            config.set('SnapshotThread', key, value)
-            with open(configfile, 'w') as config_file:
-                config.write(config_file)
+            self.config_store.set(key, value)
         except Exception as e:
             errorMsg = " Unable to set config file.key is "+ key +"with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
             self.log(errorMsg, 'Warning')
@@ -545,17 +523,37 @@ class HandlerUtility:
 
     @staticmethod
     def add_to_telemetery_data(key,value):
+        if HandlerUtility.telemetry_data.get(key) != value or key not in HandlerUtility.telemetry_data:
+            TelemetryJournal.get_instance().record(key, value)
         HandlerUtility.telemetry_data[key]=value
 
     def add_telemetry_data(self):
-        os_version,kernel_version = self.get_dist_info()
+        if HandlerUtility.static_telemetry_data is None:
+            # waagent -version alone is a process spawn, do it once and not on every report
+            os_version,kernel_version = self.get_dist_info()
+            HandlerUtility.static_telemetry_data = [("guestAgentVersion",self.get_wala_version_from_command()),
+                                                    ("extensionVersion",self.get_extension_version()),
+                                                    ("osVersion",os_version),
+                                                    ("kernelVersion",kernel_version)]
+        for key, value in HandlerUtility.static_telemetry_data:
+            HandlerUtility.add_to_telemetery_data(key, value)
         workloads = self.get_workload_running()
-        HandlerUtility.add_to_telemetery_data("guestAgentVersion",self.get_wala_version_from_command())
-        HandlerUtility.add_to_telemetery_data("extensionVersion",self.get_extension_version())
-        HandlerUtility.add_to_telemetery_data("osVersion",os_version)
-        HandlerUtility.add_to_telemetery_data("kernelVersion",kernel_version)
         HandlerUtility.add_to_telemetery_data("workloads",str(workloads))
         HandlerUtility.add_to_telemetery_data("prePostEnabled", str(self.pre_post_enabled))
+
+    def replay_telemetry_journal(self, taskId):
+        # values journaled by an earlier process of this task, e.g. one that crashed, that this process has not reported
+        if taskId is None or HandlerUtility.replayed_task_id == taskId:
+            return
+        HandlerUtility.replayed_task_id = taskId
+        journal = TelemetryJournal.get_instance(self)
+        for key, value in journal.replay(taskId):
+            if key not in HandlerUtility.telemetry_data:
+                HandlerUtility.telemetry_data[key] = value
+
+    def flush_telemetry_journal(self, taskId):
+        if taskId is not None:
+            TelemetryJournal.get_instance(self).flush(taskId)
     
     def convert_telemetery_data_to_bcm_serializable_format(self):
         HandlerUtility.serializable_telemetry_data = []
@@ -569,6 +567,7 @@ class HandlerUtility:
         self.log("{0},{1},{2},{3}".format(operation, status, status_code, message))
         sub_stat = []
         stat_rept = []
+        self.replay_telemetry_journal(taskId)
         self.add_telemetry_data()
         snapshotTelemetry = ""
 
@@ -597,6 +596,7 @@ class HandlerUtility:
                 self.SnapshotConsistency = Utils.Status.SnapshotConsistencyType.none
                 consistencyTypeStr = CommonVariables.consistency_none
         HandlerUtility.add_to_telemetery_data("consistencyType", consistencyTypeStr)
+        self.flush_telemetry_journal(taskId)
 
         extensionResponseObj = Utils.Status.ExtensionResponse(message, self.SnapshotConsistency, "")
         message = str(json.dumps(extensionResponseObj, cls = ComplexEncoder))
@@ -0,0 +1,277 @@
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import os.path
+import re
+import tempfile
+import threading
+import traceback
+
+class MountEntry(object):
+    def __init__(self, mount_id, major_minor, root, mount_point, fstype, source, name, type):
+        self.mount_id = mount_id
+        self.major_minor = major_minor
+        self.root = root
+        self.mount_point = mount_point
+        self.fstype = fstype
+        self.source = source
+        # name and type follow the lsblk NAME/TYPE columns, None when the mount is not backed by a block device
+        self.name = name
+        self.type = type
+        self.unique_name = str(self.mount_point) + "_" + str(self.name)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @staticmethod
+    def from_dict(d):
+        return MountEntry(d['mount_id'], d['major_minor'], d['root'], d['mount_point'], d['fstype'], d['source'], d['name'], d['type'])
+
+class MountIndex(object):
+    """
+    Mount topology built from /proc/self/mountinfo and sysfs, without running mount or lsblk.
+    Entries are indexed by mount point, unique name and device so lookups are O(1).
+    The resolved topology is persisted to cache_file and reused by later runs as long as
+    mountinfo and the set of block devices are unchanged.
+    """
+    __instance__ = None
+    mountinfo_file = '/proc/self/mountinfo'
+    sys_block_dir = '/sys/class/block'
+    sys_dev_block_dir = '/sys/dev/block'
+    default_cache_file = '/etc/azure/vmbackup_mountindex.json'
+    cache_version = 1
+
+    def __init__(self, logger, cache_file = default_cache_file):
+        self.logger = logger
+        self.cache_file = cache_file
+        self.lock = threading.RLock()
+        self.signature = None
+        self.entries = []
+        self.by_mount_point = {}
+        self.by_unique_name = {}
+        self.by_device = {}
+        self.block_mount_points = set()
+        self.cache_hit = False
+
+    @staticmethod
+    def get_instance(logger, cache_file = default_cache_file):
+        if MountIndex.__instance__ is None or MountIndex.__instance__.cache_file != cache_file:
+            MountIndex.__instance__ = MountIndex(logger, cache_file)
+        MountIndex.__instance__.logger = logger
+        return MountIndex.__instance__
+
+    def log(self, msg, level = 'Info'):
+        if self.logger is not None:
+            self.logger.log(msg, True, level)
+
+    @staticmethod
+    def unescape(value):
+        # mountinfo escapes space, tab, newline and backslash as \ooo
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
+
+    def read_mountinfo(self):
+        with open(self.mountinfo_file, 'rb') as f:
+            return f.read()
+
+    def compute_signature(self, mountinfo):
+        digest = hashlib.md5(mountinfo)
+        try:
+            block_devices = sorted(os.listdir(self.sys_block_dir))
+        except OSError:
+            block_devices = []
+        digest.update('\n'.join(block_devices).encode('utf-8'))
+        return digest.hexdigest()
+
+    def refresh(self):
+        """
+        Brings the index in line with the current mount table.
+        Returns True when the index is usable, False when mountinfo is not available on this system.
+        """
+        with self.lock:
+            try:
+                mountinfo = self.read_mountinfo()
+            except (IOError, OSError):
+                self.log("mountinfo is not available, mount index disabled")
+                return False
+            signature = self.compute_signature(mountinfo)
+            if signature == self.signature:
+                return True
+            self.cache_hit = False
+            entries = self.load_cache(signature)
+            if entries is not None:
+                self.cache_hit = True
+            else:
+                entries = self.parse_mountinfo(mountinfo)
+                self.save_cache(signature, entries)
+            self.build_index(entries)
+            self.signature = signature
+            self.log("mount index loaded with " + str(len(entries)) + " entries, cache hit: " + str(self.cache_hit))
+            return True
+
+    def parse_mountinfo(self, mountinfo):
+        """
+        Each line looks like
+        36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+        with a variable number of optional fields before the '-' separator.
+        """
+        entries = []
+        device_cache = {}
+        if not isinstance(mountinfo, str):
+            mountinfo = mountinfo.decode('utf-8', 'replace')
+        for line in mountinfo.splitlines():
+            fields = line.split()
+            try:
+                separator = fields.index('-')
+            except ValueError:
+                continue
+            if separator < 6 or len(fields) < separator + 3:
+                continue
+            major_minor = fields[2]
+            root = self.unescape(fields[3])
+            mount_point = self.unescape(fields[4])
+            fstype = fields[separator + 1]
+            source = self.unescape(fields[separator + 2])
+            cache_key = (major_minor, source)
+            if cache_key not in device_cache:
+                device_cache[cache_key] = self.resolve_block_device(major_minor, source)
+            name, type = device_cache[cache_key]
+            entries.append(MountEntry(fields[0], major_minor, root, mount_point, fstype, source, name, type))
+        return entries
+
+    def resolve_block_device(self, major_minor, source):
+        sys_path = None
+        dev_link = os.path.join(self.sys_dev_block_dir, major_minor)
+        if not major_minor.startswith('0:') and os.path.exists(dev_link):
+            sys_path = os.path.realpath(dev_link)
+        elif source.startswith('/dev/'):
+            # btrfs and a few others report an anonymous device number, go through the source path
+            candidate = os.path.join(self.sys_block_dir, os.path.basename(os.path.realpath(source)))
+            if os.path.exists(candidate):
+                sys_path = os.path.realpath(candidate)
+        if sys_path is None:
+            return None, None
+        kernel_name = os.path.basename(sys_path)
+        return self.get_device_name(sys_path, kernel_name), self.get_device_type(sys_path, kernel_name)
+
+    def read_sysfs_value(self, path):
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def get_device_name(self, sys_path, kernel_name):
+        dm_name = self.read_sysfs_value(os.path.join(sys_path, 'dm', 'name'))
+        if dm_name:
+            return dm_name
+        return kernel_name
+
+    def get_device_type(self, sys_path, kernel_name):
+        if os.path.exists(os.path.join(sys_path, 'partition')):
+            return 'part'
+        dm_uuid = self.read_sysfs_value(os.path.join(sys_path, 'dm', 'uuid'))
+        if dm_uuid is not None:
+            prefix = dm_uuid.split('-')[0].lower() if '-' in dm_uuid else 'dm'
+            if prefix == 'crypt':
+                return 'crypt'
+            if prefix == 'mpath':
+                return 'mpath'
+            if prefix == 'lvm':
+                return 'lvm'
+            return 'dm'
+        if kernel_name.startswith('loop'):
+            return 'loop'
+        if kernel_name.startswith('sr'):
+            return 'rom'
+        md_level = self.read_sysfs_value(os.path.join(sys_path, 'md', 'level'))
+        if md_level:
+            return md_level
+        return 'disk'
+
+    def build_index(self, entries):
+        by_mount_point = {}
+        by_unique_name = {}
+        by_device = {}
+        for entry in entries:
+            # a later entry for the same mount point is mounted over the earlier one
+            by_mount_point[entry.mount_point] = entry
+            by_unique_name[entry.unique_name] = entry
+            if entry.name is not None:
+                by_device.setdefault(entry.name, []).append(entry)
+        self.entries = entries
+        self.by_mount_point = by_mount_point
+        self.by_unique_name = by_unique_name
+        self.by_device = by_device
+        self.block_mount_points = set(entry.mount_point for entry in entries if entry.name is not None)
+
+    def get_by_mount_point(self, mount_point):
+        return self.by_mount_point.get(mount_point)
+
+    def get_by_unique_name(self, unique_name):
+        return self.by_unique_name.get(unique_name)
+
+    def is_block_mount_point(self, mount_point):
+        return mount_point in self.block_mount_points
+
+    def get_visible_mounts(self):
+        """
+        Mounts that are not hidden under a later mount on the same mount point, in mount table order.
+        """
+        return [entry for entry in self.entries if self.by_mount_point.get(entry.mount_point) is entry]
+
+    def get_block_mounts(self):
+        """
+        One visible mount per block device in mount table order, matching what lsblk reports as the
+        device mount point. The mount of the filesystem root is preferred over bind mounts of it.
+        """
+        chosen = {}
+        for entry in self.get_visible_mounts():
+            if entry.name is None:
+                continue
+            current = chosen.get(entry.name)
+            if current is None or (current.root != '/' and entry.root == '/'):
+                chosen[entry.name] = entry
+        return [entry for entry in self.get_visible_mounts() if entry.name is not None and chosen.get(entry.name) is entry]
+
+    def load_cache(self, signature):
+        try:
+            if not os.path.exists(self.cache_file):
+                return None
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('version') != self.cache_version or cache.get('signature') != signature:
+                return None
+            return [MountEntry.from_dict(d) for d in cache['entries']]
+        except Exception:
+            self.log("mount index cache is unreadable, rebuilding: " + traceback.format_exc(), 'Warning')
+            return None
+
+    def save_cache(self, signature, entries):
+        cache_dir = os.path.dirname(self.cache_file)
+        temp_file = None
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            fd, temp_file = tempfile.mkstemp(prefix='.' + os.path.basename(self.cache_file) + '.', dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': self.cache_version, 'signature': signature, 'entries': [entry.to_dict() for entry in entries]}, f)
+            os.rename(temp_file, self.cache_file)
+        except Exception:
+            self.log("failed to save mount index cache: " + traceback.format_exc(), 'Warning')
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
@@ -0,0 +1,254 @@
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+import traceback
+
+def _get_monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6', use_errno = True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _get_monotonic_clock()
+
+class PhaseScope(object):
+    def __init__(self, profiler, phase, detail):
+        self.profiler = profiler
+        self.phase = phase
+        self.detail = detail
+        self.record = None
+
+    def __enter__(self):
+        self.record = self.profiler.begin(self.phase, self.detail)
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profiler.end(self.record, 'error' if exc_type is not None else None)
+        return False
+
+class PhaseProfiler(object):
+    """
+    Records how long each phase of the freeze window takes, on a monotonic clock.
+    Every run produces one JSON timeline; the span of every phase is appended to a
+    rolling history so percentiles across runs can be reported with the run.
+    Recording is thread safe but must not be called from signal handlers, they should
+    only capture monotonic() and hand the value to record() later.
+    """
+    __instance__ = None
+    default_state_dir = '/etc/azure'
+    HistoryFileName = 'FreezePhaseHistory.json'
+    TimelineFileName = 'FreezePhaseTimeline.json'
+    MaxHistoryRunsDefault = 50
+    Percentiles = [50, 90, 99]
+
+    def __init__(self, logger = None, state_dir = default_state_dir, max_history_runs = MaxHistoryRunsDefault):
+        self.logger = logger
+        self.state_dir = state_dir
+        self.max_history_runs = max_history_runs
+        self.lock = threading.Lock()
+        self.reset()
+
+    @staticmethod
+    def get_instance(logger = None):
+        if PhaseProfiler.__instance__ is None:
+            PhaseProfiler.__instance__ = PhaseProfiler(logger)
+        elif logger is not None:
+            PhaseProfiler.__instance__.logger = logger
+        return PhaseProfiler.__instance__
+
+    def log(self, msg, level = 'Info'):
+        if self.logger is not None:
+            self.logger.log(msg, True, level)
+
+    def reset(self, run_id = None):
+        with self.lock:
+            self.run_id = run_id
+            self.run_start = monotonic()
+            self.run_start_utc = time.time()
+            self.records = []
+
+    def start_run(self, run_id):
+        self.reset(run_id)
+        self.log("phase profiler started for run " + str(run_id))
+
+    def begin(self, phase, detail = None):
+        record = {'phase': phase, 'detail': detail, 'start': monotonic(), 'end': None, 'status': None, 'thread': threading.current_thread().name}
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    def end(self, record, status = None):
+        if record is None:
+            return
+        with self.lock:
+            record['end'] = monotonic()
+            record['status'] = status
+
+    def record(self, phase, start, end, detail = None, status = None):
+        if start is None or end is None:
+            return
+        record = {'phase': phase, 'detail': detail, 'start': start, 'end': end, 'status': status, 'thread': threading.current_thread().name}
+        with self.lock:
+            self.records.append(record)
+
+    def mark(self, phase, detail = None):
+        now = monotonic()
+        self.record(phase, now, now, detail)
+
+    def phase(self, phase, detail = None):
+        return PhaseScope(self, phase, detail)
+
+    def to_ms(self, value):
+        return int(round((value - self.run_start) * 1000))
+
+    def get_timeline(self):
+        with self.lock:
+            records = list(self.records)
+        now = monotonic()
+        timeline = []
+        for record in sorted(records, key = lambda r: r['start']):
+            end = record['end']
+            entry = {'phase': record['phase'], 'start_ms': self.to_ms(record['start']), 'thread': record['thread']}
+            if record['detail'] is not None:
+                entry['detail'] = record['detail']
+            if end is None:
+                # still open, e.g. the run failed inside it
+                entry['duration_ms'] = int(round((now - record['start']) * 1000))
+                entry['status'] = 'open'
+            else:
+                entry['duration_ms'] = int(round((end - record['start']) * 1000))
+                if record['status'] is not None:
+                    entry['status'] = record['status']
+            timeline.append(entry)
+        return timeline
+
+    def get_durations_ms(self, phase, since = None):
+        with self.lock:
+            records = [r for r in self.records if r['phase'] == phase and r['end'] is not None and (since is None or r['start'] >= since)]
+        return [int(round((r['end'] - r['start']) * 1000)) for r in records]
+
+    def get_phase_spans(self, timeline):
+        """
+        Wall clock span of every phase, from its first start to its last end.
+        For per blob phases that is the time the slowest blob kept the freeze open.
+        """
+        bounds = {}
+        for entry in timeline:
+            start = entry['start_ms']
+            end = start + entry['duration_ms']
+            if entry['phase'] in bounds:
+                first, last, count = bounds[entry['phase']]
+                bounds[entry['phase']] = (min(first, start), max(last, end), count + 1)
+            else:
+                bounds[entry['phase']] = (start, end, 1)
+        spans = {}
+        for phase, (first, last, count) in bounds.items():
+            spans[phase] = {'span_ms': last - first, 'count': count}
+        return spans
+
+    @staticmethod
+    def percentile(sorted_values, p):
+        if len(sorted_values) == 0:
+            return None
+        k = (len(sorted_values) - 1) * (p / 100.0)
+        lower = int(k)
+        upper = min(lower + 1, len(sorted_values) - 1)
+        return int(round(sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)))
+
+    def get_percentiles(self, runs):
+        values = {}
+        for run in runs:
+            for phase, span in run.get('phases', {}).items():
+                values.setdefault(phase, []).append(span)
+        result = {}
+        for phase, spans in values.items():
+            spans.sort()
+            stats = {'runs': len(spans), 'max': spans[-1]}
+            for p in PhaseProfiler.Percentiles:
+                stats['p' + str(p)] = PhaseProfiler.percentile(spans, p)
+            result[phase] = stats
+        return result
+
+    def load_history(self):
+        history_file = os.path.join(self.state_dir, PhaseProfiler.HistoryFileName)
+        try:
+            if os.path.exists(history_file):
+                with open(history_file, 'r') as f:
+                    history = json.load(f)
+                runs = history.get('runs', [])
+                if isinstance(runs, list):
+                    return runs
+        except Exception:
+            self.log("phase history unreadable, starting a new one: " + traceback.format_exc(), 'Warning')
+        return []
+
+    def write_json(self, file_name, obj):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        target = os.path.join(self.state_dir, file_name)
+        fd, temp_file = tempfile.mkstemp(prefix = '.' + file_name + '.', dir = self.state_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(obj, f)
+            os.rename(temp_file, target)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    def finish_run(self, result = None):
+        """
+        Writes this run's timeline, appends it to the rolling history and returns
+        (timeline document, percentiles across the history including this run).
+        """
+        timeline = self.get_timeline()
+        spans = self.get_phase_spans(timeline)
+        document = {'run_id': self.run_id, 'start_utc': self.run_start_utc, 'result': result, 'total_ms': self.to_ms(monotonic()), 'phases': spans, 'timeline': timeline}
+        runs = self.load_history()
+        runs.append({'run_id': self.run_id, 'start_utc': self.run_start_utc, 'result': result, 'phases': dict((phase, span['span_ms']) for phase, span in spans.items())})
+        runs = runs[-self.max_history_runs:]
+        percentiles = self.get_percentiles(runs)
+        try:
+            self.write_json(PhaseProfiler.TimelineFileName, document)
+            self.write_json(PhaseProfiler.HistoryFileName, {'version': 1, 'runs': runs})
+        except Exception:
+            self.log("failed to persist phase timeline: " + traceback.format_exc(), 'Warning')
+        return document, percentiles
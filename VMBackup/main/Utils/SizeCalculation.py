@@ -12,8 +12,14 @@ except ImportError:
 import base64
 import json
 import tempfile
+import threading
 import time
+try:
+    import Queue as Queue
+except ImportError:
+    import queue as Queue
 from Utils.DiskUtil import DiskUtil
+from Utils.MountIndex import MountIndex
 from Utils.ResourceDiskUtil import ResourceDiskUtil
 import Utils.HandlerUtil
 import traceback
@@ -22,6 +28,12 @@ import shlex
 from common import CommonVariables
 
 class SizeCalculation(object):
+    # statvfs results shared by every SizeCalculation in the process, keyed by the settings that change the total
+    statvfs_cache = {}
+    statvfs_cache_lock = threading.Lock()
+    remote_file_systems = ['cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', 'coda', 'ceph', 'glusterfs', 'fuse.glusterfs', 'lustre', '9p', 'fuse.sshfs', 'gpfs', 'ocfs2']
+    # never statvfs'd: df skips them and autofs would trigger the automount
+    pseudo_file_systems = set(['autofs', 'proc', 'sysfs', 'cgroup', 'cgroup2', 'devpts', 'securityfs', 'pstore', 'debugfs', 'tracefs', 'configfs', 'mqueue', 'hugetlbfs', 'binfmt_misc', 'fusectl', 'bpf', 'rpc_pipefs', 'nsfs', 'selinuxfs', 'efivarfs', 'rootfs'])
 
     def __init__(self,patching, hutil, logger,para_parser):
         self.patching=patching
@@ -72,17 +84,172 @@ class SizeCalculation(object):
         return devices_to_bill
 
     def get_total_used_size(self):
+        engine = self.hutil.get_strvalue_from_configfile(CommonVariables.sizeCalculationEngine, CommonVariables.sizeCalculationEngineStatvfs)
+        if str(engine).lower() == CommonVariables.sizeCalculationEngineStatvfs:
+            try:
+                result = self.get_total_used_size_statvfs()
+                if result is not None:
+                    Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("sizeCalcEngine", CommonVariables.sizeCalculationEngineStatvfs)
+                    return result
+            except Exception as e:
+                errMsg = 'statvfs size calculation failed, falling back to df, error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+                self.logger.log(errMsg, True, 'Warning')
+        Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("sizeCalcEngine", "df")
+        return self.get_total_used_size_df()
+
+    def is_only_local_filesystems(self):
+        onlyLocalFilesystems = self.hutil.get_strvalue_from_configfile(CommonVariables.onlyLocalFilesystems, "False") 
+        self.logger.log("onlyLocalFilesystems : {0}".format(str(onlyLocalFilesystems)))
+        return onlyLocalFilesystems in ['True', 'true']
+
+    def is_remote_mount(self, entry):
+        # same notion of "remote" as df -l
+        fstype = str(entry.fstype).lower()
+        source = str(entry.source)
+        if fstype.startswith('nfs') or fstype in self.remote_file_systems:
+            return True
+        return ':' in source or source.startswith('//') or source.startswith('\\\\')
+
+    def get_mounts_for_size_calculation(self, mount_index, only_local):
+        """
+        Mounts that df would list: visible, not a pseudo filesystem, one per device.
+        """
+        chosen = {}
+        order = []
+        for entry in mount_index.get_visible_mounts():
+            if entry.fstype in self.pseudo_file_systems:
+                continue
+            if only_local and self.is_remote_mount(entry):
+                continue
+            current = chosen.get(entry.major_minor)
+            if current is None:
+                order.append(entry.major_minor)
+                chosen[entry.major_minor] = entry
+            elif current.root != '/' and entry.root == '/':
+                chosen[entry.major_minor] = entry
+        return [chosen[major_minor] for major_minor in order]
+
+    def statvfs_mounts(self, entries, timeout, concurrency):
+        """
+        Runs os.statvfs on every mount from a small set of daemon threads.
+        A mount that does not answer within timeout seconds is given up on and its
+        slot handed to the next mount, so a hung network share costs at most one timeout.
+        Returns the df style rows, the per mount timings in ms and the timed out entries.
+        """
+        results = Queue.Queue()
+        pending = list(range(len(entries)))
+        pending.reverse()
+        running = {}
+        rows = []
+        timings = []
+        timed_out = []
+
+        def worker(idx, mount_point):
+            start = time.time()
+            try:
+                st = os.statvfs(mount_point)
+                results.put((idx, st, None, time.time() - start))
+            except Exception as e:
+                results.put((idx, None, e, time.time() - start))
+
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < concurrency:
+                idx = pending.pop()
+                thread = threading.Thread(target=worker, args=(idx, entries[idx].mount_point))
+                thread.daemon = True
+                running[idx] = time.time()
+                thread.start()
+            wait_time = min(running.values()) + timeout - time.time()
+            try:
+                idx, st, error, elapsed = results.get(True, max(wait_time, 0.001))
+            except Queue.Empty:
+                now = time.time()
+                for idx, started in list(running.items()):
+                    if now - started >= timeout:
+                        del running[idx]
+                        timed_out.append(entries[idx])
+                        self.logger.log("statvfs timed out after {0} seconds, mount point : {1} device : {2} fstype : {3}".format(timeout, entries[idx].mount_point, entries[idx].source, entries[idx].fstype), True, 'Warning')
+                continue
+            if idx not in running:
+                # the answer came in after the mount was given up on
+                continue
+            del running[idx]
+            entry = entries[idx]
+            elapsed_ms = int(elapsed * 1000)
+            timings.append((elapsed_ms, entry.mount_point))
+            if error is not None:
+                self.logger.log("statvfs failed for mount point : {0} error : {1}".format(entry.mount_point, str(error)), True, 'Warning')
+                continue
+            self.logger.log("statvfs mount point : {0} device : {1} took {2} ms".format(entry.mount_point, entry.source, elapsed_ms), True)
+            if st.f_blocks == 0:
+                # df hides filesystems without blocks as well
+                continue
+            size = st.f_blocks * st.f_frsize // 1024
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize // 1024
+            available = st.f_bavail * st.f_frsize // 1024
+            rows.append((idx, entry.source, size, used, available, entry.mount_point, entry.fstype))
+        # report in mount table order, independent of which statvfs finished first
+        rows.sort()
+        return [row[1:] for row in rows], timings, timed_out
+
+    def get_total_used_size_statvfs(self):
+        """
+        Computes the same totals as the df engine from os.statvfs over the mount index.
+        Returns None when the mount index is not available on this system.
+        """
+        only_local = self.is_only_local_filesystems()
+        cache_ttl = self.hutil.get_intvalue_from_configfile(CommonVariables.sizeCalculationCacheTTL, CommonVariables.sizeCalculationCacheTTLDefault)
+        cache_key = (only_local, self.isOnlyOSDiskBackupEnabled)
+        with SizeCalculation.statvfs_cache_lock:
+            cached = SizeCalculation.statvfs_cache.get(cache_key)
+        if cached is not None and time.time() - cached[0] < cache_ttl:
+            self.logger.log("Using cached size calculation result computed {0} seconds ago".format(int(time.time() - cached[0])), True)
+            return cached[1]
+
+        mount_index = MountIndex.get_instance(self.logger)
+        if not mount_index.refresh():
+            return None
+        timeout = self.hutil.get_intvalue_from_configfile(CommonVariables.sizeCalculationMountTimeout, CommonVariables.sizeCalculationMountTimeoutDefault)
+        concurrency = self.hutil.get_intvalue_from_configfile(CommonVariables.sizeCalculationConcurrency, CommonVariables.sizeCalculationConcurrencyDefault)
+        entries = self.get_mounts_for_size_calculation(mount_index, only_local)
+        start = time.time()
+        rows, timings, timed_out = self.statvfs_mounts(entries, max(timeout, 1), max(concurrency, 1))
+        elapsed_ms = int((time.time() - start) * 1000)
+        self.logger.log("statvfs over {0} mounts took {1} ms".format(len(entries), elapsed_ms), True)
+        Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("sizeCalcTimeMs", str(elapsed_ms))
+        timings.sort(reverse=True)
+        if len(timings) > 0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("sizeCalcSlowestMounts", str(timings[:3]))
+
+        disk_loop_devices_file_systems = [entry.source for entry in mount_index.get_visible_mounts() if 'loop' in str(entry.source)]
         try:
-            size_calc_failed = False
+            device_list = ["/dev/{0}".format(name) for name in os.listdir(MountIndex.sys_block_dir) if name.startswith("sd")]
+        except OSError:
+            device_list = self.device_list_for_billing()
+        total_used = self.compute_total_used_size(rows, disk_loop_devices_file_systems, device_list)
+        size_calc_failed = False
+
+        if len(timed_out) > 0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("sizeCalcTimedOutMounts", str([entry.mount_point for entry in timed_out]))
+            # a local filesystem that did not answer would be missing from the billed size
+            for entry in timed_out:
+                if not self.is_remote_mount(entry):
+                    size_calc_failed = True
+        result = (total_used, size_calc_failed)
+        if not size_calc_failed:
+            with SizeCalculation.statvfs_cache_lock:
+                SizeCalculation.statvfs_cache[cache_key] = (time.time(), result)
+        return result
 
-            onlyLocalFilesystems = self.hutil.get_strvalue_from_configfile(CommonVariables.onlyLocalFilesystems, "False") 
+    def get_total_used_size_df(self):
+        try:
+            size_calc_failed = False
 
-            if onlyLocalFilesystems in ['True', 'true']:  
+            if self.is_only_local_filesystems():
                 df = subprocess.Popen(["df" , "-kl"], stdout=subprocess.PIPE)
             else:
                 df = subprocess.Popen(["df" , "-k"], stdout=subprocess.PIPE)
 
-            self.logger.log("onlyLocalFilesystems : {0}".format(str(onlyLocalFilesystems)))
             '''
             Sample output of the df command
 
@@ -121,28 +288,11 @@ class SizeCalculation(object):
             output = output.strip().split("\n")
             disk_loop_devices_file_systems = self.get_loop_devices()
             self.logger.log("outside loop device", True)
-            total_used = 0
-            total_used_network_shares = 0
-            total_used_gluster = 0
-            total_used_loop_device=0
-            total_used_temporary_disks = 0 
-            total_used_ram_disks = 0
-            total_used_unknown_fs = 0
-            actual_temp_disk_used = 0
-            total_sd_size=0
-            network_fs_types = []
-            unknown_fs_types = []
-      
-            if len(self.file_systems_info) == 0 :
-                self.file_systems_info = disk_util.get_mount_file_systems()
+            device_list=self.device_list_for_billing() #new logic: calculate the disk size for billing
 
+            rows = []
             output_length = len(output)
             index = 1
-            self.resource_disk= ResourceDiskUtil(patching = self.patching, logger = self.logger)
-            resource_disk_device= self.resource_disk.get_resource_disk_mount_point(0)
-            resource_disk_device= "/dev/{0}".format(resource_disk_device)
-            device_list=self.device_list_for_billing() #new logic: calculate the disk size for billing
-
             while index < output_length:
                 if(len(Utils.HandlerUtil.HandlerUtility.split(self.logger, output[index])) < 6 ): #when a row is divided in 2 lines
                     index = index+1
@@ -150,109 +300,134 @@ class SizeCalculation(object):
                         output[index] = output[index-1] + output[index]
                     else:
                         self.logger.log("Output of df command is not in desired format",True)
-                        total_used = 0
                         size_calc_failed = True
                         break
                 device, size, used, available, percent, mountpoint =Utils.HandlerUtil.HandlerUtility.split(self.logger, output[index])
-                fstype = ''
-                isNetworkFs = False
-                isKnownFs = False
+                rows.append((device, size, used, available, mountpoint, None))
+                index = index + 1
+
+            total_used = self.compute_total_used_size(rows, disk_loop_devices_file_systems, device_list)
+            if size_calc_failed:
+                total_used = 0
+            return total_used, size_calc_failed
+        except Exception as e:
+            errMsg = 'Unable to fetch total used space with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg,True)
+            size_calc_failed = True
+            return 0,size_calc_failed
+
+    def compute_total_used_size(self, rows, disk_loop_devices_file_systems, device_list):
+        """
+        Classifies df style rows (device, size, used, available, mountpoint, fstype) and returns the billed size in bytes.
+        """
+        total_used = 0
+        total_used_network_shares = 0
+        total_used_gluster = 0
+        total_used_loop_device=0
+        total_used_temporary_disks = 0 
+        total_used_ram_disks = 0
+        total_used_unknown_fs = 0
+        actual_temp_disk_used = 0
+        total_sd_size=0
+        network_fs_types = []
+        unknown_fs_types = []
 
+        self.resource_disk= ResourceDiskUtil(patching = self.patching, logger = self.logger)
+        resource_disk_device= self.resource_disk.get_resource_disk_mount_point(0)
+        resource_disk_device= "/dev/{0}".format(resource_disk_device)
 
+        for device, size, used, available, mountpoint, fstype in rows:
+            if fstype is None:
+                fstype = ''
                 for file_system_info in self.file_systems_info:
                     if device == file_system_info[0] and mountpoint == file_system_info[2]:
                         fstype = file_system_info[1]
-                self.logger.log("Device name : {0} fstype : {1} size : {2} used space in KB : {3} available space : {4} mountpoint : {5}".format(device,fstype,size,used,available,mountpoint),True)
+            isNetworkFs = False
+            isKnownFs = False
+            self.logger.log("Device name : {0} fstype : {1} size : {2} used space in KB : {3} available space : {4} mountpoint : {5}".format(device,fstype,size,used,available,mountpoint),True)
 
-                for nonPhysicaFsType in self.non_physical_file_systems:
-                    if nonPhysicaFsType in fstype.lower():
-                        isNetworkFs = True
-                        break
+            for nonPhysicaFsType in self.non_physical_file_systems:
+                if nonPhysicaFsType in fstype.lower():
+                    isNetworkFs = True
+                    break
 
-                for knownFs in self.known_fs:
-                    if knownFs in fstype.lower():
-                        isKnownFs = True
-                        break
+            for knownFs in self.known_fs:
+                if knownFs in fstype.lower():
+                    isKnownFs = True
+                    break
 
-                if device == resource_disk_device and self.isOnlyOSDiskBackupEnabled == False : # adding log to check difference in billing of temp disk
-                    self.logger.log("Actual temporary disk, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    actual_temp_disk_used= int(used)
-                
-                if device in device_list and device != resource_disk_device :
-                    self.logger.log("Adding sd* partition, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    total_sd_size = total_sd_size + int(used) #calcutale total sd* size just skip temp disk
+            if device == resource_disk_device and self.isOnlyOSDiskBackupEnabled == False : # adding log to check difference in billing of temp disk
+                self.logger.log("Actual temporary disk, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                actual_temp_disk_used= int(used)
+            
+            if device in device_list and device != resource_disk_device :
+                self.logger.log("Adding sd* partition, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                total_sd_size = total_sd_size + int(used) #calcutale total sd* size just skip temp disk
 
-                if not (isKnownFs or fstype == '' or fstype == None):
-                    unknown_fs_types.append(fstype)
+            if not (isKnownFs or fstype == '' or fstype == None):
+                unknown_fs_types.append(fstype)
 
-                if isNetworkFs :
-                    if fstype not in network_fs_types :
-                        network_fs_types.append(fstype)
-                    self.logger.log("Not Adding network-drive, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    total_used_network_shares = total_used_network_shares + int(used)
+            if isNetworkFs :
+                if fstype not in network_fs_types :
+                    network_fs_types.append(fstype)
+                self.logger.log("Not Adding network-drive, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                total_used_network_shares = total_used_network_shares + int(used)
 
-                elif device == "/dev/sdb1"  and self.isOnlyOSDiskBackupEnabled == False : #<todo> in some cases root is mounted on /dev/sdb1
-                    self.logger.log("Not Adding temporary disk, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    total_used_temporary_disks = total_used_temporary_disks + int(used)
+            elif device == "/dev/sdb1"  and self.isOnlyOSDiskBackupEnabled == False : #<todo> in some cases root is mounted on /dev/sdb1
+                self.logger.log("Not Adding temporary disk, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                total_used_temporary_disks = total_used_temporary_disks + int(used)
 
-                elif "tmpfs" in fstype.lower() or "devtmpfs" in fstype.lower() or "ramdiskfs" in fstype.lower() or "rootfs" in fstype.lower():
-                    self.logger.log("Not Adding RAM disks, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    total_used_ram_disks = total_used_ram_disks + int(used)
+            elif "tmpfs" in fstype.lower() or "devtmpfs" in fstype.lower() or "ramdiskfs" in fstype.lower() or "rootfs" in fstype.lower():
+                self.logger.log("Not Adding RAM disks, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                total_used_ram_disks = total_used_ram_disks + int(used)
 
-                elif 'loop' in device and device not in disk_loop_devices_file_systems:
-                    self.logger.log("Not Adding Loop Device , Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    total_used_loop_device = total_used_loop_device + int(used)
+            elif 'loop' in device and device not in disk_loop_devices_file_systems:
+                self.logger.log("Not Adding Loop Device , Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                total_used_loop_device = total_used_loop_device + int(used)
 
-                elif (mountpoint.startswith('/run/gluster/snaps/')):
-                    self.logger.log("Not Adding Gluster Device , Device name : {0} used space in KB : {1} mount point : {2}".format(device,used,mountpoint),True)
-                    total_used_gluster = total_used_gluster + int(used)
+            elif (mountpoint.startswith('/run/gluster/snaps/')):
+                self.logger.log("Not Adding Gluster Device , Device name : {0} used space in KB : {1} mount point : {2}".format(device,used,mountpoint),True)
+                total_used_gluster = total_used_gluster + int(used)
 
-                elif device.startswith( '\\\\' ) or device.startswith( '//' ):
-                    self.logger.log("Not Adding network-drive as it starts with slahes, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
-                    total_used_network_shares = total_used_network_shares + int(used)
+            elif device.startswith( '\\\\' ) or device.startswith( '//' ):
+                self.logger.log("Not Adding network-drive as it starts with slahes, Device name : {0} used space in KB : {1} fstype : {2}".format(device,used,fstype),True)
+                total_used_network_shares = total_used_network_shares + int(used)
 
+            else:
+                if(self.isOnlyOSDiskBackupEnabled == True):
+                    if(mountpoint == '/'):
+                        total_used = total_used + int(used)
+                        self.logger.log("Adding only root device to size calculation. Device name : {0} used space in KB : {1} mount point : {2} fstype : {3}".format(device,used,mountpoint,fstype),True)
+                        self.logger.log("Total Used Space: {0}".format(total_used),True)
                 else:
-                    if(self.isOnlyOSDiskBackupEnabled == True):
-                        if(mountpoint == '/'):
-                            total_used = total_used + int(used)
-                            self.logger.log("Adding only root device to size calculation. Device name : {0} used space in KB : {1} mount point : {2} fstype : {3}".format(device,used,mountpoint,fstype),True)
-                            self.logger.log("Total Used Space: {0}".format(total_used),True)
-                    else:
-                        self.logger.log("Adding Device name : {0} used space in KB : {1} mount point : {2} fstype : {3}".format(device,used,mountpoint,fstype),True)
-                        total_used = total_used + int(used) #return in KB
-                    if not (isKnownFs or fstype == '' or fstype == None):
-                        total_used_unknown_fs = total_used_unknown_fs + int(used)
+                    self.logger.log("Adding Device name : {0} used space in KB : {1} mount point : {2} fstype : {3}".format(device,used,mountpoint,fstype),True)
+                    total_used = total_used + int(used) #return in KB
+                if not (isKnownFs or fstype == '' or fstype == None):
+                    total_used_unknown_fs = total_used_unknown_fs + int(used)
 
-                index = index + 1
-                
-            if not len(unknown_fs_types) == 0:
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("unknownFSTypeInDf",str(unknown_fs_types))
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("totalUsedunknownFS",str(total_used_unknown_fs))
-                self.logger.log("Total used space in Bytes of unknown FSTypes : {0}".format(total_used_unknown_fs * 1024),True)
-
-            if total_used_temporary_disks != actual_temp_disk_used :
-                self.logger.log("Billing differenct because of incorrect temp disk: {0}".format(str(total_used_temporary_disks - actual_temp_disk_used)))
-
-            if not len(network_fs_types) == 0:
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("networkFSTypeInDf",str(network_fs_types))
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("totalUsedNetworkShare",str(total_used_network_shares))
-                self.logger.log("Total used space in Bytes of network shares : {0}".format(total_used_network_shares * 1024),True)
-            if total_used_gluster !=0 :
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("glusterFSSize",str(total_used_gluster))
-            if total_used_temporary_disks !=0:
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("tempDisksSize",str(total_used_temporary_disks))
-            if total_used_ram_disks != 0:
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("ramDisksSize",str(total_used_ram_disks))
-            if total_used_loop_device != 0 :
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("loopDevicesSize",str(total_used_loop_device))
-            self.logger.log("Total used space in Bytes : {0}".format(total_used * 1024),True)
-            if total_sd_size != 0 :
-                Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("totalsdSize",str(total_sd_size))
-            self.logger.log("Total sd* used space in Bytes : {0}".format(total_sd_size * 1024),True)
-
-            return total_used * 1024, size_calc_failed #Converting into Bytes
-        except Exception as e:
-            errMsg = 'Unable to fetch total used space with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
-            self.logger.log(errMsg,True)
-            size_calc_failed = True
-            return 0,size_calc_failed
+        if not len(unknown_fs_types) == 0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("unknownFSTypeInDf",str(unknown_fs_types))
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("totalUsedunknownFS",str(total_used_unknown_fs))
+            self.logger.log("Total used space in Bytes of unknown FSTypes : {0}".format(total_used_unknown_fs * 1024),True)
+
+        if total_used_temporary_disks != actual_temp_disk_used :
+            self.logger.log("Billing differenct because of incorrect temp disk: {0}".format(str(total_used_temporary_disks - actual_temp_disk_used)))
+
+        if not len(network_fs_types) == 0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("networkFSTypeInDf",str(network_fs_types))
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("totalUsedNetworkShare",str(total_used_network_shares))
+            self.logger.log("Total used space in Bytes of network shares : {0}".format(total_used_network_shares * 1024),True)
+        if total_used_gluster !=0 :
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("glusterFSSize",str(total_used_gluster))
+        if total_used_temporary_disks !=0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("tempDisksSize",str(total_used_temporary_disks))
+        if total_used_ram_disks != 0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("ramDisksSize",str(total_used_ram_disks))
+        if total_used_loop_device != 0 :
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("loopDevicesSize",str(total_used_loop_device))
+        self.logger.log("Total used space in Bytes : {0}".format(total_used * 1024),True)
+        if total_sd_size != 0 :
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("totalsdSize",str(total_sd_size))
+        self.logger.log("Total sd* used space in Bytes : {0}".format(total_sd_size * 1024),True)
+
+        return total_used * 1024 #Converting into Bytes
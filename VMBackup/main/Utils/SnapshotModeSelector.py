@@ -0,0 +1,200 @@
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+import traceback
+
+class SnapshotModeSelector(object):
+    """
+    Picks the guest snapshot strategy (seq, thread or process) and the thread count for
+    the next run from the latency of the previous runs, kept in a small history file.
+    A mode whose last run failed or had a slow queue setup is avoided, but every
+    probe_interval runs the other mode is tried again so one bad run is not permanent.
+    """
+    __instance__ = None
+    default_history_file = '/etc/azure/SnapshotModeHistory.json'
+    SeqMode = 'seq'
+    MaxHistoryRuns = 20
+    ProbeIntervalDefault = 10
+    SlowQueueSetupSeconds = 10
+    MinConcurrency = 2
+
+    def __init__(self, logger, history_file = default_history_file):
+        self.logger = logger
+        self.history_file = history_file
+        self.lock = threading.Lock()
+        self.runs = []
+        self.run_count = 0
+        self.concurrency = None
+        self.loaded = False
+
+    @staticmethod
+    def get_instance(logger, history_file = default_history_file):
+        if SnapshotModeSelector.__instance__ is None or SnapshotModeSelector.__instance__.history_file != history_file:
+            SnapshotModeSelector.__instance__ = SnapshotModeSelector(logger, history_file)
+        SnapshotModeSelector.__instance__.logger = logger
+        return SnapshotModeSelector.__instance__
+
+    def log(self, msg, level = 'Info'):
+        if self.logger is not None:
+            self.logger.log(msg, True, level)
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            if os.path.exists(self.history_file):
+                with open(self.history_file, 'r') as f:
+                    history = json.load(f)
+                self.runs = history.get('runs', [])[-SnapshotModeSelector.MaxHistoryRuns:]
+                self.run_count = int(history.get('run_count', len(self.runs)))
+                self.concurrency = history.get('concurrency')
+        except Exception:
+            self.log("snapshot mode history unreadable, starting a new one: " + traceback.format_exc(), 'Warning')
+            self.runs = []
+            self.run_count = 0
+            self.concurrency = None
+
+    def save(self):
+        history_dir = os.path.dirname(self.history_file)
+        temp_file = None
+        try:
+            if not os.path.isdir(history_dir):
+                os.makedirs(history_dir)
+            fd, temp_file = tempfile.mkstemp(prefix = '.' + os.path.basename(self.history_file) + '.', dir = history_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': 1, 'run_count': self.run_count, 'concurrency': self.concurrency, 'runs': self.runs}, f)
+            os.rename(temp_file, self.history_file)
+        except Exception:
+            self.log("failed to save snapshot mode history: " + traceback.format_exc(), 'Warning')
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    @staticmethod
+    def rounds(blob_count, concurrency):
+        concurrency = max(int(concurrency or 1), 1)
+        return max((blob_count + concurrency - 1) // concurrency, 1)
+
+    @staticmethod
+    def median(values):
+        values = sorted(values)
+        if len(values) == 0:
+            return None
+        middle = len(values) // 2
+        if len(values) % 2 == 1:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+    def get_mode_runs(self, mode):
+        return [run for run in self.runs if run.get('mode') == mode]
+
+    def is_penalized(self, mode):
+        runs = self.get_mode_runs(mode)
+        if len(runs) == 0:
+            return False
+        last = runs[-1]
+        if not last.get('succeeded', True):
+            return True
+        queue_setup_ms = last.get('queue_setup_ms')
+        return queue_setup_ms is not None and queue_setup_ms >= SnapshotModeSelector.SlowQueueSetupSeconds * 1000
+
+    def estimate_ms(self, mode, blob_count, concurrency):
+        """
+        Expected snapshot window for blob_count blobs, scaling the recent runs of the mode by
+        the number of rounds of HTTP calls they needed. None when the mode has no usable history.
+        """
+        per_round = []
+        for run in self.get_mode_runs(mode):
+            if not run.get('succeeded', True):
+                continue
+            run_concurrency = 1 if mode == SnapshotModeSelector.SeqMode else run.get('concurrency')
+            per_round.append(float(run['elapsed_ms']) / SnapshotModeSelector.rounds(run['blob_count'], run_concurrency))
+        estimate = SnapshotModeSelector.median(per_round)
+        if estimate is None:
+            return None
+        if mode == SnapshotModeSelector.SeqMode:
+            concurrency = 1
+        return estimate * SnapshotModeSelector.rounds(blob_count, concurrency)
+
+    def choose(self, blob_count, parallel_mode, max_concurrency, probe_interval = ProbeIntervalDefault, legacy_seq = False):
+        """
+        Returns (mode, concurrency, reason) for a run over blob_count blobs.
+        parallel_mode is the configured parallel strategy, 'thread' or 'process'.
+        """
+        with self.lock:
+            self.load()
+            if self.concurrency is None:
+                self.concurrency = max_concurrency
+            concurrency = max(min(int(self.concurrency), max_concurrency), 1)
+            seq_estimate = self.estimate_ms(SnapshotModeSelector.SeqMode, blob_count, 1)
+            parallel_estimate = self.estimate_ms(parallel_mode, blob_count, concurrency)
+
+            if self.is_penalized(parallel_mode):
+                preferred, reason = SnapshotModeSelector.SeqMode, 'last ' + parallel_mode + ' run failed or was slow to set up'
+            elif self.is_penalized(SnapshotModeSelector.SeqMode):
+                preferred, reason = parallel_mode, 'last seq run failed'
+            elif seq_estimate is not None and parallel_estimate is not None:
+                if seq_estimate < parallel_estimate:
+                    preferred = SnapshotModeSelector.SeqMode
+                else:
+                    preferred = parallel_mode
+                reason = 'estimated seq ' + str(int(seq_estimate)) + ' ms, ' + parallel_mode + ' ' + str(int(parallel_estimate)) + ' ms'
+            elif parallel_estimate is None and legacy_seq:
+                # the sticky seqsnapshot=1 of earlier versions only seeds the choice until a probe measures parallel
+                preferred, reason = SnapshotModeSelector.SeqMode, 'seqsnapshot set by an earlier version'
+            else:
+                preferred, reason = parallel_mode, 'default'
+
+            mode = preferred
+            if probe_interval > 0 and (self.run_count + 1) % probe_interval == 0:
+                mode = parallel_mode if preferred == SnapshotModeSelector.SeqMode else SnapshotModeSelector.SeqMode
+                reason = 'probe, preferred ' + preferred + ' (' + reason + ')'
+            if mode == SnapshotModeSelector.SeqMode:
+                concurrency = 1
+            self.log("snapshot mode selected: " + mode + ", concurrency: " + str(concurrency) + ", reason: " + reason)
+            return mode, concurrency, reason
+
+    def record(self, mode, concurrency, blob_count, elapsed_ms, succeeded, blob_latencies_ms = None, queue_setup_ms = None, freeze_ms = None, any_blob_failed = False, max_concurrency = None):
+        with self.lock:
+            self.load()
+            run = {'time': int(time.time()), 'mode': mode, 'concurrency': concurrency, 'blob_count': blob_count, 'elapsed_ms': int(elapsed_ms), 'succeeded': bool(succeeded)}
+            if blob_latencies_ms:
+                latencies = sorted(blob_latencies_ms)
+                run['blob_p50_ms'] = int(SnapshotModeSelector.median(latencies))
+                run['blob_max_ms'] = int(latencies[-1])
+            if queue_setup_ms is not None:
+                run['queue_setup_ms'] = int(queue_setup_ms)
+            if freeze_ms is not None:
+                run['freeze_ms'] = int(freeze_ms)
+            self.runs.append(run)
+            self.runs = self.runs[-SnapshotModeSelector.MaxHistoryRuns:]
+            self.run_count += 1
+            if mode == 'thread':
+                # additive increase, multiplicative decrease on blob failures such as throttling
+                if max_concurrency is None:
+                    max_concurrency = concurrency
+                if any_blob_failed or not succeeded:
+                    self.concurrency = max(SnapshotModeSelector.MinConcurrency, int(concurrency) // 2)
+                else:
+                    self.concurrency = min(int(concurrency) + 2, max_concurrency)
+            self.save()
+            self.log("snapshot mode run recorded: " + json.dumps(run))
+            return run
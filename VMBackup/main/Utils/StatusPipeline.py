@@ -0,0 +1,238 @@
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import os.path
+import re
+import tempfile
+import threading
+import time
+import traceback
+
+class TelemetryRecord(object):
+    """
+    One telemetry value with the type it was reported with, stored in the journal as a
+    compact json array [time, key, type, value].
+    """
+    Types = {'str': str, 'int': int, 'float': float, 'bool': bool}
+
+    def __init__(self, key, value, timestamp = None):
+        self.key = key
+        self.type = type(value).__name__
+        if self.type not in TelemetryRecord.Types:
+            self.type = 'str'
+            try:
+                value = str(value)
+            except Exception:
+                # non ascii unicode on python 2, recording telemetry must never fail its caller
+                value = repr(value)
+        self.value = value
+        self.time = round(time.time(), 3) if timestamp is None else timestamp
+
+    def to_line(self):
+        return json.dumps([self.time, self.key, self.type, self.value], separators = (',', ':')) + '\n'
+
+    @staticmethod
+    def from_line(line):
+        timestamp, key, type_name, value = json.loads(line)
+        if type_name == 'str':
+            value = str(value)
+        elif type_name in TelemetryRecord.Types:
+            value = TelemetryRecord.Types[type_name](value)
+        return TelemetryRecord(key, value, timestamp)
+
+class TelemetryJournal(object):
+    """
+    Append-only local journal of the telemetry reported by a task, so the values survive a
+    crash of the process that collected them. record() only queues in memory because it is
+    called while the file systems are frozen; flush() appends the queued records, and is
+    called from the status report which never runs inside the freeze window.
+    A task starts with a header line; the journal is compacted to the latest value of every
+    key once it grows past MaxJournalBytes.
+    """
+    __instance__ = None
+    default_journal_file = '/etc/azure/VMBackupTelemetry.journal'
+    HeaderKey = '__task__'
+    MaxJournalBytes = 262144
+
+    def __init__(self, hutil, journal_file = default_journal_file):
+        self.hutil = hutil
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.pending = []
+        self.task_id = None
+
+    @staticmethod
+    def get_instance(hutil = None, journal_file = default_journal_file):
+        if TelemetryJournal.__instance__ is None or TelemetryJournal.__instance__.journal_file != journal_file:
+            TelemetryJournal.__instance__ = TelemetryJournal(hutil, journal_file)
+        elif hutil is not None:
+            TelemetryJournal.__instance__.hutil = hutil
+        return TelemetryJournal.__instance__
+
+    def log(self, msg, level = 'Info'):
+        if self.hutil is not None:
+            self.hutil.log(msg, level)
+
+    def record(self, key, value):
+        with self.lock:
+            self.pending.append(TelemetryRecord(key, value))
+
+    def read_records(self):
+        records = []
+        if not os.path.exists(self.journal_file):
+            return records
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(TelemetryRecord.from_line(line))
+                except Exception:
+                    # a torn last line from a crash mid append
+                    continue
+        return records
+
+    def replay(self, task_id):
+        """
+        Latest value of every key journaled for task_id, in the order the keys were first reported.
+        """
+        values = {}
+        order = []
+        current_task = None
+        try:
+            for record in self.read_records():
+                if record.key == TelemetryJournal.HeaderKey:
+                    current_task = record.value
+                    continue
+                if current_task != str(task_id):
+                    continue
+                if record.key not in values:
+                    order.append(record.key)
+                values[record.key] = record.value
+        except Exception:
+            self.log("telemetry journal unreadable: " + traceback.format_exc(), 'Warning')
+        return [(key, values[key]) for key in order]
+
+    def flush(self, task_id):
+        with self.lock:
+            records = self.pending
+            self.pending = []
+            task_id = str(task_id)
+            try:
+                journal_dir = os.path.dirname(self.journal_file)
+                if not os.path.isdir(journal_dir):
+                    os.makedirs(journal_dir)
+                if self.task_id != task_id:
+                    if self.task_id is None and self.get_last_task_id() == task_id:
+                        # an earlier process of the same task started the journal
+                        self.task_id = task_id
+                    else:
+                        self.rewrite(task_id, [])
+                if len(records) == 0:
+                    return
+                with open(self.journal_file, 'a+') as f:
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() > 0:
+                        f.seek(f.tell() - 1)
+                        if f.read(1) != '\n':
+                            # terminate a line torn by a crash so it does not swallow the next record
+                            f.write('\n')
+                    f.write(''.join(record.to_line() for record in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.path.getsize(self.journal_file) > TelemetryJournal.MaxJournalBytes:
+                    self.compact(task_id)
+            except Exception:
+                self.log("failed to append to telemetry journal: " + traceback.format_exc(), 'Warning')
+
+    def get_last_task_id(self):
+        task_id = None
+        try:
+            for record in self.read_records():
+                if record.key == TelemetryJournal.HeaderKey:
+                    task_id = record.value
+        except Exception:
+            pass
+        return task_id
+
+    def compact(self, task_id):
+        records = [TelemetryRecord(key, value) for key, value in self.replay(task_id)]
+        self.rewrite(task_id, records)
+        self.log("telemetry journal compacted to " + str(len(records)) + " records")
+
+    def rewrite(self, task_id, records):
+        journal_dir = os.path.dirname(self.journal_file)
+        fd, temp_file = tempfile.mkstemp(prefix = '.' + os.path.basename(self.journal_file) + '.', dir = journal_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(TelemetryRecord(TelemetryJournal.HeaderKey, task_id).to_line())
+                f.write(''.join(record.to_line() for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_file, self.journal_file)
+            self.task_id = task_id
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+class StatusUploader(object):
+    """
+    Skips status blob uploads that would not change the blob: a report that only differs
+    from the last uploaded one in its timestamps is dropped.
+    """
+    __instance__ = None
+    # \/Date(1617181723000)\/ timestamps are stamped on every report
+    TimestampPattern = re.compile(r'\\\\?/Date\(\d+\)\\\\?/')
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.last_fingerprints = {}
+
+    @staticmethod
+    def get_instance(logger):
+        if StatusUploader.__instance__ is None:
+            StatusUploader.__instance__ = StatusUploader(logger)
+        StatusUploader.__instance__.logger = logger
+        return StatusUploader.__instance__
+
+    def log(self, msg, level = 'Info'):
+        if self.logger is not None:
+            self.logger.log(msg, True, level)
+
+    @staticmethod
+    def fingerprint(msg):
+        content = StatusUploader.TimestampPattern.sub('', msg)
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8', 'backslashreplace')
+        return hashlib.md5(content).hexdigest()
+
+    def submit(self, msg, blob_uri, upload):
+        """
+        upload(msg, blob_uri) performs the write and returns True when it succeeded, a failed
+        upload is not remembered so the next report goes out even if unchanged. Returns True
+        when something was uploaded.
+        """
+        with self.lock:
+            fingerprint = StatusUploader.fingerprint(msg)
+            if self.last_fingerprints.get(blob_uri) == fingerprint:
+                self.log("status unchanged since the last upload, skipping")
+                return False
+            if not upload(msg, blob_uri):
+                return False
+            self.last_fingerprints[blob_uri] = fingerprint
+            return True
@@ -16,23 +16,71 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
 import os
 import string
+import threading
 import time
 import traceback
 from blobwriter import BlobWriter
 from Utils.WAAgentUtil import waagent
 import sys
 
+class LogBuffer(object):
+    """
+    Bounded buffer for the lines logged while the file systems are frozen.
+    Appends are O(1); once max_bytes is exceeded the oldest lines are evicted
+    and counted, so memory stays flat no matter how chatty the run is.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lines = collections.deque()
+        self.size = 0
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        with self.lock:
+            self.lines.append(line)
+            self.size += len(line)
+            while self.size > self.max_bytes and len(self.lines) > 1:
+                evicted = self.lines.popleft()
+                self.size -= len(evicted)
+                self.dropped_lines += 1
+                self.dropped_bytes += len(evicted)
+
+    def is_empty(self):
+        return len(self.lines) == 0 and self.dropped_lines == 0
+
+    def drain(self):
+        with self.lock:
+            parts = []
+            if self.dropped_lines > 0:
+                parts.append("================== Log buffer full, dropped " + str(self.dropped_lines) + " oldest lines (" + str(self.dropped_bytes) + " bytes) ==============\n")
+            parts.extend(self.lines)
+            self.lines.clear()
+            self.size = 0
+            self.dropped_lines = 0
+            self.dropped_bytes = 0
+            return ''.join(parts)
+
 class Backuplogger(object):
+    FreezeLogBufferBytesDefault = 4194304 # 4 MB
+
     def __init__(self, hutil):
-        self.msg = ''
         self.con_path = '/dev/console'
         self.enforced_local_flag_value = True
         self.hutil = hutil
         self.prev_log = ''
         self.logging_off = False
+        max_bytes = Backuplogger.FreezeLogBufferBytesDefault
+        try:
+            max_bytes = self.hutil.get_intvalue_from_configfile('FreezeLogBufferBytes', Backuplogger.FreezeLogBufferBytesDefault)
+        except Exception as e:
+            pass
+        self.buffer = LogBuffer(max_bytes)
 
     def enforce_local_flag(self, enforced_local):
         if (self.hutil.get_intvalue_from_configfile('LoggingOff', 0) == 1):
@@ -40,9 +88,9 @@ class Backuplogger(object):
         if (self.enforced_local_flag_value != False and enforced_local == False and self.logging_off == True):
             pass
         elif (self.enforced_local_flag_value != False and enforced_local == False):
-            self.msg = self.msg + "================== Logs during Freeze Start ==============" + "\n"
+            self.buffer.append("================== Logs during Freeze Start ==============" + "\n")
         elif (self.enforced_local_flag_value == False and enforced_local == True):
-            self.msg = self.msg + "================== Logs during Freeze End ==============" + "\n"
+            self.buffer.append("================== Logs during Freeze End ==============" + "\n")
             self.commit_to_local()
         self.enforced_local_flag_value = enforced_local
 
@@ -60,7 +108,7 @@ class Backuplogger(object):
                 if(self.enforced_local_flag_value != False):
                     self.log_to_con(log_msg)
             if(self.enforced_local_flag_value == False):
-                self.msg += log_msg
+                self.buffer.append(log_msg)
             else:
                 self.hutil.log(str(msg),level)
 
@@ -95,8 +143,7 @@ class Backuplogger(object):
     def commit(self, logbloburi):
         #commit to local file system first, then commit to the network.
         try:
-            self.hutil.log(self.msg)
-            self.msg = ''
+            self.commit_to_local()
         except Exception as e:
             pass 
         try:
@@ -105,8 +152,8 @@ class Backuplogger(object):
             self.hutil.log('commit to blob failed')
 
     def commit_to_local(self):
-        self.hutil.log(self.msg)
-        self.msg = ''
+        if not self.buffer.is_empty():
+            self.hutil.log(self.buffer.drain())
 
     def commit_to_blob(self, logbloburi):
         UploadStatusAndLog = self.hutil.get_strvalue_from_configfile('UploadStatusAndLog','True')
@@ -115,6 +162,7 @@ class Backuplogger(object):
             blobWriter = BlobWriter(self.hutil)
             # append the wala log at the end.
             try:
+                blob_parts = ["Guest Agent Version is :" + waagent.GuestAgentVersion + "\n"]
                 # distro information
                 if(self.hutil is not None and self.hutil.patching is not None and self.hutil.patching.distro_info is not None):
                     distro_str = ""
@@ -122,9 +170,10 @@ class Backuplogger(object):
                         distro_str = self.hutil.patching.distro_info[0] + " " + self.hutil.patching.distro_info[1]
                     else:
                         distro_str = self.hutil.patching.distro_info[0]
-                    self.msg = "Distro Info:" + distro_str + "\n" + self.msg
-                self.msg = "Guest Agent Version is :" + waagent.GuestAgentVersion + "\n" + self.msg
-                log_to_blob = str(self.hutil.fetch_log_message()) + "Tail of shell script log:" + str(self.hutil.get_shell_script_log())
+                    blob_parts.append("Distro Info:" + distro_str + "\n")
+                blob_parts.append(str(self.hutil.fetch_log_message()))
+                blob_parts.append("Tail of shell script log:" + str(self.hutil.get_shell_script_log()))
+                log_to_blob = ''.join(blob_parts)
             except Exception as e:
                 errMsg = 'Failed to get the waagent log with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
                 self.hutil.log(errMsg)
@@ -18,7 +18,13 @@
 
 import time
 import datetime
+import hashlib
+import threading
 import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 try:
     import urlparse
 except ImportError:
@@ -34,13 +40,27 @@ class BlobProperties():
     def __str__(self):
         return ' blobType: ' + str(self.blobType) + ' contentLength: ' + str(self.contentLength)
 
+class PageBlobState(object):
+    """
+    What this process last wrote to a page blob: its content length and an md5
+    digest for every 512-byte page, used to upload only the pages that changed.
+    """
+    def __init__(self, contentLength, digests):
+        self.contentLength = contentLength
+        self.digests = digests
+
 class BlobWriter(object):
     blobEmptyDetails = {}
+    pageBlobStates = {}
+    PAGE_SIZE_BYTES = 512
+    PAGE_UPLOAD_LIMIT_BYTES = 4194304 # 4 MB
+    BlobUploadConcurrencyDefault = 4
     """description of class"""
     def __init__(self, hutil):
         self.hutil = hutil
     """
     network call should have retry.
+    returns True when the message was written.
     """
     def WriteBlob(self,msg,blobUri):
         try:
@@ -49,6 +69,12 @@ class BlobWriter(object):
                 if (self.IsEmptyBlob(blobUri) == False):
                     raise Exception("Cannot perform write operation on a non empty blob")
                 
+                pageBlobState = BlobWriter.pageBlobStates.get(blobUri)
+                if (pageBlobState is not None):
+                    # this process wrote the page-blob before, only the changed pages need to go out
+                    blobProperties = BlobProperties("PageBlob", pageBlobState.contentLength)
+                    return self.WritePageBlob(msg, blobUri, blobProperties)
+
                 blobProperties = self.GetBlobProperties(blobUri)
                 blobType = "pageblob"
 
@@ -59,15 +85,17 @@ class BlobWriter(object):
                     # Clear Page-Blob Contents
                     self.ClearPageBlob(blobUri, blobProperties)
                     # Write to Page-Blob
-                    self.WritePageBlob(msg, blobUri, blobProperties)
+                    return self.WritePageBlob(msg, blobUri, blobProperties)
                 else:
-                    self.WriteBlockBlob(msg, blobUri)
+                    return self.WriteBlockBlob(msg, blobUri)
             else:
                 self.hutil.log("bloburi is None")
         except Exception as e:
             self.hutil.log("Failed to committing the log with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
+        return False
 
     def WriteBlockBlob(self,msg,blobUri):
+        written = False
         retry_times = 3
         while(retry_times > 0):
             try:
@@ -81,6 +109,7 @@ class BlobWriter(object):
                     result = http_util.Call(method = 'PUT', sasuri_obj = sasuri_obj, data = msg, headers = headers, fallback_to_curl = True)
                     if(result == CommonVariables.success):
                         self.hutil.log("blob written succesfully")
+                        written = True
                         retry_times = 0
                     else:
                         self.hutil.log("blob failed to write")
@@ -94,15 +123,18 @@ class BlobWriter(object):
                 self.hutil.log("Failed to committing the log with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
             self.hutil.log("retry times is " + str(retry_times))
             retry_times = retry_times - 1
+        return written
 
     def WritePageBlob(self, message, blobUri, blobProperties):
+        written = False
         if(blobUri is not None):
             retry_times = 3
+            # a failed attempt may have left any mix of old and new pages in the blob, the next one clears it and writes it all
+            needsClear = False
             while(retry_times > 0):
                 msg = message
                 try:
-                    PAGE_SIZE_BYTES = 512
-                    PAGE_UPLOAD_LIMIT_BYTES = 4194304 # 4 MB
+                    PAGE_SIZE_BYTES = BlobWriter.PAGE_SIZE_BYTES
                     STATUS_BLOB_LIMIT_BYTES = 10485760 # 10 MB
                     http_util = HttpUtil(self.hutil)
                     sasuri_obj = urlparse.urlparse(blobUri + '&comp=page')
@@ -136,37 +168,111 @@ class BlobWriter(object):
                         msg = msg[msgLen-blobContentLength:msgLen]
                         msgLen = len(msg)
                         self.hutil.log("WritePageBlob: msg length after aligning to blobContentLength:"+str(msgLen))
-                    # Write Pages
-                    result = CommonVariables.error
-                    bytes_sent = 0
-                    while (bytes_sent < msgLen):
-                        bytes_remaining = msgLen - bytes_sent
-                        pageContent = None
-                        if(bytes_remaining > PAGE_UPLOAD_LIMIT_BYTES): # more than 4 MB
-                            pageContent = msg[bytes_sent:bytes_sent+PAGE_UPLOAD_LIMIT_BYTES]
-                        else:
-                            pageContent = msg[bytes_sent:msgLen]
-                        self.hutil.log("WritePageBlob: pageContentLen:"+str(len(pageContent)))
-                        result = self.put_page_update(pageContent, blobUri, bytes_sent)
-                        if(result == CommonVariables.success):
-                            self.hutil.log("WritePageBlob: page written succesfully")
-                        else:
-                            self.hutil.log("WritePageBlob: page failed to write")
-                            break
-                        bytes_sent = bytes_sent + len(pageContent)                      
+                    # Write only the pages that changed since the last write from this process
+                    digests = self.get_page_digests(msg)
+                    if(needsClear):
+                        self.ClearPageBlob(blobUri, BlobProperties("PageBlob", blobContentLength))
+                        needsClear = False
+                    previousState = BlobWriter.pageBlobStates.get(blobUri)
+                    result = CommonVariables.success
+                    if(previousState is not None and len(previousState.digests) > len(digests)):
+                        # message shrank, clear the stale tail left by the previous write
+                        clearStart = len(digests) * PAGE_SIZE_BYTES
+                        result = self.put_page_clear(blobUri, clearStart, len(previousState.digests) * PAGE_SIZE_BYTES - clearStart)
+                        self.hutil.log("WritePageBlob: cleared stale tail from " + str(clearStart) + ", result: " + str(result))
+                    if(result == CommonVariables.success):
+                        pageRanges = self.get_changed_page_ranges(digests, previousState.digests if previousState is not None else None)
+                        self.hutil.log("WritePageBlob: uploading " + str(len(pageRanges)) + " changed page range(s) of " + str(len(digests)) + " page(s)")
+                        result = self.put_page_ranges(msg, blobUri, pageRanges)
                     if(result == CommonVariables.success):
+                        BlobWriter.pageBlobStates[blobUri] = PageBlobState(blobContentLength, digests)
                         self.hutil.log("WritePageBlob: page-blob written succesfully")
+                        written = True
                         retry_times = 0
                     else:
                         self.hutil.log("WritePageBlob: page-blob failed to write")
                         HandlerUtil.HandlerUtility.add_to_telemetery_data(CommonVariables.statusBlobUploadError, "true")
+                        needsClear = self.forget_page_blob_state(blobUri)
                 except Exception as e:
                     HandlerUtil.HandlerUtility.add_to_telemetery_data(CommonVariables.statusBlobUploadError, "true")
                     self.hutil.log("WritePageBlob: Failed to write to page-blob with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
+                    needsClear = self.forget_page_blob_state(blobUri)
                 self.hutil.log("WritePageBlob: retry times is " + str(retry_times))
                 retry_times = retry_times - 1
         else:
             self.hutil.log("WritePageBlob: bloburi is None")
+        return written
+
+    def forget_page_blob_state(self, blobUri):
+        # returns True when a state was dropped, the blob then no longer matches what was written before
+        return BlobWriter.pageBlobStates.pop(blobUri, None) is not None
+
+    def get_page_digests(self, msg):
+        digests = []
+        for offset in range(0, len(msg), BlobWriter.PAGE_SIZE_BYTES):
+            page = msg[offset:offset + BlobWriter.PAGE_SIZE_BYTES]
+            if not isinstance(page, bytes):
+                page = page.encode('utf-8', 'backslashreplace')
+            digests.append(hashlib.md5(page).digest())
+        return digests
+
+    def get_changed_page_ranges(self, digests, previousDigests):
+        # returns (offset, length) byte ranges, contiguous changed pages merged up to the 4 MB put-page limit
+        pageRanges = []
+        rangeStart = None
+        pagesPerRange = BlobWriter.PAGE_UPLOAD_LIMIT_BYTES // BlobWriter.PAGE_SIZE_BYTES
+        for pageIndex in range(len(digests)):
+            changed = previousDigests is None or pageIndex >= len(previousDigests) or previousDigests[pageIndex] != digests[pageIndex]
+            if changed and rangeStart is None:
+                rangeStart = pageIndex
+            elif changed and pageIndex - rangeStart >= pagesPerRange:
+                pageRanges.append((rangeStart * BlobWriter.PAGE_SIZE_BYTES, (pageIndex - rangeStart) * BlobWriter.PAGE_SIZE_BYTES))
+                rangeStart = pageIndex
+            elif not changed and rangeStart is not None:
+                pageRanges.append((rangeStart * BlobWriter.PAGE_SIZE_BYTES, (pageIndex - rangeStart) * BlobWriter.PAGE_SIZE_BYTES))
+                rangeStart = None
+        if rangeStart is not None:
+            pageRanges.append((rangeStart * BlobWriter.PAGE_SIZE_BYTES, (len(digests) - rangeStart) * BlobWriter.PAGE_SIZE_BYTES))
+        return pageRanges
+
+    def put_page_ranges(self, msg, blobUri, pageRanges):
+        if(len(pageRanges) == 0):
+            return CommonVariables.success
+        concurrency = self.hutil.get_intvalue_from_configfile('BlobUploadConcurrency', BlobWriter.BlobUploadConcurrencyDefault)
+        concurrency = max(1, min(concurrency, len(pageRanges)))
+        work_queue = queue.Queue()
+        for pageRange in pageRanges:
+            work_queue.put(pageRange)
+        results = []
+
+        def upload_worker():
+            while True:
+                try:
+                    offset, length = work_queue.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    result = self.put_page_update(msg[offset:offset + length], blobUri, offset)
+                except Exception as e:
+                    self.hutil.log("WritePageBlob: put page failed at offset " + str(offset) + " with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
+                    result = CommonVariables.error
+                results.append((offset, result))
+
+        if(concurrency == 1):
+            upload_worker()
+        else:
+            workers = [threading.Thread(target=upload_worker) for i in range(concurrency)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        for offset, result in results:
+            if(result != CommonVariables.success):
+                self.hutil.log("WritePageBlob: page failed to write at offset " + str(offset) + ", result: " + str(result))
+                return result
+        if(len(results) != len(pageRanges)):
+            return CommonVariables.error
+        return CommonVariables.success
 
     def ClearPageBlob(self, blobUri, blobProperties):
         if(blobUri is not None):
@@ -42,6 +42,14 @@ class CommonVariables:
     statusBlobUploadError = 'statusBlobUploadError'
     TempStatusFileName = 'tempStatusFile.status'
     onlyLocalFilesystems = 'onlyLocalFilesystems'
+    sizeCalculationEngine = 'SizeCalculationEngine'
+    sizeCalculationEngineStatvfs = 'statvfs'
+    sizeCalculationMountTimeout = 'SizeCalculationMountTimeoutInSeconds'
+    sizeCalculationMountTimeoutDefault = 5
+    sizeCalculationConcurrency = 'SizeCalculationConcurrency'
+    sizeCalculationConcurrencyDefault = 8
+    sizeCalculationCacheTTL = 'SizeCalculationCacheTTLInSeconds'
+    sizeCalculationCacheTTLDefault = 60
 
     snapshotTaskToken = 'snapshotTaskToken'
     snapshotCreator = 'snapshotCreator'
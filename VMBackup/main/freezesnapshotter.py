@@ -34,6 +34,7 @@ from common import CommonVariables
 from HttpUtil import HttpUtil
 from Utils import Status
 from Utils import HandlerUtil
+from Utils.PhaseProfiler import PhaseProfiler
 from fsfreezer import FsFreezer
 from guestsnapshotter import GuestSnapshotter
 from hostsnapshotter import HostSnapshotter
@@ -143,6 +144,8 @@ class FreezeSnapshotter(object):
 
         """ Do Not remove below HttpUtil object creation. This is to ensure HttpUtil singleton object is created before freeze."""
         http_util = HttpUtil(self.logger)
+        profiler = PhaseProfiler.get_instance(self.logger)
+        profiler.start_run(self.taskId)
 
         if(self.takeSnapshotFrom == CommonVariables.onlyGuest):
             run_result, run_status, blob_snapshot_info_array, all_failed, all_snapshots_failed, unable_to_sleep, is_inconsistent = self.takeSnapshotFromGuest()
@@ -162,12 +165,26 @@ class FreezeSnapshotter(object):
             run_result, run_status = self.updateErrorCode(blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent)
 
         snapshot_info_array = self.update_snapshotinfoarray(blob_snapshot_info_array)
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("httpPoolStats", http_util.pool.get_stats())
+        self.report_phase_timeline(profiler, run_result)
 
         if not (run_result == CommonVariables.success):
             self.hutil.SetExtErrorCode(self.extensionErrorCode)
 
         return run_result, run_status, snapshot_info_array
     
+    def report_phase_timeline(self, profiler, run_result):
+        try:
+            timeline, percentiles = profiler.finish_run(run_result)
+            self.logger.log('T:S freeze phase timeline : ' + json.dumps(timeline), True)
+            spans = dict((phase, span['span_ms']) for phase, span in timeline['phases'].items())
+            HandlerUtil.HandlerUtility.add_to_telemetery_data("freezePhaseSpansMs", json.dumps(spans, sort_keys = True))
+            p90 = dict((phase, stats['p90']) for phase, stats in percentiles.items())
+            HandlerUtil.HandlerUtility.add_to_telemetery_data("freezePhaseP90Ms", json.dumps(p90, sort_keys = True))
+            self.logger.log('T:S freeze phase percentiles across runs : ' + json.dumps(percentiles, sort_keys = True), True)
+        except Exception as e:
+            self.logger.log('Failed to report freeze phase timeline: %s, stack trace: %s' % (str(e), traceback.format_exc()), True, 'Warning')
+
     def update_snapshotinfoarray(self, blob_snapshot_info_array):
         snapshot_info_array = []
 
@@ -267,7 +284,8 @@ class FreezeSnapshotter(object):
             timeout = self.hutil.get_intvalue_from_configfile('timeout',60)
             self.logger.log('T:S freeze, timeout value ' + str(timeout))
             time_before_freeze = datetime.datetime.now()
-            freeze_result,timedout = self.freezer.freeze_safe(timeout)
+            with PhaseProfiler.get_instance().phase("freeze"):
+                freeze_result,timedout = self.freezer.freeze_safe(timeout)
             time_after_freeze = datetime.datetime.now()
             freezeTimeTaken = time_after_freeze-time_before_freeze
             self.logger.log('T:S ***** freeze, time_before_freeze=' + str(time_before_freeze) + ", time_after_freeze=" + str(time_after_freeze) + ", freezeTimeTaken=" + str(freezeTimeTaken))
@@ -341,7 +359,8 @@ class FreezeSnapshotter(object):
                 snap_shotter = GuestSnapshotter(self.logger, self.hutil)
                 self.logger.log('T:S doing snapshot now...')
                 time_before_snapshot = datetime.datetime.now()
-                snapshot_result, blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep, all_snapshots_failed = snap_shotter.snapshotall(self.para_parser, self.freezer, self.g_fsfreeze_on)
+                with PhaseProfiler.get_instance().phase("snapshot", "guest"):
+                    snapshot_result, blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep, all_snapshots_failed = snap_shotter.snapshotall(self.para_parser, self.freezer, self.g_fsfreeze_on)
                 time_after_snapshot = datetime.datetime.now()
                 snapshotTimeTaken = time_after_snapshot-time_before_snapshot
                 self.logger.log('T:S ***** takeSnapshotFromGuest, time_before_snapshot=' + str(time_before_snapshot) + ", time_after_snapshot=" + str(time_after_snapshot) + ", snapshotTimeTaken=" + str(snapshotTimeTaken))
@@ -428,7 +447,8 @@ class FreezeSnapshotter(object):
             snap_shotter = HostSnapshotter(self.logger, self.hostIp)
             self.logger.log('T:S doing snapshot now...')
             time_before_snapshot = datetime.datetime.now()
-            blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep  = snap_shotter.snapshotall(self.para_parser, self.freezer, self.g_fsfreeze_on, self.taskId)
+            with PhaseProfiler.get_instance().phase("snapshot", "host"):
+                blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep  = snap_shotter.snapshotall(self.para_parser, self.freezer, self.g_fsfreeze_on, self.taskId)
             time_after_snapshot = datetime.datetime.now()
             snapshotTimeTaken = time_after_snapshot-time_before_snapshot
             self.logger.log('T:S takeSnapshotFromHost, time_before_snapshot=' + str(time_before_snapshot) + ", time_after_snapshot=" + str(time_after_snapshot) + ", snapshotTimeTaken=" + str(snapshotTimeTaken))
@@ -30,15 +30,60 @@ import threading
 import fcntl
 from common import CommonVariables
 from Utils.ResourceDiskUtil import ResourceDiskUtil
+from Utils.PhaseProfiler import PhaseProfiler, monotonic
+from backuplogger import Backuplogger, LogBuffer
 
 def thread_for_binary(self,args):
     self.logger.log("Thread for binary is called",True)
-    time.sleep(3)
+    profiler = PhaseProfiler.get_instance()
+    with profiler.phase("safefreeze_start_delay"):
+        time.sleep(3)
     self.logger.log("Waited in thread for 3 seconds",True)
     self.logger.log("****** 1. Starting Freeze Binary ",True)
-    self.child = subprocess.Popen(args,stdout=subprocess.PIPE)
+    with profiler.phase("safefreeze_spawn"):
+        child = subprocess.Popen(args,stdout=subprocess.PIPE)
+        max_bytes = self.hutil.get_intvalue_from_configfile('FreezeLogBufferBytes', Backuplogger.FreezeLogBufferBytesDefault)
+        self.output_reader = BinaryOutputReader(child.stdout, max_bytes)
+        self.output_reader.start()
+        self.child = child
     self.logger.log("Binary subprocess Created",True)
 
+class BinaryOutputReader(object):
+    """
+    Drains the safefreeze stdout on a background thread while the binary runs, so the
+    pipe never fills up during the freeze. Lines are stamped with the time they were
+    read and kept in a bounded LogBuffer until they can be logged after thaw.
+    """
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.buffer = LogBuffer(max_bytes)
+        self.mount_open_failed = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            for line in iter(self.stream.readline, b''):
+                if sys.version_info > (3,):
+                    line = str(line, encoding='utf-8', errors="backslashreplace")
+                else:
+                    line = str(line)
+                if("Failed to open:" in line):
+                    self.mount_open_failed = True
+                self.buffer.append(str(datetime.datetime.utcnow()) + " " + line.rstrip() + "\n")
+        except Exception as e:
+            self.buffer.append(str(datetime.datetime.utcnow()) + " failed to read binary output: " + str(e) + "\n")
+        finally:
+            self.done.set()
+
+    def wait(self, timeout):
+        self.done.wait(timeout)
+        return self.done.is_set()
+
 class FreezeError(object):
     def __init__(self):
         self.errorcode = None
@@ -61,12 +106,16 @@ class FreezeHandler(object):
         # sig_handle valid values(0:nothing done,1: freezed successfully, 2:freeze failed)
         self.sig_handle = 0
         self.child= None
+        self.output_reader = None
         self.logger=logger
         self.hutil = hutil
+        # monotonic time of the freeze signal, the profiler itself must not be used in a signal handler
+        self.freeze_signal_time = None
 
     def sigusr1_handler(self,signal,frame):
         self.logger.log('freezed',False)
         self.logger.log("****** 4. Freeze Completed (Signal=1 received)",False)
+        self.freeze_signal_time = monotonic()
         self.sig_handle=1
 
     def sigchld_handler(self,signal,frame):
@@ -79,9 +128,12 @@ class FreezeHandler(object):
     def reset_signals(self):
         self.sig_handle = 0
         self.child= None
+        self.output_reader = None
+        self.freeze_signal_time = None
 
 
     def startproc(self,args):
+        wait_start = monotonic()
         binary_thread = threading.Thread(target=thread_for_binary, args=[self, args])
         binary_thread.start()
 
@@ -96,6 +148,8 @@ class FreezeHandler(object):
             else:
                 break
         self.logger.log("Binary output for signal handled: "+str(self.sig_handle))
+        wait_end = self.freeze_signal_time if self.sig_handle == 1 and self.freeze_signal_time is not None else monotonic()
+        PhaseProfiler.get_instance().record("freeze_wait", wait_start, wait_end, status = {0: 'timedout', 1: None, 2: 'failed'}.get(self.sig_handle))
         return self.sig_handle
 
     def signal_receiver(self):
@@ -103,6 +157,10 @@ class FreezeHandler(object):
         signal.signal(signal.SIGCHLD,self.sigchld_handler)
 
 class FsFreezer:
+    ThawWaitInSeconds = 30
+    OutputDrainWaitInSeconds = 5
+    ChildPollIntervalInSeconds = 0.005
+
     def __init__(self, patching, logger, hutil):
         """
         """
@@ -147,6 +205,8 @@ class FsFreezer:
         self.getLockRetry = 0
         self.maxGetLockRetry = 5
         self.safeFreezelockFile = None
+        self.freeze_completed_time = None
+        self.thaw_completed_time = None
 
     def should_skip(self, mount):
         if(self.resource_disk_mount_point is not None and mount.mount_point == self.resource_disk_mount_point):
@@ -161,6 +221,8 @@ class FsFreezer:
         error_msg=''
         timedout = False
         self.skip_freeze = True 
+        self.freeze_completed_time = None
+        self.thaw_completed_time = None
         mounts_to_skip = None
         try:
             mounts_to_skip = self.hutil.get_strvalue_from_configfile('MountsToSkip','')
@@ -200,6 +262,7 @@ class FsFreezer:
                 self.logger.enforce_local_flag(False) 
 
             start_time = datetime.datetime.utcnow()
+            lock_phase = PhaseProfiler.get_instance().begin("lock_acquire")
 
             while self.getLockRetry < self.maxGetLockRetry:
                 try:
@@ -230,6 +293,7 @@ class FsFreezer:
                 self.logger.log("Retry to aquire lock count: "+ str(self.getLockRetry),True)
 
             end_time = datetime.datetime.utcnow()
+            PhaseProfiler.get_instance().end(lock_phase, None if self.isAquireLockSucceeded else 'failed')
             self.logger.log("Wait time to aquire lock "+ str(end_time - start_time),True)
 
             # sig_handle = None
@@ -238,7 +302,9 @@ class FsFreezer:
             sig_handle=self.freeze_handler.startproc(args)
 
             self.logger.log("freeze_safe after returning from startproc : sig_handle="+str(sig_handle))
-            if(sig_handle != 1):
+            if(sig_handle == 1):
+                self.freeze_completed_time = time.time()
+            else:
                 if (self.freeze_handler.child is not None):
                     self.log_binary_output()
                 if (sig_handle == 0):
@@ -292,13 +358,12 @@ class FsFreezer:
             elif(self.freeze_handler.child.poll() is None):
                 self.logger.log("child process still running")
                 self.logger.log("****** 7. Sending Thaw Signal to Binary")
+                thaw_phase = PhaseProfiler.get_instance().begin("thaw_signal")
                 self.freeze_handler.child.send_signal(signal.SIGUSR1)
-                for i in range(0,30):
-                    if(self.freeze_handler.child.poll() is None):
-                        self.logger.log("child still running sigusr1 sent")
-                        time.sleep(1)
-                    else:
-                        break
+                if(not self.wait_for_child_exit(FsFreezer.ThawWaitInSeconds)):
+                    self.logger.log("child still running " + str(FsFreezer.ThawWaitInSeconds) + " seconds after sigusr1 sent")
+                self.thaw_completed_time = time.time()
+                PhaseProfiler.get_instance().end(thaw_phase, None if self.freeze_handler.child.poll() is not None else 'timedout')
                 self.logger.enforce_local_flag(True)
                 self.log_binary_output()
                 if(self.freeze_handler.child.returncode!=0):
@@ -323,7 +388,41 @@ class FsFreezer:
         return thaw_result, unable_to_sleep
 
 
+    def wait_for_child_exit(self, timeout):
+        """
+        Waits until the binary exits. The reader hits EOF as soon as the binary goes away,
+        so the wait wakes up on that event and then only has to reap the process.
+        """
+        child = self.freeze_handler.child
+        reader = self.freeze_handler.output_reader
+        deadline = monotonic() + timeout
+        if(reader is not None):
+            reader.wait(timeout)
+        while(child.poll() is None):
+            remaining = deadline - monotonic()
+            if(remaining <= 0):
+                return False
+            time.sleep(min(FsFreezer.ChildPollIntervalInSeconds, remaining))
+        return True
+
     def log_binary_output(self):
+        with PhaseProfiler.get_instance().phase("binary_output_drain"):
+            reader = self.freeze_handler.output_reader
+            if(reader is None):
+                self.drain_binary_output()
+                return
+            # the binary may still be running when freeze failed, only wait for the tail of its output once it exited
+            if(self.freeze_handler.child is not None and self.freeze_handler.child.poll() is not None):
+                reader.wait(FsFreezer.OutputDrainWaitInSeconds)
+            if(reader.mount_open_failed):
+                self.mount_open_failed = True
+            self.logger.log("============== Binary output traces start ================= ", True)
+            output = reader.buffer.drain()
+            if(output != ''):
+                self.logger.log(output.rstrip(), True)
+            self.logger.log("============== Binary output traces end ================= ", True)
+
+    def drain_binary_output(self):
         self.logger.log("============== Binary output traces start ================= ", True)
         while True:
             line=self.freeze_handler.child.stdout.readline()
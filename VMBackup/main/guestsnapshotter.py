@@ -28,10 +28,18 @@ try:
 except ImportError:
     import configparser as ConfigParsers
 import multiprocessing as mp
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 from common import CommonVariables
 from HttpUtil import HttpUtil
 from Utils import Status
 from Utils import HandlerUtil
+from Utils.PhaseProfiler import PhaseProfiler, monotonic
+from Utils.SnapshotModeSelector import SnapshotModeSelector
 from fsfreezer import FsFreezer
 from Utils import HostSnapshotObjects
 
@@ -64,12 +72,24 @@ class SnapshotResult(object):
 
 class GuestSnapshotter(object):
     """description of class"""
+    SnapshotThreadPoolSizeDefault = 16
+    SnapshotDeadlineMarginInSeconds = 5
+
     def __init__(self, logger, hutil):
         self.logger = logger
         self.configfile='/etc/azure/vmbackup.conf'
         self.hutil = hutil
+        self.adaptive_mode_selection = False
+        self.queue_setup_seconds = None
 
     def snapshot(self, sasuri, sasuri_index, meta_data, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger):
+        snapshot_error, snapshot_info_indexer, temp_logger, error_logger = self.snapshot_blob(sasuri, sasuri_index, meta_data)
+        global_logger.put(temp_logger)
+        global_error_logger.put(error_logger)
+        snapshot_result_error.put(snapshot_error)
+        snapshot_info_indexer_queue.put(snapshot_info_indexer)
+
+    def snapshot_blob(self, sasuri, sasuri_index, meta_data):
         temp_logger=''
         error_logger=''
         snapshot_error = SnapshotError()
@@ -99,7 +119,9 @@ class GuestSnapshotter(object):
                 sasuri_obj = urlparser.urlparse(sasuri + '&comp=snapshot')
                 temp_logger = temp_logger + str(datetime.datetime.utcnow()) + ' start calling the snapshot rest api. '
                 # initiate http call for blob-snapshot and get http response
+                blob_phase = PhaseProfiler.get_instance().begin("blob_snapshot", sasuri_index)
                 result, httpResp, errMsg, responseBody  = http_util.HttpCallGetResponse('PUT', sasuri_obj, body_content, headers = headers, responseBodyRequired = True)
+                PhaseProfiler.get_instance().end(blob_phase, None if result == CommonVariables.success else 'failed')
                 temp_logger = temp_logger + str("responseBody: " + responseBody)
                 if(result == CommonVariables.success and httpResp != None):
                     # retrieve snapshot information from http response
@@ -120,10 +142,7 @@ class GuestSnapshotter(object):
             snapshot_error.errorcode = CommonVariables.error
             snapshot_error.sasuri = sasuri
         temp_logger=temp_logger + str(datetime.datetime.utcnow()) + ' snapshot ends..'
-        global_logger.put(temp_logger)
-        global_error_logger.put(error_logger)
-        snapshot_result_error.put(snapshot_error)
-        snapshot_info_indexer_queue.put(snapshot_info_indexer)
+        return snapshot_error, snapshot_info_indexer, temp_logger, error_logger
 
     def snapshot_seq(self, sasuri, sasuri_index, meta_data):
         result = None
@@ -153,7 +172,9 @@ class GuestSnapshotter(object):
                 sasuri_obj = urlparser.urlparse(sasuri + '&comp=snapshot')
                 self.logger.log("start calling the snapshot rest api")
                 # initiate http call for blob-snapshot and get http response
+                blob_phase = PhaseProfiler.get_instance().begin("blob_snapshot", sasuri_index)
                 result, httpResp, errMsg, responseBody  = http_util.HttpCallGetResponse('PUT', sasuri_obj, body_content, headers = headers, responseBodyRequired = True)
+                PhaseProfiler.get_instance().end(blob_phase, None if result == CommonVariables.success else 'failed')
                 self.logger.log("responseBody: " + responseBody)
                 if(result == CommonVariables.success and httpResp != None):
                     # retrieve snapshot information from http response
@@ -218,6 +239,7 @@ class GuestSnapshotter(object):
                     if(counter == 0):
                         queue_creation_endtime = datetime.datetime.now()
                         timediff = queue_creation_endtime - queue_creation_starttime
+                        self.queue_setup_seconds = timediff.seconds + timediff.microseconds / 1000000.0
                         if(timediff.seconds >= 10):
                             self.logger.log("mp queue creation took more than 10 secs. Setting next backup to sequential")
                             set_next_backup_to_seq = True
@@ -233,7 +255,7 @@ class GuestSnapshotter(object):
                     time_after_thaw = datetime.datetime.now()
                     HandlerUtil.HandlerUtility.add_to_telemetery_data("ThawTime", str(time_after_thaw-time_before_thaw))
                     thaw_done_local = True
-                    if(set_next_backup_to_seq == True):
+                    if(set_next_backup_to_seq == True and self.adaptive_mode_selection == False):
                         self.logger.log("Setting to sequential snapshot")
                         self.hutil.set_value_to_configfile('seqsnapshot', '1')
                     self.logger.log('T:S thaw result ' + str(thaw_result))
@@ -274,6 +296,114 @@ class GuestSnapshotter(object):
             return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
 
 
+    def snapshot_worker(self, blobs, meta_data, work_queue, results, deadline):
+        while True:
+            try:
+                blob_index = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            if(time.time() >= deadline):
+                snapshot_error = SnapshotError()
+                snapshot_error.errorcode = CommonVariables.error
+                snapshot_error.sasuri = blobs[blob_index]
+                error_logger = str(datetime.datetime.utcnow()) + " snapshot not started, freeze deadline already passed "
+                results[blob_index] = (snapshot_error, SnapshotInfoIndexerObj(blob_index, False, None, error_logger), '', error_logger)
+            else:
+                results[blob_index] = self.snapshot_blob(blobs[blob_index], blob_index, meta_data)
+
+    def get_snapshot_deadline(self, freezer, g_fsfreeze_on):
+        # the binary thaws by itself once the freeze timeout expires, snapshots finishing after that are not consistent
+        timeout = self.hutil.get_intvalue_from_configfile('timeout', 60)
+        start_time = time.time()
+        if(g_fsfreeze_on and freezer is not None and getattr(freezer, 'freeze_completed_time', None) is not None):
+            start_time = freezer.freeze_completed_time
+        return start_time + max(timeout - GuestSnapshotter.SnapshotDeadlineMarginInSeconds, 1)
+
+    def snapshotall_threaded(self, paras, freezer, thaw_done, g_fsfreeze_on, concurrency = None):
+        self.logger.log("doing snapshotall now in parallel using threads...")
+        snapshot_result = SnapshotResult()
+        blob_snapshot_info_array = []
+        all_failed = True
+        exceptOccurred = False
+        is_inconsistent = False
+        thaw_done_local = thaw_done
+        unable_to_sleep = False
+        all_snapshots_failed = False
+        try:
+            blobs = paras.blobs
+            if blobs is not None:
+                if concurrency is None:
+                    concurrency = self.hutil.get_intvalue_from_configfile('SnapshotThreadPoolSize', GuestSnapshotter.SnapshotThreadPoolSizeDefault)
+                concurrency = max(1, min(concurrency, len(blobs)))
+                deadline = self.get_snapshot_deadline(freezer, g_fsfreeze_on)
+                work_queue = queue.Queue()
+                results = [None] * len(blobs)
+                for blob_index in range(len(blobs)):
+                    blobUri = blobs[blob_index].split("?")[0]
+                    self.logger.log("index: " + str(blob_index) + " blobUri: " + str(blobUri))
+                    blob_snapshot_info_array.append(HostSnapshotObjects.BlobSnapshotInfo(False, blobUri, None, 500))
+                    work_queue.put(blob_index)
+
+                self.logger.log('****** 5. Snaphotting (Guest-threaded) Started, threads: ' + str(concurrency))
+                workers = []
+                for i in range(concurrency):
+                    worker = threading.Thread(target=self.snapshot_worker, args=(blobs, paras.backup_metadata, work_queue, results, deadline))
+                    # a worker stuck past the deadline must not keep the process alive
+                    worker.daemon = True
+                    worker.start()
+                    workers.append(worker)
+                for worker in workers:
+                    worker.join(max(deadline - time.time(), 0))
+                self.logger.log('****** 6. Snaphotting (Guest-threaded) Completed')
+
+                thaw_result = None
+                if g_fsfreeze_on and thaw_done_local == False:
+                    time_before_thaw = datetime.datetime.now()
+                    thaw_result, unable_to_sleep = freezer.thaw_safe()
+                    time_after_thaw = datetime.datetime.now()
+                    HandlerUtil.HandlerUtility.add_to_telemetery_data("ThawTime", str(time_after_thaw-time_before_thaw))
+                    thaw_done_local = True
+                    self.logger.log('T:S thaw result ' + str(thaw_result))
+                    if(thaw_result is not None and len(thaw_result.errors) > 0  and (snapshot_result is None or len(snapshot_result.errors) == 0)):
+                        is_inconsistent = True
+                        snapshot_result.errors.append(thaw_result.errors)
+                        return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
+
+                for blob_index in range(len(blobs)):
+                    result = results[blob_index]
+                    if result is None:
+                        snapshot_error = SnapshotError()
+                        snapshot_error.errorcode = CommonVariables.error
+                        snapshot_error.sasuri = blobs[blob_index]
+                        snapshot_result.errors.append(snapshot_error)
+                        self.logger.log("index: " + str(blob_index) + " snapshot did not complete before the freeze deadline", False, 'Error')
+                        self.get_snapshot_info(SnapshotInfoIndexerObj(blob_index, False, None, "snapshot did not complete before the freeze deadline"), blob_snapshot_info_array[blob_index])
+                        continue
+                    snapshot_error, snapshot_info_indexer, temp_logger, error_logger = result
+                    self.logger.log(temp_logger)
+                    if(error_logger != ''):
+                        self.logger.log(error_logger, False, 'Error')
+                    if(snapshot_error.errorcode != CommonVariables.success):
+                        snapshot_result.errors.append(snapshot_error)
+                    # update blob_snapshot_info_array element properties from snapshot_info_indexer object
+                    self.get_snapshot_info(snapshot_info_indexer, blob_snapshot_info_array[blob_index])
+                    if (blob_snapshot_info_array[blob_index].isSuccessful == True):
+                        all_failed = False
+                    self.logger.log("index: " + str(blob_index) + " blobSnapshotUri: " + str(blob_snapshot_info_array[blob_index].snapshotUri))
+
+                all_snapshots_failed = all_failed
+                self.logger.log("Setting all_snapshots_failed to " + str(all_snapshots_failed))
+                return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
+            else:
+                self.logger.log("the blobs are None")
+                return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
+        except Exception as e:
+            errorMsg = " Unable to perform threaded snapshot with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
+            self.logger.log(errorMsg)
+            exceptOccurred = True
+            all_snapshots_failed = all_failed
+            return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
+
     def snapshotall_seq(self, paras, freezer, thaw_done, g_fsfreeze_on):
         exceptOccurred = False
         self.logger.log("doing snapshotall now in sequence...")
@@ -327,16 +457,66 @@ class GuestSnapshotter(object):
             exceptOccurred = True
             return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
 
+    def select_snapshot_mode(self, paras):
+        seqsnapshot = self.hutil.get_intvalue_from_configfile('seqsnapshot',0)
+        parallel_mode = self.hutil.get_strvalue_from_configfile('ParallelSnapshotMode', 'thread')
+        max_concurrency = self.hutil.get_intvalue_from_configfile('SnapshotThreadPoolSize', GuestSnapshotter.SnapshotThreadPoolSizeDefault)
+        self.adaptive_mode_selection = False
+        if (seqsnapshot == 2 or (len(paras.blobs) <= 4)):
+            return SnapshotModeSelector.SeqMode, 1, None
+        if (self.hutil.get_strvalue_from_configfile('AdaptiveSnapshotMode', 'True') not in ['True', 'true']):
+            if (seqsnapshot == 1):
+                return SnapshotModeSelector.SeqMode, 1, None
+            return parallel_mode, max_concurrency, None
+        selector = SnapshotModeSelector.get_instance(self.logger)
+        probe_interval = self.hutil.get_intvalue_from_configfile('SnapshotModeProbeInterval', SnapshotModeSelector.ProbeIntervalDefault)
+        mode, concurrency, reason = selector.choose(len(paras.blobs), parallel_mode, max_concurrency, probe_interval, legacy_seq = (seqsnapshot == 1))
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("snapshotModeSelection", mode + ":" + str(concurrency) + " " + reason)
+        self.adaptive_mode_selection = True
+        return mode, concurrency, selector
+
+    def record_snapshot_mode_run(self, selector, mode, concurrency, paras, freezer, g_fsfreeze_on, start, fell_back, blob_snapshot_info_array):
+        try:
+            elapsed_ms = (monotonic() - start) * 1000
+            freeze_ms = None
+            if (g_fsfreeze_on and freezer is not None and getattr(freezer, 'freeze_completed_time', None) is not None
+                and getattr(freezer, 'thaw_completed_time', None) is not None):
+                # only a freeze that was thawed by now has a duration
+                freeze_ms = (freezer.thaw_completed_time - freezer.freeze_completed_time) * 1000
+            queue_setup_ms = None
+            if self.queue_setup_seconds is not None:
+                queue_setup_ms = self.queue_setup_seconds * 1000
+            any_blob_failed = blob_snapshot_info_array is None or any(info is None or info.isSuccessful != True for info in blob_snapshot_info_array)
+            blob_latencies_ms = PhaseProfiler.get_instance().get_durations_ms("blob_snapshot", start)
+            selector.record(mode, concurrency, len(paras.blobs), elapsed_ms, not fell_back, blob_latencies_ms, queue_setup_ms, freeze_ms, any_blob_failed,
+                self.hutil.get_intvalue_from_configfile('SnapshotThreadPoolSize', GuestSnapshotter.SnapshotThreadPoolSizeDefault))
+        except Exception as e:
+            self.logger.log("Failed to record snapshot mode statistics: %s, stack trace: %s" % (str(e), traceback.format_exc()), True, 'Warning')
+
     def snapshotall(self, paras, freezer, g_fsfreeze_on):
         thaw_done = False
-        if (self.hutil.get_intvalue_from_configfile('seqsnapshot',0) == 1 or self.hutil.get_intvalue_from_configfile('seqsnapshot',0) == 2 or (len(paras.blobs) <= 4)):
+        fell_back = False
+        self.queue_setup_seconds = None
+        mode, concurrency, selector = self.select_snapshot_mode(paras)
+        start = monotonic()
+        if (mode == SnapshotModeSelector.SeqMode):
             snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_seq(paras, freezer, thaw_done, g_fsfreeze_on)
-        else:
+        elif (mode == 'process'):
             snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_parallel(paras, freezer, thaw_done, g_fsfreeze_on)
             self.logger.log("exceptOccurred : " + str(exceptOccurred) + " thaw_done : " + str(thaw_done) + " all_snapshots_failed : " + str(all_snapshots_failed))
             if exceptOccurred and thaw_done == False and all_snapshots_failed:
                 self.logger.log("Trying sequential snapshotting as parallel snapshotting failed")
+                fell_back = True
+                snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent,thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_seq(paras, freezer, thaw_done, g_fsfreeze_on)
+        else:
+            snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_threaded(paras, freezer, thaw_done, g_fsfreeze_on, concurrency)
+            self.logger.log("exceptOccurred : " + str(exceptOccurred) + " thaw_done : " + str(thaw_done) + " all_snapshots_failed : " + str(all_snapshots_failed))
+            if exceptOccurred and thaw_done == False and all_snapshots_failed:
+                self.logger.log("Trying sequential snapshotting as parallel snapshotting failed")
+                fell_back = True
                 snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent,thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_seq(paras, freezer, thaw_done, g_fsfreeze_on)
+        if selector is not None:
+            self.record_snapshot_mode_run(selector, mode, concurrency, paras, freezer, g_fsfreeze_on, start, fell_back, blob_snapshot_info_array)
         return snapshot_result, blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep, all_snapshots_failed
 
     def httpresponse_get_snapshot_info(self, resp, sasuri_index, sasuri, responseBody):
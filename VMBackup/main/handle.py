@@ -49,6 +49,7 @@ from Utils import Status
 from freezesnapshotter import FreezeSnapshotter
 from backuplogger import Backuplogger
 from blobwriter import BlobWriter
+from Utils.StatusPipeline import StatusUploader
 from taskidentity import TaskIdentity
 from MachineIdentity import MachineIdentity
 import ExtensionErrorCodeHelper
@@ -107,17 +108,22 @@ def status_report_to_file(file_report_msg):
     backup_logger.log("file status report message:",True)
     backup_logger.log(file_report_msg,True)
 
+def write_status_blob(blob_report_msg, status_blob_uri):
+    global backup_logger,hutil
+    blobWriter = BlobWriter(hutil)
+    written = blobWriter.WriteBlob(blob_report_msg,status_blob_uri)
+    backup_logger.log("blob status report message:",True)
+    backup_logger.log(blob_report_msg,True)
+    return written
+
 def status_report_to_blob(blob_report_msg):
     global backup_logger,hutil,para_parser
     UploadStatusAndLog = hutil.get_strvalue_from_configfile('UploadStatusAndLog','True')        
     if(UploadStatusAndLog == None or UploadStatusAndLog == 'True'):
         try:
             if(para_parser is not None and para_parser.statusBlobUri is not None and para_parser.statusBlobUri != ""):
-                blobWriter = BlobWriter(hutil)
                 if(blob_report_msg is not None):
-                    blobWriter.WriteBlob(blob_report_msg,para_parser.statusBlobUri)
-                    backup_logger.log("blob status report message:",True)
-                    backup_logger.log(blob_report_msg,True)
+                    StatusUploader.get_instance(backup_logger).submit(blob_report_msg, para_parser.statusBlobUri, write_status_blob)
                 else:
                     backup_logger.log("blob_report_msg is none",True)
         except Exception as e:
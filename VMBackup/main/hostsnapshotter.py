@@ -34,6 +34,7 @@ from HttpUtil import HttpUtil
 from Utils import Status
 from Utils import HostSnapshotObjects
 from Utils import HandlerUtil
+from Utils.PhaseProfiler import PhaseProfiler
 from fsfreezer import FsFreezer
 import sys
 
@@ -77,7 +78,9 @@ class HostSnapshotter(object):
                 self.logger.log("start calling the snapshot rest api")
                 # initiate http call for blob-snapshot and get http response
                 self.logger.log('****** 5. Snaphotting (Host) Started')
+                host_phase = PhaseProfiler.get_instance().begin("host_snapshot")
                 result, httpResp, errMsg,responseBody = http_util.HttpCallGetResponse('POST', snapshoturi_obj, body_content, headers = headers, responseBodyRequired = True, isHostCall = True)
+                PhaseProfiler.get_instance().end(host_phase, None if result == CommonVariables.success else 'failed')
                 self.logger.log('****** 6. Snaphotting (Host) Completed')
                 self.logger.log("dosnapshot responseBody: " + responseBody)
                 if(httpResp != None):
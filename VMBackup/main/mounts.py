@@ -22,7 +22,9 @@ import re
 import sys
 import subprocess
 import types
+import traceback
 from Utils.DiskUtil import DiskUtil
+from Utils.MountIndex import MountIndex
 
 class Error(Exception): 
     pass
@@ -38,58 +40,78 @@ class Mount:
 class Mounts:
     def __init__(self,patching,logger):
         self.mounts = []
+        self.device_items = []
+        try:
+            mount_index = MountIndex.get_instance(logger)
+            if mount_index.refresh():
+                self.load_from_index(mount_index, logger)
+                return
+        except Exception as e:
+            logger.log("mount index failed, falling back to lsblk and mount: " + str(e) + ", stack trace: " + traceback.format_exc(), True, 'Warning')
+            self.mounts = []
+        self.load_from_commands(patching, logger)
+
+    def load_from_index(self, mount_index, logger):
+        for entry in mount_index.get_block_mounts():
+            if (self.should_skip_fstype(str(entry.fstype))):
+                logger.log("######## mounts list item Skipped due to fsType, mountPoint "+str(entry.mount_point)+", fsType "+str(entry.fstype)+" and unique-name "+str(entry.unique_name), True)
+                continue
+            mountObj = Mount(entry.name, entry.type, entry.fstype, entry.mount_point)
+            self.mounts.append(mountObj)
+            logger.log("mounts list item added, mount point "+str(mountObj.mount_point)+", device-name "+str(mountObj.name)+", fs-type "+str(mountObj.fstype)+", unique-name "+str(mountObj.unique_name), True)
+        # Reverse the mounts list
+        self.mounts.reverse()
+        logger.log("added_mount_point_names :" + str([mount.mount_point for mount in self.mounts]), True)
+
+    def load_from_commands(self, patching, logger):
         added_mount_point_names = [] 
+        added_mount_point_set = set()
         disk_util = DiskUtil.get_instance(patching,logger)
         # Get mount points 
         mount_points, mount_points_info = disk_util.get_mount_points() 
+        mount_point_set = set(mount_points)
         # Get lsblk devices 
         self.device_items = disk_util.get_device_items(None)
-        lsblk_mounts = [] 
-        lsblk_mount_points = []
-        lsblk_unique_names = []
-        lsblk_fs_types = []
+        # lsblk mounts keyed by mount point and unique name, the first device wins as with list.index
+        lsblk_mounts_by_mount_point = {}
+        lsblk_mounts_by_unique_name = {}
         # List to hold mount-points returned from lsblk command but not reurned from mount command 
-        lsblk_mounts_not_in_mount = [] 
+        lsblk_mounts_not_in_mount = set()
         for device_item in self.device_items:
             mount = Mount(device_item.name, device_item.type, device_item.file_system, device_item.mount_point)
-            lsblk_mounts.append(mount)
             logger.log("lsblk mount point "+str(mount.mount_point)+" added with device-name "+str(mount.name)+" and fs type "+str(mount.fstype)+", unique-name "+str(mount.unique_name), True)
-            lsblk_mount_points.append(device_item.mount_point)
-            lsblk_unique_names.append(mount.unique_name)
-            lsblk_fs_types.append(device_item.file_system)
-            # If lsblk mount is not found in "mount command" mount-list, add it to the lsblk_mounts_not_in_mount array
-            if((device_item.mount_point not in mount_points) and (device_item.mount_point not in lsblk_mounts_not_in_mount)):
-                lsblk_mounts_not_in_mount.append(device_item.mount_point)
-        # Sort lsblk_mounts_not_in_mount array in ascending order
-        lsblk_mounts_not_in_mount.sort()
+            lsblk_mounts_by_mount_point.setdefault(device_item.mount_point, mount)
+            lsblk_mounts_by_unique_name.setdefault(mount.unique_name, mount)
+            # If lsblk mount is not found in "mount command" mount-list, add it to the lsblk_mounts_not_in_mount set
+            if(device_item.mount_point not in mount_point_set):
+                lsblk_mounts_not_in_mount.add(device_item.mount_point)
         # Add the lsblk devices in the same order as they are returned in mount command output
         for mount_point_info in mount_points_info:
             mountPoint = mount_point_info[0]
             deviceNameParts = mount_point_info[1].split("/")
             uniqueName = str(mountPoint) + "_" + str(deviceNameParts[len(deviceNameParts)-1])
             fsType = mount_point_info[2]
-            if((mountPoint in lsblk_mount_points) and (mountPoint not in added_mount_point_names)):
+            if((mountPoint in lsblk_mounts_by_mount_point) and (mountPoint not in added_mount_point_set)):
                 if (self.should_skip_fstype(str(fsType))):
                     logger.log("######## mounts list item Skipped due to fsType, mountPoint "+str(mountPoint)+", fsType "+str(fsType)+" and unique-name "+str(uniqueName), True)
                 else:
-                    lsblk_mounts_index = 0
-                    try:
-                        lsblk_mounts_index = lsblk_unique_names.index(uniqueName)
-                    except ValueError as e:
+                    mountObj = lsblk_mounts_by_unique_name.get(uniqueName)
+                    if mountObj is None:
                         logger.log("######## UniqueName not found in lsblk list :" + str(uniqueName), True)
-                        lsblk_mounts_index = lsblk_mount_points.index(mountPoint)
-                    mountObj = lsblk_mounts[lsblk_mounts_index]
+                        mountObj = lsblk_mounts_by_mount_point[mountPoint]
                     if(mountObj.fstype is None or mountObj.fstype == "" or mountObj.fstype == " "):
                         logger.log("fstype empty from lsblk for mount" + str(mountPoint), True)
                         mountObj.fstype = fsType
                     self.mounts.append(mountObj)
                     added_mount_point_names.append(mountPoint)
+                    added_mount_point_set.add(mountPoint)
                     logger.log("mounts list item added, mount point "+str(mountObj.mount_point)+", device-name "+str(mountObj.name)+", fs-type "+str(mountObj.fstype)+", unique-name "+str(mountObj.unique_name), True)
-        # Append all the lsblk devices corresponding to lsblk_mounts_not_in_mount list mount-points
-        for mount_point in lsblk_mounts_not_in_mount:
-            if((mount_point in lsblk_mount_points) and (mount_point not in added_mount_point_names)):
-                self.mounts.append(lsblk_mounts[lsblk_mount_points.index(mount_point)])
+        # Append all the lsblk devices corresponding to lsblk_mounts_not_in_mount mount-points in ascending order
+        for mount_point in sorted(lsblk_mounts_not_in_mount, key=str):
+            if(mount_point not in added_mount_point_set):
+                self.mounts.append(lsblk_mounts_by_mount_point[mount_point])
                 added_mount_point_names.append(mount_point)
+                added_mount_point_set.add(mount_point)
                 logger.log("mounts list item added from lsblk_mounts_not_in_mount, mount point "+str(mount_point), True)
         added_mount_point_names.reverse()
         logger.log("added_mount_point_names :" + str(added_mount_point_names), True)
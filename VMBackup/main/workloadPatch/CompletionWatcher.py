@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import select
+import time
+from time import sleep
+
+class CompletionWatcher:
+    """
+    Waits for the quiesce script of a workload to signal completion by creating its IPC file.
+    The IPC folder is watched with inotify so the wait ends as soon as the file shows up;
+    where inotify is not available the file is checked every PollIntervalInSeconds.
+    The file cannot be replaced by a fifo or socket, mysql refuses SELECT INTO OUTFILE on an existing path.
+    """
+    IN_CREATE = 0x00000100
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    PollIntervalInSeconds = 0.1
+    # how often the caller's liveness check runs while inotify has nothing to report
+    AliveCheckIntervalInSeconds = 0.5
+
+    def __init__(self, logger, ipc_file):
+        self.logger = logger
+        self.ipc_file = ipc_file
+        self.inotify_fd = None
+        self.start()
+
+    def start(self):
+        # the watch is added before the quiesce script is started so its signal cannot be missed
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            folder = os.path.dirname(self.ipc_file).encode('utf-8')
+            if libc.inotify_add_watch(fd, folder, CompletionWatcher.IN_CREATE | CompletionWatcher.IN_CLOSE_WRITE | CompletionWatcher.IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, "inotify_add_watch failed")
+            self.inotify_fd = fd
+        except Exception as e:
+            self.logger.log("WorkloadPatch: inotify not available, polling for the IPC file: " + str(e))
+            self.inotify_fd = None
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def wait(self, timeout, is_alive=None):
+        """
+        Returns True once the IPC file exists, False when timeout passes or is_alive() reports
+        that the quiescing process is gone.
+        """
+        deadline = time.time() + timeout
+        try:
+            while True:
+                if os.path.exists(self.ipc_file):
+                    return True
+                if is_alive is not None and not is_alive():
+                    self.logger.log("WorkloadPatch: quiescing process exited before signalling completion")
+                    return os.path.exists(self.ipc_file)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if self.inotify_fd is None:
+                    sleep(min(remaining, CompletionWatcher.PollIntervalInSeconds))
+                    continue
+                readable = select.select([self.inotify_fd], [], [], min(remaining, CompletionWatcher.AliveCheckIntervalInSeconds))[0]
+                if readable:
+                    # only wakes the loop up, the existence check above decides
+                    os.read(self.inotify_fd, 4096)
+        finally:
+            self.close()
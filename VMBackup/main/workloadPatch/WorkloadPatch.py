@@ -20,7 +20,8 @@ import sys
 import Utils.HandlerUtil
 import threading
 import os
-from time import sleep
+import json
+import time
 import re
 try:
     import ConfigParser as ConfigParsers
@@ -29,6 +30,7 @@ except ImportError:
 import subprocess
 from common import CommonVariables
 from workloadPatch.LogBackupPatch import LogBackupPatch
+from workloadPatch.CompletionWatcher import CompletionWatcher
 
 class ErrorDetail:
     def __init__(self, errorCode, errorMsg):
@@ -63,6 +65,10 @@ class WorkloadPatch:
         self.post_database_status = ""
         self.post_log_mode = ""
         self.instance_list = []
+        self.child_created = threading.Event()
+        self.ipc_watcher = None
+        self.phase_timestamps = []
+        self.phase_lock = threading.Lock()
 
     def readOracleList(self,filePath):
         re_db = re.compile(r'^(?P<DB>(\w+)):(?P<PATH>(/|\w+|\.)+)(:(\w*))?')
@@ -79,6 +85,7 @@ class WorkloadPatch:
     def pre(self):
         try:
             self.logger.log("WorkloadPatch: Entering workload pre call")
+            self.markPhase("pre_start")
             self.createTempScriptsFolder()
             if self.role == "master" and int(self.enforce_slave_only) == 0:
                 if self.configuration_path:
@@ -101,10 +108,12 @@ class WorkloadPatch:
         except Exception as e:
             self.logger.log("WorkloadPatch: exception in pre" + str(e))
             self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadPreError, "Exception in pre"))
+        self.markPhase("pre_end")
 
     def post(self):
         try:
             self.logger.log("WorkloadPatch: Entering workload post call")
+            self.markPhase("post_start")
             if self.role == "master":
                 if len(self.instance_list) != 0:
                     self.postInstance()
@@ -128,7 +137,9 @@ class WorkloadPatch:
             #Remove the temporary scripts folder created
             self.removeTempScriptsFolder()
             self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadPostError, "exception in processing of postscript"))
-        
+        self.markPhase("post_end")
+        self.reportPhaseTimestamps()
+
     def preMaster(self):
         global preSuccess
         self.logger.log("WorkloadPatch: Entering pre mode for master")
@@ -148,6 +159,7 @@ class WorkloadPatch:
                 return None
             prescript = os.path.join(self.temp_script_folder, self.scriptpath + "/preMysqlMaster.sql")
             arg = self.sudo_user+" "+self.command+self.name+" "+self.cred_string+" -e\"set @timeout="+self.timeout+";set @outfile=\\\"\\\\\\\""+self.outfile+"\\\\\\\"\\\";source "+prescript+";\""
+            self.ipc_watcher = CompletionWatcher(self.logger, self.outfile)
             binary_thread = threading.Thread(target=self.thread_for_sql, args=[arg])
             binary_thread.start()
             self.waitForPreScriptCompletion()
@@ -158,10 +170,6 @@ class WorkloadPatch:
             self.logger.log("WorkloadPatch: argument passed for pre script:"+str(args))
 
             process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll() == None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
             while True:
                 line= process.stdout.readline()
                 line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
@@ -197,6 +205,7 @@ class WorkloadPatch:
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadDatabaseInNoArchiveLog, "Workload in no archive log mode"))                
             if(preSuccess == True):
                 self.logger.log("WorkloadPatch: pre success is true")
+                self.markPhase("quiesced")
                 self.timeoutDaemon()
             elif(self.pre_database_status == "NOTOPEN"):
                 self.logger.log("WorkloadPatch: Database in closed status, backup can be app consistent")
@@ -212,10 +221,6 @@ class WorkloadPatch:
             self.logger.log("WorkloadPatch: argument passed for pre script:"+str(self.linux_user)+"  "+str(self.command))
 
             process = subprocess.Popen(args,stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll() == None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
             while True:
                 line= process.stdout.readline()
                 line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
@@ -223,6 +228,7 @@ class WorkloadPatch:
                     self.logger.log("WorkloadPatch: pre completed with output "+line.rstrip(), True)
                 else:
                     break
+            self.markPhase("quiesced")
             self.timeoutDaemon()
             self.logger.log("WorkloadPatch: Pre- Exiting pre mode for master postgres")
         #Add new workload support here
@@ -269,10 +275,6 @@ class WorkloadPatch:
             args =  "su - "+self.linux_user+" -c "+"\'"+postOracle+"\'"
             self.logger.log("WorkloadPatch: argument passed for post script:"+str(args))
             process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll()==None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
             while True:
                 line= process.stdout.readline()
                 line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
@@ -324,10 +326,7 @@ class WorkloadPatch:
             args =  "su - "+self.linux_user+" -c "+"\'"+postPostgres+"\'"
             self.logger.log("WorkloadPatch: argument passed for post script:"+str(self.linux_user)+"  "+str(self.command))
             process = subprocess.Popen(args,stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll()==None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
+            self.waitForExit(process, 10)
             self.logger.log("WorkloadPatch: Post- Completed")
         #Add new workload support here
         else:
@@ -350,6 +349,7 @@ class WorkloadPatch:
                 return None
             prescript = os.path.join(self.temp_script_folder, self.scriptpath + "/preMysqlSlave.sql")
             arg = self.sudo_user+" "+self.command+self.name+" "+self.cred_string+" -e\"set @timeout="+self.timeout+";set @outfile=\\\"\\\\\\\""+self.outfile+"\\\\\\\"\\\";source "+prescript+";\""
+            self.ipc_watcher = CompletionWatcher(self.logger, self.outfile)
             binary_thread = threading.Thread(target=self.thread_for_sql, args=[arg])
             binary_thread.start()
             self.waitForPreScriptCompletion()
@@ -395,48 +395,66 @@ class WorkloadPatch:
     def preInstance(self):
         if 'oracle' in self.name.lower():
             self.readOracleList(self.configuration_path)
-            for index in range(len(self.instance_list)):
-                oracleInstance = self.instance_list[index]
-                oracle_home = oracleInstance["home"]
-                commandPath = os.path.join(oracle_home,'bin') + "/"
-                self.preMasterOracleInstance(commandPath, index)
+            self.runForInstances(self.preMasterOracleInstance, CommonVariables.FailedWorkloadPreError)
 
     def postInstance(self):
         if 'oracle' in self.name.lower():
-            for index in range(len(self.instance_list)):
-                oracleInstance = self.instance_list[index]
-                oracle_home = oracleInstance["home"]
-                commandPath = os.path.join(oracle_home,'bin') + "/"
-                if ((oracleInstance["preSuccess"] == True or oracleInstance["dbOpen"] == False)):
-                    self.postMasterOracleInstance(commandPath, index)
-                else:
-                    if (oracleInstance["noArchive"] == True):
-                        self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadDatabaseInNoArchiveLog, "Workload in no archive log mode"))                
-                    self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadPreError, "Workload Pre failed for SID: " + oracleInstance["sid"]))
+            self.runForInstances(self.postInstanceWorker, CommonVariables.FailedWorkloadPostError)
+            # the log backup cron entry is shared by the instances, it is set up once after all of them ran post
+            if any(oracleInstance["preSuccess"] == True or oracleInstance["dbOpen"] == False for oracleInstance in self.instance_list):
+                self.callLogBackup()
+
+    def postInstanceWorker(self, commandPath, index):
+        oracleInstance = self.instance_list[index]
+        if ((oracleInstance["preSuccess"] == True or oracleInstance["dbOpen"] == False)):
+            self.postMasterOracleInstance(commandPath, index)
+        else:
+            if (oracleInstance["noArchive"] == True):
+                self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadDatabaseInNoArchiveLog, "Workload in no archive log mode"))                
+            self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadPreError, "Workload Pre failed for SID: " + oracleInstance["sid"]))
+
+    def runForInstances(self, target, error_code):
+        # every instance is quiesced on its own thread so the backup waits for the slowest instance, not for their sum
+        threads = []
+        for index in range(len(self.instance_list)):
+            oracle_home = self.instance_list[index]["home"]
+            commandPath = os.path.join(oracle_home,'bin') + "/"
+            thread = threading.Thread(target=self.instanceWorker, args=[target, error_code, commandPath, index])
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def instanceWorker(self, target, error_code, commandPath, index):
+        try:
+            target(commandPath, index)
+        except Exception as e:
+            self.logger.log("WorkloadPatch: exception for instance with SID: " + self.instance_list[index]["sid"] + " " + str(e))
+            self.error_details.append(ErrorDetail(error_code, "Exception for SID: " + self.instance_list[index]["sid"]))
+
+    def oracleInstanceEnv(self, oracleInstance):
+        return "export ORACLE_SID=" + oracleInstance["sid"] + "; export ORACLE_HOME=" + oracleInstance["home"] + "; export PATH=" + oracleInstance["home"] + "/bin:${PATH}; export ORACLE_UNQNAME=" + oracleInstance["sid"] + "; " 
 
     def preMasterOracleInstance(self, commandPath, instanceIndex):
-        global preSuccess
         self.logger.log("WorkloadPatch: Entering pre mode for master")           
         preSuccess = False
+        pre_log_mode = ""
+        pre_database_status = ""
     
         oracleInstance = self.instance_list[instanceIndex]
+        self.markPhase("pre_start", oracleInstance["sid"])
         self.logger.log("WorkloadPatch: Pre- Inside oracle pre for instance with SID: " + oracleInstance["sid"] + " HOME: " + oracleInstance["home"])
         preOracle = commandPath + "sqlplus" + " -S -R 2 /nolog @" + os.path.join(self.temp_script_folder, self.scriptpath + "/preOracleMaster.sql ")
-        envExport = "export ORACLE_SID=" + oracleInstance["sid"] + "; export ORACLE_HOME=" + oracleInstance["home"] + "; export PATH=" + oracleInstance["home"] + "/bin:${PATH}; export ORACLE_UNQNAME=" + oracleInstance["sid"] + "; " 
-        args = "su - "+self.linux_user+" -c "+"\'"+ envExport + preOracle+"\'"
+        args = "su - "+self.linux_user+" -c "+"\'"+ self.oracleInstanceEnv(oracleInstance) + preOracle+"\'"
         self.logger.log("WorkloadPatch: argument passed for pre script:"+str(args))
         process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
 
-        self.instance_list[instanceIndex]["pid"] = process.pid
-        wait_counter = 5
-        while process.poll() == None and wait_counter>0:
-            wait_counter -= 1
-            sleep(2)
+        oracleInstance["pid"] = process.pid
         while True:
             line= process.stdout.readline()
             line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
             if(line != ''):
-                self.logger.log("WorkloadPatch: pre completed with output "+line.rstrip(), True)
+                self.logger.log("WorkloadPatch: pre completed with output for SID: " + oracleInstance["sid"] + " " + line.rstrip(), True)
             else:
                 break
             if('BEGIN BACKUP succeeded' in line):
@@ -447,45 +465,45 @@ class WorkloadPatch:
                 line_split = line.split('=')
                 self.logger.log("WorkloadPatch: log mode set is "+line_split[1], True)
                 if(line_split[1] == "ARCHIVELOG"):
-                    self.pre_log_mode = "ARCHIVELOG"
+                    pre_log_mode = "ARCHIVELOG"
                     self.logger.log("WorkloadPatch: Archive log mode for oracle")
                 else:
-                    self.pre_log_mode = "NOARCHIVELOG" 
+                    pre_log_mode = "NOARCHIVELOG" 
                     self.logger.log("WorkloadPatch: No archive log mode for oracle")
             if('STATUS=' in line):
                 line = line.replace('\n', '')
                 line_split = line.split('=')
                 self.logger.log("WorkloadPatch: database status is "+line_split[1], True)
                 if(line_split[1] == "OPEN"):
-                    self.pre_database_status = "OPEN"
+                    pre_database_status = "OPEN"
                     self.logger.log("WorkloadPatch: Database is open")
                 else:##handle other DB status if required
-                    self.pre_database_status = "NOTOPEN"
-                    self.instance_list[instanceIndex]["dbOpen"] = False
+                    pre_database_status = "NOTOPEN"
+                    oracleInstance["dbOpen"] = False
                     self.logger.log("WorkloadPatch: Database is not open")
 
-        if(self.pre_log_mode == "NOARCHIVELOG" and self.pre_database_status == "OPEN"):
-            self.instance_list[instanceIndex]["noArchive"] = True
+        if(pre_log_mode == "NOARCHIVELOG" and pre_database_status == "OPEN"):
+            oracleInstance["noArchive"] = True
         if(preSuccess == True):
-            self.logger.log("WorkloadPatch: pre success is true")
-            self.instance_list[instanceIndex]["preSuccess"] = True
+            self.logger.log("WorkloadPatch: pre success is true for SID: " + oracleInstance["sid"])
+            oracleInstance["preSuccess"] = True
+            self.markPhase("quiesced", oracleInstance["sid"])
             self.timeoutDaemonOracleInstance(instanceIndex, commandPath)
-        elif(self.pre_database_status == "NOTOPEN"):
+        elif(pre_database_status == "NOTOPEN"):
             self.logger.log("WorkloadPatch: Database in closed status, backup can be app consistent")
         else:
-            self.logger.log("WorkloadPatch: Pre failed for oracle")
-            
+            self.logger.log("WorkloadPatch: Pre failed for oracle SID: " + oracleInstance["sid"])
+        self.markPhase("pre_end", oracleInstance["sid"])
         self.logger.log("WorkloadPatch: Pre- Exiting pre mode for master")
 
     def postMasterOracleInstance(self, commandPath, instanceIndex):
-        global daemonProcess
-
-        if "daemonProcess" in self.instance_list[instanceIndex]:
-            daemonProcess = self.instance_list[instanceIndex]["daemonProcess"]
+        oracleInstance = self.instance_list[instanceIndex]
+        daemonProcess = oracleInstance.get("daemonProcess")
+        self.markPhase("post_start", oracleInstance["sid"])
 
         self.logger.log("WorkloadPatch: Entering post mode for master")
         try:
-            if (self.instance_list[instanceIndex]["dbOpen"] == True) and (daemonProcess is None or daemonProcess.poll() is not None):
+            if (oracleInstance["dbOpen"] == True) and (daemonProcess is None or daemonProcess.poll() is not None):
                 self.logger.log("WorkloadPatch: Not app consistent backup")
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadQuiescingTimeout,"not app consistent"))
             elif daemonProcess.poll() is None:
@@ -495,64 +513,60 @@ class WorkloadPatch:
             self.logger.log("WorkloadPatch: exception in daemon process indentification" + str(e))
         
         postSuccess = False
+        post_log_mode = ""
+        post_database_status = ""
     
-        oracleInstance = self.instance_list[instanceIndex]
         self.logger.log("WorkloadPatch: Post- Inside oracle post for instance with SID: " + oracleInstance["sid"] + " HOME: " + oracleInstance["home"])
         postOracle = commandPath + "sqlplus" + " -S -R 2 /nolog @" + os.path.join(self.temp_script_folder, self.scriptpath + "/postOracleMaster.sql ")
-        envExport = "export ORACLE_SID=" + oracleInstance["sid"] + "; export ORACLE_HOME=" + oracleInstance["home"] + "; export PATH=" + oracleInstance["home"] + "/bin:${PATH}; export ORACLE_UNQNAME=" + oracleInstance["sid"] + "; " 
-        args =  "su - "+self.linux_user+" -c "+"\'"+ envExport + postOracle+"\'"
+        args =  "su - "+self.linux_user+" -c "+"\'"+ self.oracleInstanceEnv(oracleInstance) + postOracle+"\'"
         self.logger.log("WorkloadPatch: argument passed for post script:"+str(args))
         process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-        wait_counter = 5
-        while process.poll()==None and wait_counter>0:
-            wait_counter -= 1
-            sleep(2)
         while True:
             line= process.stdout.readline()
             line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
             if(line != ''):
-                self.logger.log("WorkloadPatch: post completed with output "+line.rstrip(), True)
+                self.logger.log("WorkloadPatch: post completed with output for SID: " + oracleInstance["sid"] + " " + line.rstrip(), True)
             else:
                 break
             if 'END BACKUP succeeded' in line:
                 self.logger.log("WorkloadPatch: post succeeded")
                 postSuccess = True
-                self.instance_list[instanceIndex]["postSuccess"] = True
+                oracleInstance["postSuccess"] = True
                 break
             if('LOG_MODE=' in line):
                 line = line.replace('\n','')
                 line_split = line.split('=')
                 self.logger.log("WorkloadPatch: log mode set is "+line_split[1], True)
                 if(line_split[1] == "ARCHIVELOG"):
-                    self.post_log_mode = "ARCHIVELOG"
+                    post_log_mode = "ARCHIVELOG"
                     self.logger.log("WorkloadPatch: Archive log mode for oracle")
                 else:
-                    self.post_log_mode = "NOARCHIVELOG" 
+                    post_log_mode = "NOARCHIVELOG" 
                     self.logger.log("WorkloadPatch: No archive log mode for oracle")
             if('STATUS=' in line):
                 line = line.replace('\n', '')
                 line_split = line.split('=')
                 self.logger.log("WorkloadPatch: database status is "+line_split[1], True)
                 if(line_split[1] == "OPEN"):
-                    self.post_database_status = "OPEN"
+                    post_database_status = "OPEN"
                     self.logger.log("WorkloadPatch: Database is open")
                 else:##handle other DB status if required
-                    self.post_database_status = "NOTOPEN"
+                    post_database_status = "NOTOPEN"
                     self.logger.log("WorkloadPatch: Database is not open")
-        if((oracleInstance["noArchive"] == True and self.post_log_mode == "ARCHIVELOG") or (oracleInstance["noArchive"] == False and self.post_log_mode == "NOARCHIVELOG")):
+        if((oracleInstance["noArchive"] == True and post_log_mode == "ARCHIVELOG") or (oracleInstance["noArchive"] == False and post_log_mode == "NOARCHIVELOG")):
             self.logger.log("WorkloadPatch: Database log mode changed during backup")
             self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadLogModeChanged, "Database log mode changed during backup"))
         if(postSuccess == False):
-            if(oracleInstance["dbOpen"] == False and self.post_database_status == "NOTOPEN"):
+            if(oracleInstance["dbOpen"] == False and post_database_status == "NOTOPEN"):
                 self.logger.log("WorkloadPatch: Database in closed status, backup is app consistent")
-            elif((oracleInstance["dbOpen"] == True and self.post_database_status == "NOTOPEN") or (oracleInstance["dbOpen"] == False and self.post_database_status == "OPEN")):
+            elif((oracleInstance["dbOpen"] == True and post_database_status == "NOTOPEN") or (oracleInstance["dbOpen"] == False and post_database_status == "OPEN")):
                 self.logger.log("WorkloadPatch: Database status changed during backup")
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadDatabaseStatusChanged, "Database status changed during backup"))
             else:
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadPostError, "Workload Post failed"))
         
+        self.markPhase("post_end", oracleInstance["sid"])
         self.logger.log("WorkloadPatch: Post- Completed")
-        self.callLogBackup()
 
     def preMasterDB(self):
         pass
@@ -679,89 +693,78 @@ class WorkloadPatch:
 
     def waitForPreScriptCompletion(self):
         if self.ipc_folder != None:
-            wait_counter = 5 
-            while len(self.child) == 0 and wait_counter > 0:
-                self.logger.log("WorkloadPatch: child not created yet", True)
-                wait_counter -= 1
-                sleep(2)
-            if wait_counter > 0:
+            if self.child_created.wait(10) and len(self.child) > 0:
                 self.logger.log("WorkloadPatch: sql subprocess Created "+str(self.child[0].pid))
             else:
                 self.logger.log("WorkloadPatch: sql connection failed")
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadConnectionError, "sql connection failed"))
                 return None
-            wait_counter = 60
-            while os.path.exists(self.outfile) == False and wait_counter > 0:
-                self.logger.log("WorkloadPatch: Waiting for sql to complete")
-                wait_counter -= 1
-                sleep(2)
-            if wait_counter > 0:
+            self.logger.log("WorkloadPatch: Waiting for sql to complete")
+            watcher = self.ipc_watcher
+            if watcher is None:
+                watcher = CompletionWatcher(self.logger, self.outfile)
+            self.ipc_watcher = None
+            if watcher.wait(120, lambda: self.child[0].poll() is None):
+                self.markPhase("quiesced")
                 self.logger.log("WorkloadPatch: pre at server level completed")
             else:
                 self.logger.log("WorkloadPatch: pre failed to quiesce")
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadQuiescingError, "pre failed to quiesce"))
                 return None
 
+    def timeoutDaemonArgs(self, commandPath, envExport=""):
+        # argument list for su, so no extra shell is started to parse the command line
+        daemonCommand = os.path.join(self.temp_script_folder, self.scriptpath + "/timeoutDaemon.sh")+" "+self.name+" "+commandPath+" \""+self.cred_string+"\" "+self.timeout+" "+os.path.join(self.temp_script_folder, self.scriptpath)
+        return ["su", "-", self.linux_user, "-c", envExport + daemonCommand]
 
-    def timeoutDaemon(self):
-        global daemonProcess
-
-        argsDaemon = "su - "+self.linux_user+" -c " + "'" + os.path.join(self.temp_script_folder, self.scriptpath + "/timeoutDaemon.sh")+" "+self.name+" "+self.command+" \""+self.cred_string+"\" "+self.timeout+" "+os.path.join(self.temp_script_folder, self.scriptpath + "'")
+    def startTimeoutDaemon(self, argsDaemon):
         devnull = open(os.devnull, 'w')
-
-        daemonProcess = subprocess.Popen(argsDaemon, stdout=devnull, stderr=devnull, shell=True)
-        wait_counter = 5
-        while (daemonProcess is None or daemonProcess.poll() is not None) and wait_counter > 0:
-            self.logger.log("WorkloadPatch: daemonProcess not created yet", True)
-            wait_counter -= 1
-            sleep(1)
-        if wait_counter > 0:
+        daemonProcess = subprocess.Popen(argsDaemon, stdout=devnull, stderr=devnull)
+        devnull.close()
+        if daemonProcess.poll() is None:
             self.logger.log("WorkloadPatch: daemonProcess Created "+str(daemonProcess.pid))
         else:
-            while True:
-                line= daemonProcess.stdout.readline()
-                line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
-                if(line != ''):
-                    self.logger.log("WorkloadPatch: daemon process creation failed "+line.rstrip(), True)
-                else:
-                    break
+            self.logger.log("WorkloadPatch: daemon process creation failed with return code "+str(daemonProcess.returncode), True)
             self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadConnectionError, "sql connection failed"))
-        return None
+        return daemonProcess
 
-    def timeoutDaemonOracleInstance(self, instanceIndex, commandPath):
+    def timeoutDaemon(self):
         global daemonProcess
+        daemonProcess = self.startTimeoutDaemon(self.timeoutDaemonArgs(self.command))
+        return None
 
-        argsDaemon = "su - "+self.linux_user+" -c " + "'" + os.path.join(self.temp_script_folder, self.scriptpath + "/timeoutDaemon.sh")+" "+self.name+" "+commandPath+" \""+self.cred_string+"\" "+self.timeout+" "+os.path.join(self.temp_script_folder, self.scriptpath + "'")
-        devnull = open(os.devnull, 'w')
-    
+    def timeoutDaemonOracleInstance(self, instanceIndex, commandPath):
         oracleInstance = self.instance_list[instanceIndex]
-        envExport = "export ORACLE_SID=" + oracleInstance["sid"] + "; export ORACLE_HOME=" + oracleInstance["home"] + "; export PATH=" + oracleInstance["home"] + "/bin:${PATH}; export ORACLE_UNQNAME=" + oracleInstance["sid"] + "; " 
-        argsDaemon = envExport + argsDaemon
-        daemonProcess = subprocess.Popen(argsDaemon, stdout=devnull, stderr=devnull, shell=True)
-        self.instance_list[instanceIndex]["daemonProcess"] = daemonProcess
-        wait_counter = 5
-
-        while (daemonProcess is None or daemonProcess.poll() is not None) and wait_counter > 0:
-            self.logger.log("WorkloadPatch: daemonProcess not created yet", True)
-            wait_counter -= 1
-            sleep(1)
-        if wait_counter > 0:
-            self.logger.log("WorkloadPatch: daemonProcess Created "+str(daemonProcess.pid))
-        else:
-            while True:
-                line= daemonProcess.stdout.readline()
-                line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
-                if(line != ''):
-                    self.logger.log("WorkloadPatch: daemon process creation failed "+line.rstrip(), True)
-                else:
-                    break
-            self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadConnectionError, "sql connection failed"))
+        oracleInstance["daemonProcess"] = self.startTimeoutDaemon(self.timeoutDaemonArgs(commandPath, self.oracleInstanceEnv(oracleInstance)))
         return None
     
     def thread_for_sql(self,args):
         self.logger.log("WorkloadPatch: command to execute: "+str(args))
-        self.child.append(subprocess.Popen(args,stdout=subprocess.PIPE,stdin=subprocess.PIPE,shell=True,stderr=subprocess.PIPE))
-        sleep(1)
+        try:
+            self.child.append(subprocess.Popen(args,stdout=subprocess.PIPE,stdin=subprocess.PIPE,shell=True,stderr=subprocess.PIPE))
+        finally:
+            self.child_created.set()
+
+    def waitForExit(self, process, timeout):
+        # Popen.wait has no timeout on python 2, wait on a helper thread instead of polling
+        waiter = threading.Thread(target=process.wait)
+        waiter.daemon = True
+        waiter.start()
+        waiter.join(timeout)
+        return process.poll() is not None
+
+    def markPhase(self, phase, instance=None):
+        entry = {"phase": phase, "time": round(time.time(), 3)}
+        if instance is not None:
+            entry["instance"] = instance
+        with self.phase_lock:
+            self.phase_timestamps.append(entry)
+        self.logger.log("WorkloadPatch: phase " + phase + ("" if instance is None else " for SID: " + instance) + " at " + str(entry["time"]))
+
+    def reportPhaseTimestamps(self):
+        with self.phase_lock:
+            timestamps = list(self.phase_timestamps)
+        Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("workloadPhaseTimestamps", json.dumps(timestamps))
     
     def getRole(self):
         return "master"
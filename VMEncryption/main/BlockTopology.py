@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import hashlib
+import os
+import os.path
+import time
+from Common import CommonVariables
+
+
+class BlockTopology(object):
+    """
+    one snapshot of the block devices, their mounts, the LVM physical volumes and the azure
+    udev symlinks, taken with a single lsblk and lvs run and a walk of sysfs.
+    the snapshot holds as long as no uevent was sent and the mount table is unchanged, see
+    get_change_signature; it is shared by the status queries and the encryption of the volumes.
+    """
+    sys_block_path = '/sys/class/block'
+    uevent_seqnum_path = '/sys/kernel/uevent_seqnum'
+    mountinfo_path = '/proc/self/mountinfo'
+
+    def __init__(self):
+        self.timestamp = None
+        self.signature = None
+        self.device_items = []
+        self.mount_items = []
+        self.lvm_items = []
+        self.pv_names = None
+        self.azure_symlinks = {}
+        self.ide_devices = []
+        # maj:min of a device -> maj:min of its partitions and of the devices stacked on it
+        self.children = {}
+
+    @staticmethod
+    def get_change_signature():
+        """
+        the kernel counts every uevent, adding or removing a device, a partition or a mapper
+        bumps the count; mounts and umounts show in the mount table.
+        """
+        uevent_seqnum = None
+        if os.path.exists(BlockTopology.uevent_seqnum_path):
+            with open(BlockTopology.uevent_seqnum_path, 'r') as f:
+                uevent_seqnum = f.read().strip()
+        with open(BlockTopology.mountinfo_path, 'r') as f:
+            mountinfo_digest = hashlib.md5(f.read()).hexdigest()
+        return (uevent_seqnum, mountinfo_digest)
+
+    @staticmethod
+    def build(disk_util):
+        topology = BlockTopology()
+        topology.signature = BlockTopology.get_change_signature()
+        topology.timestamp = time.time()
+        topology.mount_items = disk_util.get_mount_items()
+        topology.lvm_items = disk_util.get_lvm_items()
+        topology.device_items = disk_util.get_device_items(None)
+        topology.azure_symlinks = disk_util.get_azure_symlinks()
+        topology.ide_devices = disk_util.get_ide_devices()
+        topology.children = BlockTopology.get_children()
+        if any(device_item.type.lower() == 'lvm' for device_item in topology.device_items):
+            topology.pv_names = disk_util.get_pv_names()
+        else:
+            topology.pv_names = []
+        return topology
+
+    @staticmethod
+    def get_children():
+        children = {}
+        if not os.path.isdir(BlockTopology.sys_block_path):
+            return children
+        for kernel_name in os.listdir(BlockTopology.sys_block_path):
+            sys_path = os.path.realpath(os.path.join(BlockTopology.sys_block_path, kernel_name))
+            majmin = BlockTopology.read_majmin(sys_path)
+            if majmin is None:
+                continue
+            if os.path.exists(os.path.join(sys_path, 'partition')):
+                parent_majmin = BlockTopology.read_majmin(os.path.dirname(sys_path))
+                if parent_majmin is not None:
+                    children.setdefault(parent_majmin, []).append(majmin)
+            holders_path = os.path.join(sys_path, 'holders')
+            if os.path.isdir(holders_path):
+                for holder in os.listdir(holders_path):
+                    holder_majmin = BlockTopology.read_majmin(os.path.realpath(os.path.join(holders_path, holder)))
+                    if holder_majmin is not None:
+                        children.setdefault(majmin, []).append(holder_majmin)
+        return children
+
+    @staticmethod
+    def read_majmin(sys_path):
+        try:
+            with open(os.path.join(sys_path, 'dev'), 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def is_current(self):
+        if time.time() - self.timestamp > CommonVariables.topology_max_age_seconds:
+            return False
+        try:
+            return BlockTopology.get_change_signature() == self.signature
+        except (IOError, OSError):
+            return False
+
+    def get_device_items(self):
+        """
+        copies of the device items, callers may change them.
+        """
+        return [copy.copy(device_item) for device_item in self.device_items]
+
+    def get_sub_items(self, device_item):
+        """
+        the device and everything on it, what lsblk lists for the device path.
+        """
+        majmins = set()
+        pending = [device_item.majmin]
+        while pending:
+            majmin = pending.pop()
+            if majmin in majmins:
+                continue
+            majmins.add(majmin)
+            pending.extend(self.children.get(majmin, []))
+        return [item for item in self.device_items if item.majmin in majmins]
+
+    def get_azure_devices(self):
+        """
+        the device items of the os and the resource disk and of the volumes on them.
+        """
+        azure_devices = []
+        for ide_device in self.ide_devices:
+            for device_item in self.device_items:
+                if device_item.name == ide_device:
+                    azure_devices.extend(self.get_sub_items(device_item))
+        return azure_devices
+
+    def has_pv(self, pv_path):
+        return any(pv_path in pv_name for pv_name in self.pv_names)
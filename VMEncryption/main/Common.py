@@ -33,6 +33,21 @@ class CommonVariables:
     sector_size = 512
     luks_header_size = 4096 * 512
     default_block_size = 52428800
+    # the in-place copy counts its progress in units of this size, slices are sized in whole units
+    copy_unit_size = 4194304
+    copy_max_slice_size = 268435456
+    # slices kept in memory by the read-ahead of the in-place copy
+    copy_pipeline_depth = 3
+    # the slice shrinks when backing it up and writing it takes longer than this
+    copy_max_commit_seconds = 2
+    copy_throttled_io_size = 1048576
+    # the copy reports its status when the percentage moved this much, or moved at all after the interval
+    copy_status_percent_step = 5
+    copy_status_interval_seconds = 10
+    # data volumes on different disks encrypted in place at the same time
+    default_max_parallel_volumes = 4
+    # the block topology is taken again after this even when no change was seen
+    topology_max_age_seconds = 60
     min_filesystem_size_support = 52428800 * 3
     #TODO for the sles 11, we should use the ext3
     default_file_system = 'ext4'
@@ -70,6 +85,10 @@ class CommonVariables:
     AADClientSecretKey = 'AADClientSecret'
     SecretUriKey = 'SecretUri'
     SecretSeqNum = 'SecretSeqNum'
+    EncryptionThroughputLimitKey = 'EncryptionThroughputLimitMBps'
+    EncryptionIopsLimitKey = 'EncryptionIopsLimit'
+    EncryptionMaxParallelVolumesKey = 'EncryptionMaxParallelVolumes'
+    EncryptionTotalThroughputLimitKey = 'EncryptionTotalThroughputLimitMBps'
 
     VolumeTypeOS = 'OS'
     VolumeTypeData = 'Data'
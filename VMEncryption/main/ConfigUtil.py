@@ -16,7 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import os.path
+import tempfile
+import threading
+from StringIO import StringIO
 from Common import *
 from ConfigParser import *
 
@@ -26,6 +30,13 @@ class ConfigKeyValuePair(object):
         self.prop_value = prop_value
 
 class ConfigUtil(object):
+    """
+    a config file is parsed once per process and kept until its inode, size or mtime change,
+    the instances for one path share the parsed copy.
+    """
+    parsed_configs = {}
+    parsed_configs_lock = threading.RLock()
+
     def __init__(self, config_file_path, section_name, logger):
         """
         this should not create the config file with path: config_file_path
@@ -37,37 +48,74 @@ class ConfigUtil(object):
     def config_file_exists(self):
         return os.path.exists(self.config_file_path)
 
-    def save_config(self, prop_name, prop_value):
-        #TODO make the operation an transaction.
-        config = ConfigParser()
-        if os.path.exists(self.config_file_path):
+    @staticmethod
+    def get_file_signature(stat_result):
+        return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime, stat_result.st_ctime)
+
+    def get_parsed_config(self):
+        """
+        returns the parsed config file, None when the file does not exist.
+        """
+        try:
+            signature = ConfigUtil.get_file_signature(os.stat(self.config_file_path))
+        except OSError:
+            with ConfigUtil.parsed_configs_lock:
+                ConfigUtil.parsed_configs.pop(self.config_file_path, None)
+            return None
+        with ConfigUtil.parsed_configs_lock:
+            parsed_config = ConfigUtil.parsed_configs.get(self.config_file_path)
+            if parsed_config is not None and parsed_config[0] == signature:
+                return parsed_config[1]
+            config = ConfigParser()
             config.read(self.config_file_path)
-        # read values from a section
-        if not config.has_section(self.azure_crypt_config_section):
-            config.add_section(self.azure_crypt_config_section)
-        config.set(self.azure_crypt_config_section, prop_name, prop_value)
-        with open(self.config_file_path, 'wb') as configfile:
-            config.write(configfile)
+            ConfigUtil.parsed_configs[self.config_file_path] = (signature, config)
+            return config
+
+    def save_config(self, prop_name, prop_value):
+        self.save_configs([ConfigKeyValuePair(prop_name, prop_value)])
 
     def save_configs(self, key_value_pairs):
-        config = ConfigParser()
-        if os.path.exists(self.config_file_path):
-            config.read(self.config_file_path)
-        # read values from a section
-        if not config.has_section(self.azure_crypt_config_section):
-            config.add_section(self.azure_crypt_config_section)
-        for key_value_pair in key_value_pairs:
-            if key_value_pair.prop_value is not None:
-                config.set(self.azure_crypt_config_section, key_value_pair.prop_name, key_value_pair.prop_value)
-        with open(self.config_file_path, 'wb') as configfile:
-            config.write(configfile)
+        """
+        sets all the values in one write, the file is replaced by an atomic rename so readers
+        see either all of them or none.
+        """
+        with ConfigUtil.parsed_configs_lock:
+            config = ConfigParser()
+            if os.path.exists(self.config_file_path):
+                config.read(self.config_file_path)
+            # read values from a section
+            if not config.has_section(self.azure_crypt_config_section):
+                config.add_section(self.azure_crypt_config_section)
+            for key_value_pair in key_value_pairs:
+                if key_value_pair.prop_value is not None:
+                    config.set(self.azure_crypt_config_section, key_value_pair.prop_name, key_value_pair.prop_value)
+            self.write_config(config)
+
+    def write_config(self, config):
+        content = StringIO()
+        config.write(content)
+        config_dir = os.path.dirname(self.config_file_path) or '.'
+        fd, temp_file_path = tempfile.mkstemp(prefix='.' + os.path.basename(self.config_file_path) + '.', dir=config_dir)
+        try:
+            with os.fdopen(fd, 'wb') as configfile:
+                configfile.write(content.getvalue())
+                configfile.flush()
+                os.fsync(configfile.fileno())
+            os.rename(temp_file_path, self.config_file_path)
+        except Exception:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+            raise
+        # the values just written are the parsed copy, values set as numbers are read back as strings
+        written_config = ConfigParser()
+        written_config.readfp(StringIO(content.getvalue()))
+        ConfigUtil.parsed_configs[self.config_file_path] = (ConfigUtil.get_file_signature(os.stat(self.config_file_path)), written_config)
 
     def get_config(self, prop_name):
         # write the configs, the bek file name and so on.
-        if os.path.exists(self.config_file_path):
+        config = self.get_parsed_config()
+        if config is not None:
             try:
-                config = ConfigParser()
-                config.read(self.config_file_path)
                 # read values from a section
                 prop_value = config.get(self.azure_crypt_config_section, prop_name)
                 return prop_value
@@ -76,4 +124,13 @@ class ConfigUtil(object):
                 return None
         else:
             self.logger.log("the config file {0} not exists.".format(self.config_file_path))
-            return None
\ No newline at end of file
+            return None
+
+    def get_long_config(self, prop_name):
+        """
+        the value as a long, None when it is missing or empty.
+        """
+        prop_value = self.get_config(prop_name)
+        if prop_value is None or prop_value == "":
+            return None
+        return long(prop_value)
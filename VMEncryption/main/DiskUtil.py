@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import subprocess
 import json
 import os
@@ -26,20 +27,38 @@ import shutil
 import traceback
 import uuid
 import glob
+import threading
 from datetime import datetime
 
 from EncryptionConfig import EncryptionConfig
 from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from TransactionalCopyTask import TransactionalCopyTask
+from SliceController import IOThrottle
+from BlockTopology import BlockTopology
 from CommandExecutor import CommandExecutor, ProcessCommunicator
 from Common import CommonVariables, CryptItem, LvmItem, DeviceItem
 
 
+def shared_file_update(method):
+    """
+    the decorated methods rewrite files shared by all volumes, such as crypttab, azure_crypt_mount
+    and fstab; they run one at a time even when volumes are encrypted concurrently.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with DiskUtil.shared_file_lock:
+            return method(*args, **kwargs)
+    return wrapper
+
+
 class DiskUtil(object):
     os_disk_lvm = None
     sles_cache = {}
     device_id_cache = {}
+    shared_file_lock = threading.RLock()
+    topology = None
+    topology_lock = threading.Lock()
 
     def __init__(self, hutil, patching, logger, encryption_environment):
         self.encryption_environment = encryption_environment
@@ -50,6 +69,17 @@ class DiskUtil(object):
         self.vmbus_sys_path = '/sys/bus/vmbus/devices'
 
         self.command_executor = CommandExecutor(self.logger)
+        # set when volumes are encrypted concurrently, see EncryptionScheduler
+        self.shared_copy_throttle = None
+        self.parallel_copies = 1
+
+    def get_copy_throttle(self):
+        try:
+            return IOThrottle.from_public_settings(self.logger, self.hutil.get_public_settings(), parent=self.shared_copy_throttle)
+        except Exception as e:
+            self.logger.log(msg="failed to read the encryption IO limits: {0}".format(e),
+                            level=CommonVariables.WarningLevel)
+            return self.shared_copy_throttle
 
     def copy(self, ongoing_item_config, status_prefix=''):
         copy_task = TransactionalCopyTask(logger=self.logger,
@@ -58,18 +88,14 @@ class DiskUtil(object):
                                           ongoing_item_config=ongoing_item_config,
                                           patching=self.distro_patcher,
                                           encryption_environment=self.encryption_environment,
-                                          status_prefix=status_prefix)
+                                          status_prefix=status_prefix,
+                                          throttle=self.get_copy_throttle(),
+                                          parallel_copies=self.parallel_copies)
         try:
-            mem_fs_result = copy_task.prepare_mem_fs()
-            if mem_fs_result != CommonVariables.process_success:
-                return CommonVariables.tmpfs_error
-            else:
-                return copy_task.begin_copy()
+            return copy_task.begin_copy()
         except Exception as e:
-            message = "Failed to perform dd copy: {0}, stack trace: {1}".format(e, traceback.format_exc())
+            message = "Failed to perform copy: {0}, stack trace: {1}".format(e, traceback.format_exc())
             self.logger.log(msg=message, level=CommonVariables.ErrorLevel)
-        finally:
-            copy_task.clear_mem_fs()
 
     def format_disk(self, dev_path, file_system):
         mkfs_command = ""
@@ -238,6 +264,7 @@ class DiskUtil(object):
         # if there is a non_os_entry found we should use azure_crypt_mount. Otherwise we shouldn't
         return non_os_entry_found
 
+    @shared_file_update
     def add_crypt_item(self, crypt_item, key_file_path):
         if self.should_use_azure_crypt_mount():
             return self.add_crypt_item_to_azure_crypt_mount(crypt_item)
@@ -295,6 +322,7 @@ class DiskUtil(object):
         except Exception:
             return False
 
+    @shared_file_update
     def remove_crypt_item(self, crypt_item):
         try:
             if self.should_use_azure_crypt_mount():
@@ -328,11 +356,13 @@ class DiskUtil(object):
         except Exception as e:
             return False
 
+    @shared_file_update
     def update_crypt_item(self, crypt_item, key_file_path):
         self.logger.log("Updating entry for crypt item {0}".format(crypt_item))
         self.remove_crypt_item(crypt_item)
         self.add_crypt_item(crypt_item, key_file_path)
 
+    @shared_file_update
     def migrate_crypt_items(self, passphrase_file):
         crypt_items = self.get_crypt_items()
         # Archive azure_crypt_mount file
@@ -542,6 +572,7 @@ class DiskUtil(object):
         return self.command_executor.Execute(cryptsetup_cmd)
 
     # TODO error handling.
+    @shared_file_update
     def append_mount_info(self, dev_path, mount_point):
         shutil.copy2('/etc/fstab', '/etc/fstab.backup.' + str(str(uuid.uuid4())))
         mount_content_item = dev_path + " " + mount_point + "  auto defaults 0 0"
@@ -572,6 +603,7 @@ class DiskUtil(object):
         fstab_mount_point = fstab_parts[1]
         return fstab_device, fstab_mount_point
 
+    @shared_file_update
     def modify_fstab_entry_encrypt(self, mount_point, mapper_path):
         self.logger.log("modify_fstab_entry_encrypt called with mount_point={0}, mapper_path={1}".format(mount_point, mapper_path))
 
@@ -620,6 +652,7 @@ class DiskUtil(object):
         else:
             return CommonVariables.bek_fstab_line_template.format(CommonVariables.encryption_key_mount_point)
 
+    @shared_file_update
     def add_bek_to_default_cryptdisks(self):
         if os.path.exists("/etc/default/cryptdisks"):
             with open("/etc/default/cryptdisks", 'r') as f:
@@ -628,6 +661,7 @@ class DiskUtil(object):
                 with open("/etc/default/cryptdisks", 'a') as f:
                     f.write('\n' + CommonVariables.etc_defaults_cryptdisks_line.format(CommonVariables.encryption_key_mount_point))
 
+    @shared_file_update
     def remove_mount_info(self, mount_point):
         if not mount_point:
             self.logger.log("remove_mount_info: mount_point is empty")
@@ -664,6 +698,7 @@ class DiskUtil(object):
 
         self.logger.log("fstab.azure.backup updated successfully")
 
+    @shared_file_update
     def restore_mount_info(self, mount_point_or_mapper_name):
         if not mount_point_or_mapper_name:
             self.logger.log("restore_mount_info: mount_point_or_mapper_name is empty")
@@ -779,8 +814,9 @@ class DiskUtil(object):
             "os": "NotEncrypted"
         }
 
-        mount_items = self.get_mount_items()
-        device_items = self.get_device_items(None)
+        topology = self.get_topology()
+        mount_items = topology.mount_items
+        device_items = topology.device_items
         device_items_dict = dict([(device_item.mount_point, device_item) for device_item in device_items])
 
         os_drive_encrypted = False
@@ -788,15 +824,14 @@ class DiskUtil(object):
         all_data_drives_encrypted = True
 
         osmapper_path = os.path.join(CommonVariables.dev_mapper_root, CommonVariables.osmapper_name)
+        os_disk_lvm = self.is_os_disk_lvm()
 
-        if self.is_os_disk_lvm():
-            grep_result = self.command_executor.ExecuteInBash('pvdisplay | grep {0}'.format(osmapper_path),
-                                                              suppress_logging=True)
-            if grep_result == 0 and not os.path.exists('/volumes.lvm'):
+        if os_disk_lvm:
+            if topology.has_pv(osmapper_path) and not os.path.exists('/volumes.lvm'):
                 self.logger.log("OS PV is encrypted")
                 os_drive_encrypted = True
 
-        special_azure_devices_to_skip = self.get_azure_devices()
+        special_azure_devices_to_skip = topology.get_azure_devices()
 
         for mount_item in mount_items:
             device_item = device_items_dict.get(mount_item["dest"])
@@ -811,7 +846,7 @@ class DiskUtil(object):
                     all_data_drives_encrypted = False
 
             if mount_item["dest"] == "/" and \
-               not self.is_os_disk_lvm() and \
+               not os_disk_lvm and \
                CommonVariables.dev_mapper_root in mount_item["src"] or \
                "/dev/dm" in mount_item["src"]:
                 self.logger.log("OS volume {0} is mounted from {1}".format(mount_item["dest"], mount_item["src"]))
@@ -911,6 +946,21 @@ class DiskUtil(object):
         self.logger.log(msg="Failed to find a persistent path for [{0}].".format(sdx_path), level=CommonVariables.WarningLevel)
         return sdx_path
 
+    def get_physical_disk_name(self, dev_path):
+        """
+        kernel name of the disk dev_path lives on: the disk of a partition, the disks below a
+        device mapper device joined by '+', or the device itself.
+        """
+        kernel_name = os.path.basename(os.path.realpath(dev_path))
+        sys_path = os.path.realpath(os.path.join('/sys/class/block', kernel_name))
+        if os.path.exists(os.path.join(sys_path, 'partition')):
+            return os.path.basename(os.path.dirname(sys_path))
+        slaves_path = os.path.join(sys_path, 'slaves')
+        if os.path.isdir(slaves_path) and os.listdir(slaves_path):
+            disks = set(self.get_physical_disk_name(os.path.join('/dev', slave)) for slave in os.listdir(slaves_path))
+            return '+'.join(sorted(disks))
+        return kernel_name
+
     def get_device_path(self, dev_name):
         device_path = None
 
@@ -933,6 +983,29 @@ class DiskUtil(object):
 
         return DiskUtil.device_id_cache[dev_path]
 
+    def get_topology(self):
+        """
+        the current BlockTopology, taken again once devices or mounts changed.
+        """
+        with DiskUtil.topology_lock:
+            if DiskUtil.topology is not None and DiskUtil.topology.is_current():
+                return DiskUtil.topology
+            if DiskUtil.topology is not None:
+                # device names may now belong to other devices
+                DiskUtil.sles_cache.clear()
+                DiskUtil.device_id_cache.clear()
+            DiskUtil.topology = BlockTopology.build(self)
+            return DiskUtil.topology
+
+    def get_pv_names(self):
+        pvs_command = 'pvs --noheadings -o pv_name'
+        proc_comm = ProcessCommunicator()
+
+        if self.command_executor.Execute(pvs_command, communicator=proc_comm, suppress_logging=True):
+            return []
+
+        return [line.strip() for line in proc_comm.stdout.splitlines() if line.strip()]
+
     def get_device_items_property(self, dev_name, property_name):
         if (dev_name, property_name) in DiskUtil.sles_cache:
             return DiskUtil.sles_cache[(dev_name, property_name)]
@@ -1178,13 +1251,13 @@ class DiskUtil(object):
         if DiskUtil.os_disk_lvm is not None:
             return DiskUtil.os_disk_lvm
 
-        device_items = self.get_device_items(None)
+        topology = self.get_topology()
 
-        if not any([item.type.lower() == 'lvm' for item in device_items]):
+        if not any([item.type.lower() == 'lvm' for item in topology.device_items]):
             DiskUtil.os_disk_lvm = False
             return False
 
-        lvm_items = filter(lambda item: item.vg_name == "rootvg", self.get_lvm_items())
+        lvm_items = filter(lambda item: item.vg_name == "rootvg", topology.lvm_items)
 
         current_lv_names = set([item.lv_name for item in lvm_items])
 
@@ -1247,7 +1320,7 @@ class DiskUtil(object):
             if device_item.uuid is None or device_item.uuid == "":
                 self.logger.log(msg="the device do not have the related uuid, so skip it.", level=CommonVariables.WarningLevel)
                 return True
-            sub_items = self.get_device_items("/dev/" + device_item.name)
+            sub_items = self.get_topology().get_sub_items(device_item)
             if len(sub_items) > 1:
                 self.logger.log(msg=("there's sub items for the device:{0} , so skip it.".format(device_item.name)), level=CommonVariables.WarningLevel)
                 return True
@@ -1267,13 +1340,7 @@ class DiskUtil(object):
             return False
 
     def get_azure_devices(self):
-        ide_devices = self.get_ide_devices()
-        blk_items = []
-        for ide_device in ide_devices:
-            current_blk_items = self.get_device_items("/dev/" + ide_device)
-            for current_blk_item in current_blk_items:
-                blk_items.append(current_blk_item)
-        return blk_items
+        return self.get_topology().get_azure_devices()
 
     def get_ide_devices(self):
         """
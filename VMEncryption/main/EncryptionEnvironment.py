@@ -16,8 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import glob
 import os
 import os.path
+import re
 import subprocess
 from subprocess import *
 
@@ -40,8 +43,32 @@ class EncryptionEnvironment(object):
         self.cleartext_key_base_path = os.path.join(self.encryption_config_path, 'cleartext_key')
         self.copy_header_slice_file_path = os.path.join(self.encryption_config_path, 'copy_header_slice_file')
         self.copy_slice_item_backup_file = os.path.join(self.encryption_config_path, 'copy_slice_item.bak')
+        self.copy_slice_checkpoint_file = os.path.join(self.encryption_config_path, 'copy_slice_checkpoint')
         self.os_encryption_markers_path = os.path.join(self.encryption_config_path, 'os_encryption_markers')
         self.bek_backup_path = os.path.join(self.encryption_config_path, 'bek_backup')
+        self.volume_key = None
+
+    def get_volume_environment(self, volume_key):
+        """
+        a copy of this environment whose in-place encryption state files belong to one volume,
+        so several volumes can be encrypted side by side.
+        """
+        volume_environment = copy.copy(self)
+        volume_environment.volume_key = volume_key
+        suffix = '_' + re.sub(r'[^A-Za-z0-9_.-]', '_', volume_key)
+        volume_environment.azure_crypt_ongoing_item_config_path = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item' + suffix + '.ini')
+        volume_environment.copy_header_slice_file_path = os.path.join(self.encryption_config_path, 'copy_header_slice_file' + suffix)
+        volume_environment.copy_slice_item_backup_file = os.path.join(self.encryption_config_path, 'copy_slice_item' + suffix + '.bak')
+        volume_environment.copy_slice_checkpoint_file = os.path.join(self.encryption_config_path, 'copy_slice_checkpoint' + suffix)
+        return volume_environment
+
+    def get_volume_keys(self):
+        """
+        keys of the volumes whose in-place encryption did not finish, e.g. because of a reboot.
+        """
+        pattern = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item_*.ini')
+        prefix_length = len(os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item_'))
+        return sorted(path[prefix_length:-len('.ini')] for path in glob.glob(pattern))
 
     def get_se_linux(self):
         proc = Popen([self.patching.getenforce_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
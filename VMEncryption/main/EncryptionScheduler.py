@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import traceback
+from collections import OrderedDict
+from Common import CommonVariables
+
+
+class VolumeEncryptionJob(object):
+    """
+    one volume to encrypt in place. disk_key names the physical disk the volume lives on,
+    volume_key names its state files, see EncryptionEnvironment.get_volume_environment.
+    device_item is set for a new encryption, ongoing_item_config when resuming one.
+    """
+    def __init__(self, volume_key, disk_key, device_item=None, ongoing_item_config=None, status_prefix=''):
+        self.volume_key = volume_key
+        self.disk_key = disk_key
+        self.device_item = device_item
+        self.ongoing_item_config = ongoing_item_config
+        self.status_prefix = status_prefix
+        self.succeeded = None
+
+    def __str__(self):
+        return "volume {0} on disk {1}".format(self.volume_key, self.disk_key)
+
+
+class MergedStatusReporter(object):
+    """
+    stands in for hutil in the volumes of a schedule. every volume keeps its latest status line
+    and each report writes all of them as one message, so volumes running side by side do not
+    overwrite each other's progress; reports are written one at a time.
+    """
+    def __init__(self, hutil):
+        self.hutil = hutil
+        self.lock = threading.Lock()
+        self.messages = OrderedDict()
+
+    def for_volume(self, volume_key):
+        return VolumeStatusReporter(self, volume_key)
+
+    def report(self, volume_key, operation, status, status_code, message):
+        with self.lock:
+            self.messages[volume_key] = message
+            self.hutil.do_status_report(operation=operation,
+                                        status=status,
+                                        status_code=status_code,
+                                        message='; '.join(self.messages.values()))
+
+
+class VolumeStatusReporter(object):
+    def __init__(self, merged_status_reporter, volume_key):
+        self.merged_status_reporter = merged_status_reporter
+        self.volume_key = volume_key
+
+    def do_status_report(self, operation, status, status_code, message):
+        self.merged_status_reporter.report(self.volume_key, operation, status, status_code, message)
+
+    def __getattr__(self, name):
+        return getattr(self.merged_status_reporter.hutil, name)
+
+
+class EncryptionScheduler(object):
+    """
+    encrypts volumes concurrently, one volume per physical disk at a time: volumes on one disk
+    share its throughput and would only slow each other down, volumes on different disks do not.
+    at most max_parallel disks are worked on at once. once a volume fails no new volume is
+    started, the ones running are finished.
+    """
+    def __init__(self, logger, max_parallel=CommonVariables.default_max_parallel_volumes):
+        self.logger = logger
+        self.max_parallel = max(int(max_parallel), 1)
+        self.lock = threading.Lock()
+        self.pending_disks = []
+        self.failed = threading.Event()
+
+    def get_parallelism(self, jobs):
+        return min(self.max_parallel, len(set(job.disk_key for job in jobs))) or 1
+
+    def run(self, jobs, encrypt_volume):
+        """
+        encrypt_volume(job) returns True when the volume is encrypted and None when it skipped
+        the volume, which is neither a failure nor done. returns the jobs that failed, in the
+        order they were given; volumes skipped or not started because of a failure are left
+        out, they are retried on the next round.
+        """
+        disks = OrderedDict()
+        for job in jobs:
+            disks.setdefault(job.disk_key, []).append(job)
+        self.pending_disks = list(disks.values())
+        self.failed.clear()
+
+        workers = []
+        for i in range(self.get_parallelism(jobs)):
+            worker = threading.Thread(target=self.work, args=(encrypt_volume,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return [job for job in jobs if job.succeeded is False]
+
+    def work(self, encrypt_volume):
+        while not self.failed.is_set():
+            with self.lock:
+                if not self.pending_disks:
+                    return
+                disk_jobs = self.pending_disks.pop(0)
+            for job in disk_jobs:
+                if self.failed.is_set():
+                    return
+                self.logger.log(msg="encrypting {0}".format(job))
+                try:
+                    succeeded = encrypt_volume(job)
+                    job.succeeded = None if succeeded is None else bool(succeeded)
+                except Exception as e:
+                    self.logger.log(msg="encrypting {0} failed: {1}, stack trace: {2}".format(job, e, traceback.format_exc()),
+                                    level=CommonVariables.ErrorLevel)
+                    job.succeeded = False
+                if job.succeeded is False:
+                    self.failed.set()
+                    return
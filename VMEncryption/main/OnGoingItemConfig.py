@@ -76,28 +76,16 @@ class OnGoingItemConfig(object):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemMountPointKey)
 
     def get_device_size(self):
-        device_size_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemDeviceSizeKey)
-        if device_size_value is None or device_size_value == "":
-            return None
-        else:
-            return long(device_size_value)
+        return self.ongoing_item_config.get_long_config(CommonVariables.OngoingItemDeviceSizeKey)
 
     def get_current_slice_index(self):
-        current_slice_index_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentSliceIndexKey)
-        if current_slice_index_value is None or current_slice_index_value == "":
-            return None
-        else:
-            return long(current_slice_index_value)
+        return self.ongoing_item_config.get_long_config(CommonVariables.OngoingItemCurrentSliceIndexKey)
 
     def get_from_end(self):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemFromEndKey)
 
     def get_current_block_size(self):
-        block_size_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentBlockSizeKey)
-        if block_size_value is None or block_size_value == "":
-            return None
-        else:
-            return long(block_size_value)
+        return self.ongoing_item_config.get_long_config(CommonVariables.OngoingItemCurrentBlockSizeKey)
 
     def get_current_source_path(self):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentSourcePathKey)
@@ -106,11 +94,7 @@ class OnGoingItemConfig(object):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentDestinationKey)
     
     def get_current_total_copy_size(self):
-        total_copy_size_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentTotalCopySizeKey)
-        if total_copy_size_value is None or total_copy_size_value == "":
-            return None
-        else:
-            return long(total_copy_size_value)
+        return self.ongoing_item_config.get_long_config(CommonVariables.OngoingItemCurrentTotalCopySizeKey)
 
     def get_luks_header_file_path(self):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentLuksHeaderFilePathKey)
@@ -190,6 +174,8 @@ class OnGoingItemConfig(object):
                 os.rename(self.encryption_environment.azure_crypt_ongoing_item_config_path, new_name)
             else:
                 self.logger.log(msg=("the config file not exist: {0}".format(self.encryption_environment.azure_crypt_ongoing_item_config_path)), level = CommonVariables.WarningLevel)
+            if os.path.exists(self.encryption_environment.copy_slice_checkpoint_file):
+                os.remove(self.encryption_environment.copy_slice_checkpoint_file)
             return True
         except OSError as e:
             self.logger.log("Failed to archive_backup_config with error: {0}, stack trace: {1}".format(e, traceback.format_exc()))
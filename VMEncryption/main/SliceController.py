@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from Common import CommonVariables
+
+
+class SliceSizeController(object):
+    """
+    picks the number of units of the next slice from the last committed ones.
+    the slice grows while a bigger slice still makes the copy faster, and shrinks as soon as
+    committing a slice takes longer than max_commit_seconds: that is how long the slice is at
+    risk and how long other IO on the disk queues behind the syncs.
+    once growing stops paying off the size is kept for settle_slices slices before probing again.
+    """
+    samples_per_step = 2
+    settle_slices = 16
+    # throughput has to improve by this ratio to count as better
+    min_gain = 1.05
+
+    def __init__(self, logger, unit_size, initial_units, max_units, max_commit_seconds=CommonVariables.copy_max_commit_seconds):
+        self.logger = logger
+        self.unit_size = unit_size
+        self.max_units = max(max_units, 1)
+        self.units = min(max(initial_units, 1), self.max_units)
+        self.max_commit_seconds = max_commit_seconds
+        self.lock = threading.Lock()
+        self.samples = []
+        self.last_step = None
+        self.settled = 0
+
+    def next_units(self):
+        with self.lock:
+            return self.units
+
+    def record(self, units, copied_bytes, elapsed_seconds, commit_seconds):
+        """
+        elapsed_seconds is the wall time since the previous slice was committed, with the
+        read-ahead that is the pace of the slowest stage; commit_seconds covers the backup
+        and destination writes and syncs of this slice.
+        """
+        with self.lock:
+            if units != self.units or elapsed_seconds <= 0:
+                # planned before the last resize, or nothing to measure
+                return
+            self.samples.append((copied_bytes / elapsed_seconds, commit_seconds))
+            if len(self.samples) < SliceSizeController.samples_per_step:
+                return
+            throughput = sum(sample[0] for sample in self.samples) / len(self.samples)
+            commit_seconds = max(sample[1] for sample in self.samples)
+            self.samples = []
+
+            if commit_seconds > self.max_commit_seconds and self.units > 1:
+                self.resize(max(self.units // 2, 1), throughput, "commit took {0:.1f}s".format(commit_seconds))
+                self.settled = SliceSizeController.settle_slices
+            elif self.settled > 0:
+                self.settled -= SliceSizeController.samples_per_step
+            elif self.last_step is not None and throughput < self.last_step[1] * SliceSizeController.min_gain:
+                # the last change did not pay off, go back and stay there for a while
+                self.resize(self.last_step[0], throughput, "{0:.1f} MB/s is no gain".format(throughput / 1048576))
+                self.last_step = None
+                self.settled = SliceSizeController.settle_slices
+            elif self.units < self.max_units:
+                self.last_step = (self.units, throughput)
+                self.resize(min(self.units * 2, self.max_units), throughput, "probing a bigger slice")
+
+    def resize(self, units, throughput, reason):
+        if units == self.units:
+            return
+        self.logger.log(msg="slice size {0} -> {1} bytes at {2:.1f} MB/s, {3}".format(self.units * self.unit_size,
+                                                                                    units * self.unit_size,
+                                                                                    throughput / 1048576,
+                                                                                    reason))
+        self.units = units
+
+    @staticmethod
+    def get_available_memory():
+        """
+        MemAvailable from /proc/meminfo in bytes, free plus page cache on kernels without it.
+        """
+        values = {}
+        try:
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 2:
+                        values[fields[0].rstrip(':')] = long(fields[1]) * 1024
+        except (IOError, OSError, ValueError):
+            return None
+        if 'MemAvailable' in values:
+            return values['MemAvailable']
+        if 'MemFree' in values:
+            return values['MemFree'] + values.get('Cached', 0)
+        return None
+
+
+class IOThrottle(object):
+    """
+    caps the bandwidth and the number of requests the copy issues against the data disk, so
+    other workloads on it are not starved while it is encrypted. requests are delayed until
+    they fit in the budget; a cap of None or 0 is no cap. a request also has to fit in the
+    budget of parent, which copies of several volumes can share.
+    """
+    def __init__(self, bytes_per_second=None, ios_per_second=None, io_size=CommonVariables.copy_throttled_io_size, parent=None):
+        self.bytes_per_second = bytes_per_second or None
+        self.ios_per_second = ios_per_second or None
+        self.parent = parent
+        # throttled requests are split to io_size so the cap is even within a slice
+        self.io_size = io_size
+        self.lock = threading.Lock()
+        self.available_at = None
+
+    def is_enabled(self):
+        return self.bytes_per_second is not None or self.ios_per_second is not None
+
+    def acquire(self, size):
+        cost = 0.0
+        if self.bytes_per_second is not None:
+            cost = max(cost, float(size) / self.bytes_per_second)
+        if self.ios_per_second is not None:
+            cost = max(cost, 1.0 / self.ios_per_second)
+        with self.lock:
+            now = time.time()
+            start = now if self.available_at is None else max(self.available_at, now)
+            self.available_at = start + cost
+        if start > now:
+            time.sleep(start - now)
+        if self.parent is not None:
+            self.parent.acquire(size)
+
+    @staticmethod
+    def from_public_settings(logger, public_settings, parent=None):
+        """
+        reads the caps from the public settings, returns parent when neither is set.
+        """
+        if not isinstance(public_settings, dict):
+            return parent
+        throttle = IOThrottle(parent=parent)
+        try:
+            throughput_limit = public_settings.get(CommonVariables.EncryptionThroughputLimitKey)
+            if throughput_limit:
+                throttle.bytes_per_second = float(throughput_limit) * 1048576
+            iops_limit = public_settings.get(CommonVariables.EncryptionIopsLimitKey)
+            if iops_limit:
+                throttle.ios_per_second = float(iops_limit)
+        except (TypeError, ValueError) as e:
+            logger.log(msg="ignoring the encryption IO limits in the settings: {0}".format(e),
+                       level=CommonVariables.WarningLevel)
+            return parent
+        if not throttle.is_enabled():
+            return parent
+        logger.log(msg="capping the copy IO at {0} bytes/s and {1} IO/s".format(throttle.bytes_per_second, throttle.ios_per_second))
+        return throttle
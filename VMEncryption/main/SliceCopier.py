@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import struct
+import zlib
+import Queue
+import threading
+import traceback
+from Common import CommonVariables
+
+
+class SliceBuffer(object):
+    """
+    preallocated buffer holding one slice, rounded up to whole sectors.
+    """
+    def __init__(self, size):
+        self.capacity = SliceBuffer.align(size)
+        self.data = bytearray(self.capacity)
+        self.view = memoryview(self.data)
+        self.length = 0
+
+    @staticmethod
+    def align(size, alignment=512):
+        return ((size + alignment - 1) // alignment) * alignment
+
+
+class SliceFile(object):
+    """
+    positional reads and writes on a device or a regular file, without moving data through
+    intermediate strings. os.preadv/os.pwrite are used where the interpreter has them,
+    otherwise the file offset is set before each readinto/write.
+    with a throttle every request waits for its share of the IO budget.
+    """
+    def __init__(self, path, writable=False, create=False, throttle=None):
+        self.path = path
+        self.throttle = throttle
+        flags = os.O_RDWR if writable else os.O_RDONLY
+        if create:
+            flags |= os.O_CREAT
+        self.fd = os.open(path, flags, 0o600)
+        self.file = io.FileIO(self.fd, 'r+' if writable else 'r', closefd=False)
+
+    def next_view(self, slice_buffer, start, end):
+        if self.throttle is None:
+            return slice_buffer.view[start:end]
+        end = min(end, start + self.throttle.io_size)
+        self.throttle.acquire(end - start)
+        return slice_buffer.view[start:end]
+
+    def read_into(self, slice_buffer, offset, length, buffer_offset=0):
+        """
+        fills slice_buffer from offset until length bytes are read or the end of the file.
+        returns the number of bytes read.
+        """
+        done = 0
+        while done < length:
+            view = self.next_view(slice_buffer, buffer_offset + done, buffer_offset + length)
+            if hasattr(os, 'preadv'):
+                count = os.preadv(self.fd, [view], offset + done)
+            else:
+                os.lseek(self.fd, offset + done, os.SEEK_SET)
+                count = self.file.readinto(view)
+            if not count:
+                break
+            done += count
+        return done
+
+    def write_from(self, slice_buffer, offset, length, buffer_offset=0):
+        done = 0
+        while done < length:
+            view = self.next_view(slice_buffer, buffer_offset + done, buffer_offset + length)
+            if hasattr(os, 'pwrite'):
+                count = os.pwrite(self.fd, view, offset + done)
+            else:
+                os.lseek(self.fd, offset + done, os.SEEK_SET)
+                count = self.file.write(view)
+            if not count:
+                raise IOError("short write to {0} at {1}".format(self.path, offset + done))
+            done += count
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        self.file.close()
+        os.close(self.fd)
+
+
+class SliceCopier(object):
+    """
+    copies one slice from the source to the destination through an in-memory buffer.
+    the slice is first written completely to the backup file and synced, only then to the
+    destination, so an interrupted destination write can always be replayed from the backup.
+    """
+    def __init__(self, logger, source_path, destination_path, backup_file_path, slice_size, throttle=None):
+        self.logger = logger
+        self.backup_file_path = backup_file_path
+        self.slice_size = slice_size
+        self.buffer = None
+        self.source = SliceFile(source_path, throttle=throttle)
+        self.destination = SliceFile(destination_path, writable=True, create=True, throttle=throttle)
+
+    def close(self):
+        self.source.close()
+        self.destination.close()
+
+    def get_buffer(self, size=None):
+        size = size or self.slice_size
+        if self.buffer is None or self.buffer.capacity < size:
+            self.buffer = SliceBuffer(size)
+        return self.buffer
+
+    def write_backup(self, slice_buffer, length):
+        """
+        the backup file only appears once it holds the whole slice, so its size is the slice length.
+        """
+        temp_file_path = self.backup_file_path + '.tmp'
+        backup = SliceFile(temp_file_path, writable=True, create=True)
+        try:
+            os.ftruncate(backup.fd, 0)
+            backup.write_from(slice_buffer, 0, length)
+            backup.sync()
+        finally:
+            backup.close()
+        os.rename(temp_file_path, self.backup_file_path)
+        SliceCopier.sync_directory(os.path.dirname(self.backup_file_path))
+
+    @staticmethod
+    def sync_directory(path):
+        fd = os.open(path or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def remove_backup(self):
+        if os.path.exists(self.backup_file_path):
+            os.remove(self.backup_file_path)
+
+    def read_slice(self, slice_buffer, source_offset, length):
+        slice_buffer.length = self.source.read_into(slice_buffer, source_offset, length)
+        return slice_buffer.length
+
+    def commit_slice(self, slice_buffer, destination_offset, backed_up=None, written=None):
+        """
+        writes a slice already read into slice_buffer, backup file first. returns the number
+        of bytes written, it is only less than the requested length at the end of the source.
+        backed_up() runs once the backup is durable and written() once the destination is,
+        before the backup is removed.
+        """
+        if slice_buffer.length > 0:
+            self.write_backup(slice_buffer, slice_buffer.length)
+            if backed_up is not None:
+                backed_up()
+            self.destination.write_from(slice_buffer, destination_offset, slice_buffer.length)
+            self.destination.sync()
+        if written is not None:
+            written()
+        self.remove_backup()
+        return slice_buffer.length
+
+    def resume_slice(self, source_offset, destination_offset, length, written=None):
+        """
+        completes a slice interrupted by a crash. the part already in the backup file is taken
+        from there since the destination write may have overwritten it on the source,
+        the rest has not been touched and is read from the source; backups of earlier versions
+        may be partial.
+        """
+        slice_buffer = self.get_buffer(length)
+        backup = SliceFile(self.backup_file_path)
+        try:
+            backed_up = min(backup.read_into(slice_buffer, 0, length), length)
+        finally:
+            backup.close()
+        if backed_up < length:
+            self.logger.log(msg="completing the slice backup from {0} to {1} bytes".format(backed_up, length))
+            read = self.source.read_into(slice_buffer, source_offset + backed_up, length - backed_up, buffer_offset=backed_up)
+            length = backed_up + read
+            self.write_backup(slice_buffer, length)
+        self.destination.write_from(slice_buffer, destination_offset, length)
+        self.destination.sync()
+        if written is not None:
+            written()
+        self.remove_backup()
+        return length
+
+
+class SliceCheckpoint(object):
+    """
+    progress of one copy as a single sector record, rewritten in place and synced after every
+    slice instead of the whole ongoing item config. besides the next slice index it names the
+    slice the backup file belongs to while that slice is written, so a backup left over from a
+    committed slice is never replayed onto the next one. copy_id tells copies apart.
+    """
+    record_format = '<4sHHQqqqI'
+    record_size = 512
+    magic = 'ADEC'
+    version = 1
+
+    def __init__(self, path, copy_id):
+        self.path = path
+        self.copy_id = copy_id
+        self.file = None
+        self.slice_index = None
+        self.backup_slice_index = -1
+        self.backup_units = 0
+
+    @staticmethod
+    def get_copy_id(*identity):
+        return struct.unpack('<Q', hashlib.md5('|'.join(str(value) for value in identity)).digest()[:8])[0]
+
+    def load(self):
+        """
+        returns True and fills slice_index, backup_slice_index and backup_units when the file
+        holds a valid record of this copy.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                record = f.read(struct.calcsize(SliceCheckpoint.record_format))
+        except (IOError, OSError):
+            return False
+        if len(record) != struct.calcsize(SliceCheckpoint.record_format):
+            return False
+        magic, version, reserved, copy_id, slice_index, backup_slice_index, backup_units, checksum = struct.unpack(SliceCheckpoint.record_format, record)
+        if magic != SliceCheckpoint.magic or version != SliceCheckpoint.version or copy_id != self.copy_id:
+            return False
+        if checksum != zlib.crc32(record[:-4]) & 0xffffffff:
+            return False
+        self.slice_index = slice_index
+        self.backup_slice_index = backup_slice_index
+        self.backup_units = backup_units
+        return True
+
+    def save(self, slice_index, backup_slice_index=-1, backup_units=0):
+        if self.file is None:
+            self.file = SliceFile(self.path, writable=True, create=True)
+        record = struct.pack(SliceCheckpoint.record_format[:-1], SliceCheckpoint.magic, SliceCheckpoint.version, 0,
+                             self.copy_id, slice_index, backup_slice_index, backup_units)
+        record += struct.pack('<I', zlib.crc32(record) & 0xffffffff)
+        slice_buffer = SliceBuffer(SliceCheckpoint.record_size)
+        slice_buffer.data[:len(record)] = record
+        self.file.write_from(slice_buffer, 0, SliceCheckpoint.record_size)
+        self.file.sync()
+        self.slice_index = slice_index
+        self.backup_slice_index = backup_slice_index
+        self.backup_units = backup_units
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SliceReader(object):
+    """
+    reads slices ahead of the writer on a background thread, so reading slice N+1 overlaps
+    with backing up and writing slice N. buffers come from a pool of depth slices, which
+    bounds both the memory used and how far the reader runs ahead; depth 1 is a serial copy.
+    read-ahead only fills memory, the backup file still protects the one slice being written.
+    slices yields (source_offset, length, units) and is consumed lazily, so slice sizes may
+    change while the copy runs; next() returns (slice, buffer) in that order and None at the end.
+    """
+    def __init__(self, logger, copier, slices, depth):
+        self.logger = logger
+        self.copier = copier
+        self.slices = slices
+        self.free_buffers = Queue.Queue()
+        self.free_buffers.put(copier.get_buffer())
+        for i in range(depth - 1):
+            self.free_buffers.put(SliceBuffer(copier.slice_size))
+        self.ready_buffers = Queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read_slices)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_slices(self):
+        try:
+            for entry in self.slices:
+                slice_buffer = self.free_buffers.get()
+                if self.stopped.is_set():
+                    return
+                source_offset, length = entry[0], entry[1]
+                if slice_buffer.capacity < length:
+                    slice_buffer = SliceBuffer(length)
+                self.copier.read_slice(slice_buffer, source_offset, length)
+                self.ready_buffers.put((entry, slice_buffer, None))
+            self.ready_buffers.put((None, None, None))
+        except Exception as e:
+            self.logger.log(msg="reading ahead failed: {0}, stack trace: {1}".format(e, traceback.format_exc()),
+                            level=CommonVariables.ErrorLevel)
+            self.ready_buffers.put((None, None, e))
+
+    def next(self):
+        entry, slice_buffer, error = self.ready_buffers.get()
+        if error is not None:
+            raise error
+        if entry is None:
+            return None
+        return entry, slice_buffer
+
+    def release(self, slice_buffer):
+        self.free_buffers.put(slice_buffer)
+
+    def stop(self):
+        self.stopped.set()
+        # wakes the reader up if it waits for a free buffer
+        self.free_buffers.put(SliceBuffer(0))
+        self.thread.join()
@@ -16,28 +16,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
 import os
 import os.path
 import sys
-import shlex
-from subprocess import *
-from CommandExecutor import CommandExecutor
+import time
+import traceback
 from Common import CommonVariables
 from ConfigUtil import ConfigUtil
 from OnGoingItemConfig import *
+from SliceCopier import SliceCheckpoint, SliceCopier, SliceReader
+from SliceController import SliceSizeController
+
+
+class CopyProgressReporter(object):
+    """
+    throttles the DataCopy status: a report goes out once the percentage moved by percent_step,
+    or moved at all and interval_seconds passed since the last report. report() returns whether
+    a report was due, callers persist their progress along with it.
+    """
+    def __init__(self, hutil, status_prefix, interval_seconds=CommonVariables.copy_status_interval_seconds, percent_step=CommonVariables.copy_status_percent_step):
+        self.hutil = hutil
+        self.status_prefix = status_prefix
+        self.interval_seconds = interval_seconds
+        self.percent_step = percent_step
+        self.last_percent = None
+        self.last_report_time = None
+        self.last_done = None
+
+    def report(self, done, total, force=False):
+        percent = int(done / (float)(total) * 100.0)
+        now = time.time()
+        if done == self.last_done:
+            return False
+        if not force and self.last_percent is not None:
+            if percent == self.last_percent:
+                return False
+            if percent - self.last_percent < self.percent_step and now - self.last_report_time < self.interval_seconds:
+                return False
+        if self.status_prefix:
+            self.hutil.do_status_report(operation='DataCopy',
+                                        status=CommonVariables.extension_success_status,
+                                        status_code=str(CommonVariables.success),
+                                        message=self.status_prefix + ': ' + str(percent) + '%')
+        self.last_percent = percent
+        self.last_report_time = now
+        self.last_done = done
+        return True
 
 
 class TransactionalCopyTask(object):
     """
     copy_total_size is in byte, skip_target_size is also in byte
-    slice_size is in byte 50M
+    block_size is the unit current_slice_index counts, each slice is a whole number of units
+    sized by SliceSizeController within the memory available.
+    slices are copied in process, see SliceCopier; the next slices are read while the
+    current one is written, see SliceReader
+    the progress is kept in a SliceCheckpoint, the ongoing item config is only updated
+    along with the throttled status reports and at the end.
     """
-    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix=''):
+    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix='',
+                 pipeline_depth=CommonVariables.copy_pipeline_depth, throttle=None, max_slice_size=CommonVariables.copy_max_slice_size,
+                 parallel_copies=1):
         """
         copy_total_size is in bytes.
+        pipeline_depth is the number of slices held in memory, 1 copies strictly one slice at a time.
+        throttle is an optional IOThrottle for the source and destination IO.
+        parallel_copies is the number of copies running side by side, they share the memory.
         """
-        self.command_executer = CommandExecutor(logger)
         self.ongoing_item_config = ongoing_item_config
         self.total_size = self.ongoing_item_config.get_current_total_copy_size()
         self.block_size = self.ongoing_item_config.get_current_block_size()
@@ -56,239 +101,203 @@ class TransactionalCopyTask(object):
         self.patching = patching
         self.disk_util = disk_util
         self.hutil = hutil
-        self.tmpfs_mount_point = "/mnt/azure_encrypt_tmpfs"
-        self.slice_file_path = self.tmpfs_mount_point + "/slice_file"
-        self.copy_command = self.patching.dd_path
-
-    def resume_copy_internal(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
-        block_size_of_slice_item_backup = 512
-        #copy the left slice
-        if copy_slice_item_backup_file_size <= original_total_copy_size:
-            skip_of_slice_item_backup_file = copy_slice_item_backup_file_size / block_size_of_slice_item_backup
-            left_count = ((original_total_copy_size - copy_slice_item_backup_file_size) / block_size_of_slice_item_backup)
-            total_count = original_total_copy_size / block_size_of_slice_item_backup
-            original_device_skip_count = (self.block_size * skip_block) / block_size_of_slice_item_backup 
-            if left_count != 0:
-                dd_cmd = str(self.copy_command) \
-                       + ' if=' + self.source_dev_full_path \
-                       + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
-                       + ' bs=' + str(block_size_of_slice_item_backup) \
-                       + ' skip=' + str(original_device_skip_count + skip_of_slice_item_backup_file) \
-                       + ' seek=' + str(skip_of_slice_item_backup_file) \
-                       + ' count=' + str(left_count)
-
-                return_code = self.command_executer.Execute(dd_cmd)
-                if return_code != CommonVariables.process_success:
-                    return return_code
-
-            dd_cmd = str(self.copy_command) \
-                   + ' if=' + self.encryption_environment.copy_slice_item_backup_file \
-                   + ' of=' + self.destination \
-                   + ' bs=' + str(block_size_of_slice_item_backup) \
-                   + ' seek=' + str(original_device_skip_count) \
-                   + ' count=' + str(total_count)
-
-            return_code = self.command_executer.Execute(dd_cmd)
-            if return_code != CommonVariables.process_success:
-                return return_code
-            else:
-                self.current_slice_index += 1
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    os.remove(self.encryption_environment.copy_slice_item_backup_file)
-                return return_code
-        else:
-            self.logger.log(msg="copy_slice_item_backup_file_size is bigger than original_total_copy_size",
-                            level=CommonVariables.ErrorLevel)
-            return CommonVariables.backup_slice_file_error
-
-    def resume_copy(self):
+        self.pipeline_depth = pipeline_depth
+        self.throttle = throttle
+        self.parallel_copies = max(parallel_copies, 1)
+        self.slice_size_controller = SliceSizeController(logger=self.logger,
+                                                         unit_size=self.block_size,
+                                                         initial_units=CommonVariables.default_block_size // self.block_size,
+                                                         max_units=self.get_max_slice_size(max_slice_size) // self.block_size)
+        self.checkpoint = SliceCheckpoint(path=encryption_environment.copy_slice_checkpoint_file,
+                                          copy_id=SliceCheckpoint.get_copy_id(ongoing_item_config.get_mapper_name(),
+                                                                              self.source_dev_full_path,
+                                                                              self.destination,
+                                                                              self.total_size,
+                                                                              self.block_size,
+                                                                              self.from_end))
+        self.progress_reporter = CopyProgressReporter(hutil=hutil, status_prefix=status_prefix)
+        self.copier = None
+
+    def get_max_slice_size(self, max_slice_size):
+        # the slices in flight of all the copies together take at most a quarter of the available memory
+        available_memory = SliceSizeController.get_available_memory()
+        if available_memory is not None:
+            max_slice_size = min(max_slice_size, available_memory // (4 * self.pipeline_depth * self.parallel_copies))
+        return max(max_slice_size, self.block_size)
+
+    def get_copier(self):
+        if self.copier is None:
+            self.copier = SliceCopier(logger=self.logger,
+                                      source_path=self.source_dev_full_path,
+                                      destination_path=self.destination,
+                                      backup_file_path=self.encryption_environment.copy_slice_item_backup_file,
+                                      slice_size=self.slice_size_controller.next_units() * self.block_size,
+                                      throttle=self.throttle)
+        return self.copier
+
+    def close(self):
+        if self.copier is not None:
+            self.copier.close()
+            self.copier = None
+        self.checkpoint.close()
+
+    def report_progress(self, force=False):
+        if self.progress_reporter.report(self.current_slice_index, self.total_slice_size, force):
+            self.ongoing_item_config.current_slice_index = self.current_slice_index
+            self.ongoing_item_config.commit()
+
+    def get_slice_region(self, slice_index, units):
+        """
+        (offset, length) of the units slice_index to slice_index + units - 1. the last unit of the
+        device may be shorter than block_size or even empty, from_end copies it first.
+        """
         if self.from_end.lower() == 'true':
-            skip_block = (self.total_slice_size - self.current_slice_index - 1)
+            first_block = self.total_slice_size - slice_index - units
+            includes_last_slice = (slice_index == 0)
         else:
-            skip_block = self.current_slice_index
+            first_block = slice_index
+            includes_last_slice = (slice_index + units == self.total_slice_size)
+        length = units * self.block_size
+        if includes_last_slice:
+            length += self.last_slice_size - self.block_size
+        return first_block * self.block_size, length
+
+    def get_backed_up_units(self, backup_file_size):
+        """
+        the number of units of the slice in the backup file, None if the size matches no slice.
+        backups of earlier versions hold at most one unit and may be partial.
+        """
+        units = 0
+        while self.current_slice_index + units < self.total_slice_size:
+            units += 1
+            length = self.get_slice_region(self.current_slice_index, units)[1]
+            if length == backup_file_size or (units == 1 and length > backup_file_size):
+                return units
+            if length > backup_file_size:
+                return None
+        return None
+
+    def load_checkpoint(self):
+        if not self.checkpoint.load():
+            return False
+        if self.checkpoint.slice_index < self.current_slice_index:
+            self.logger.log(msg="the checkpoint at slice {0} is behind the config at {1}, ignoring it".format(self.checkpoint.slice_index, self.current_slice_index),
+                            level=CommonVariables.WarningLevel)
+            return False
+        if self.checkpoint.slice_index != self.current_slice_index:
+            self.logger.log(msg="resuming from the checkpoint at slice {0}, the config is at {1}".format(self.checkpoint.slice_index, self.current_slice_index))
+            self.current_slice_index = self.checkpoint.slice_index
+        return True
 
-        return_code = CommonVariables.process_success
+    def resume_copy(self):
+        has_checkpoint = self.load_checkpoint()
+        if not os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+            self.logger.log(msg="the slice item backup file not exists.",
+                            level=CommonVariables.WarningLevel)
+            return CommonVariables.process_success
 
-        if self.current_slice_index == 0:
-            if self.last_slice_size > 0:
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    copy_slice_item_backup_file_size = os.path.getsize(self.encryption_environment.copy_slice_item_backup_file)
-                    return_code = self.resume_copy_internal(copy_slice_item_backup_file_size=copy_slice_item_backup_file_size,
-                                                           skip_block=skip_block,
-                                                           original_total_copy_size=self.last_slice_size)
-                else:
-                    self.logger.log(msg="1. the slice item backup file not exists.",
-                                    level=CommonVariables.WarningLevel)
-            else:
-                self.logger.log(msg="the last slice",
+        copy_slice_item_backup_file_size = os.path.getsize(self.encryption_environment.copy_slice_item_backup_file)
+        if has_checkpoint:
+            if self.checkpoint.backup_slice_index != self.current_slice_index:
+                # the destination write of this backup never started, or its slice is committed
+                self.logger.log(msg="the slice item backup file is not of slice {0}, removing it".format(self.current_slice_index),
                                 level=CommonVariables.WarningLevel)
+                os.remove(self.encryption_environment.copy_slice_item_backup_file)
+                return CommonVariables.process_success
+            units = self.checkpoint.backup_units
+            if self.get_slice_region(self.current_slice_index, units)[1] != copy_slice_item_backup_file_size:
+                units = None
         else:
-            if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                copy_slice_item_backup_file_size = os.path.getsize(self.encryption_environment.copy_slice_item_backup_file)
-                return_code = self.resume_copy_internal(copy_slice_item_backup_file_size, skip_block=skip_block, original_total_copy_size=self.block_size)
-            else:
-                self.logger.log(msg="2. unfortunately the slice item backup file not exists.",
-                                level=CommonVariables.WarningLevel)
-        return return_code
+            units = self.get_backed_up_units(copy_slice_item_backup_file_size)
+        if units is None:
+            self.logger.log(msg="copy_slice_item_backup_file_size {0} matches no slice at {1}".format(copy_slice_item_backup_file_size, self.current_slice_index),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.backup_slice_file_error
 
-    def copy_last_slice(self, skip_block):
-        block_size_of_last_slice = 512
-        skip_of_last_slice = (skip_block * self.block_size) / block_size_of_last_slice
-        count_of_last_slice = self.last_slice_size / block_size_of_last_slice
+        offset, length = self.get_slice_region(self.current_slice_index, units)
+        try:
+            self.get_copier().resume_slice(source_offset=offset,
+                                           destination_offset=offset,
+                                           length=length,
+                                           written=lambda: self.checkpoint.save(self.current_slice_index + units))
+        except (IOError, OSError) as e:
+            self.logger.log(msg="resuming the slice at {0} failed: {1}, stack trace: {2}".format(offset, e, traceback.format_exc()),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        self.current_slice_index += units
+        self.report_progress()
+        return CommonVariables.process_success
 
-        copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                         to_device = self.destination,
-                                         skip=skip_of_last_slice,
-                                         seek=skip_of_last_slice,
-                                         block_size=block_size_of_last_slice,
-                                         count = count_of_last_slice)
-        return copy_result
+    def plan_slices(self):
+        """
+        yields (offset, length, units) of the slices left to copy, in copy order. it runs ahead
+        of the copy in the reader, each slice takes the size the controller has chosen by then.
+        """
+        slice_index = self.current_slice_index
+        while slice_index < self.total_slice_size:
+            units = min(self.slice_size_controller.next_units(), self.total_slice_size - slice_index)
+            offset, length = self.get_slice_region(slice_index, units)
+            yield offset, length, units
+            slice_index += units
 
     def begin_copy(self):
         """
         check the device_item size first, cut it
         """
-        self.resume_copy()
-        if self.from_end.lower() == 'true':
-            while self.current_slice_index < self.total_slice_size:
-                skip_block = (self.total_slice_size - self.current_slice_index - 1)
-
-                if self.current_slice_index == 0:
-                    if self.last_slice_size > 0:
-                        copy_result = self.copy_last_slice(skip_block)
-                        if copy_result != CommonVariables.process_success:
-                            return copy_result
-                    else:
-                        self.logger.log(msg = "the last slice size is zero, so skip the 0 index.")
-                else:
-                    copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                                     to_device=self.destination,
-                                                     skip=skip_block,
-                                                     seek=skip_block,
-                                                     block_size=self.block_size)
-
-                    if copy_result != CommonVariables.process_success:
-                        return copy_result
-
-                self.current_slice_index += 1
-
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
-
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
-
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
-
-            return CommonVariables.process_success
-        else:
-            while self.current_slice_index < self.total_slice_size:
-                skip_block = self.current_slice_index
-
-                if self.current_slice_index == (self.total_slice_size - 1):
-                    if self.last_slice_size > 0:
-                        copy_result = self.copy_last_slice(skip_block)
-                        if copy_result != CommonVariables.process_success:
-                            return copy_result
-                    else:
-                        self.logger.log(msg = "the last slice size is zero, so skip the last slice index.")
-                else:
-                    copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                                     to_device=self.destination,
-                                                     skip=skip_block,
-                                                     seek=skip_block,
-                                                     block_size=self.block_size)
-
-                    if copy_result != CommonVariables.process_success:
-                        return copy_result
-
-                self.current_slice_index += 1
-
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
+        try:
+            return self.begin_copy_internal()
+        finally:
+            self.close()
+
+    def begin_copy_internal(self):
+        resume_result = self.resume_copy()
+        if resume_result != CommonVariables.process_success:
+            return resume_result
+
+        try:
+            reader = SliceReader(logger=self.logger,
+                                 copier=self.get_copier(),
+                                 slices=self.plan_slices(),
+                                 depth=self.pipeline_depth)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="opening {0} to copy to {1} failed: {2}, stack trace: {3}".format(self.source_dev_full_path, self.destination, e, traceback.format_exc()),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        try:
+            last_commit_time = time.time()
+            while True:
+                try:
+                    next_slice = reader.next()
+                    if next_slice is None:
+                        break
+                    (offset, length, units), slice_buffer = next_slice
+                    if length == 0:
+                        self.logger.log(msg="the last slice size is zero, so skip the slice at {0}.".format(offset))
+                    commit_start_time = time.time()
+                    slice_index = self.current_slice_index
+                    copied = self.get_copier().commit_slice(slice_buffer, offset,
+                                                            backed_up=lambda: self.checkpoint.save(slice_index, slice_index, units),
+                                                            written=lambda: self.checkpoint.save(slice_index + units))
+                except (IOError, OSError) as e:
+                    self.logger.log(msg="copying from {0} to {1} at slice {2} failed: {3}, stack trace: {4}".format(self.source_dev_full_path, self.destination, self.current_slice_index, e, traceback.format_exc()),
+                                    level=CommonVariables.ErrorLevel)
+                    return CommonVariables.copy_data_error
+                if copied != length:
+                    self.logger.log(msg="slice at {0} ended after {1} of {2} bytes".format(offset, copied, length),
+                                    level=CommonVariables.WarningLevel)
+                reader.release(slice_buffer)
 
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
+                self.current_slice_index += units
 
-                self.hutil.do_status_report(operation='DataCopy',
-                                            status=CommonVariables.extension_success_status,
-                                            status_code=str(CommonVariables.success),
-                                            message=msg)
+                now = time.time()
+                self.slice_size_controller.record(units=units,
+                                                  copied_bytes=copied,
+                                                  elapsed_seconds=now - last_commit_time,
+                                                  commit_seconds=now - commit_start_time)
+                last_commit_time = now
 
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
+                self.report_progress()
+            self.report_progress(force=True)
             return CommonVariables.process_success
-
-    """
-    TODO: if the copy failed?
-    """
-    def copy_internal(self, from_device, to_device,  block_size, skip=0, seek=0, count=1):
-        """
-        first, copy the data to the middle cache
-        """
-        dd_cmd = str(self.copy_command) \
-               + ' if=' + from_device \
-               + ' of=' + self.slice_file_path \
-               + ' bs=' + str(block_size) \
-               + ' skip=' + str(skip) \
-               + ' count=' + str(count)
-
-        return_code = self.command_executer.Execute(dd_cmd)
-        if return_code != CommonVariables.process_success:
-            self.logger.log(msg="{0} is {1}".format(dd_cmd, return_code), level=CommonVariables.ErrorLevel)
-            return return_code
-        else:
-            slice_file_size = os.path.getsize(self.slice_file_path)
-            self.logger.log(msg=("slice_file_size is: {0}".format(slice_file_size)))
-            """
-            second, copy the data in the middle cache to the backup slice.
-            """
-            backup_slice_item_cmd = str(self.copy_command) \
-                                  + ' if=' + self.slice_file_path \
-                                  + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
-                                  + ' bs=' + str(block_size) \
-                                  + ' count=' + str(count)
-            backup_slice_args = shlex.split(backup_slice_item_cmd)
-            backup_process = Popen(backup_slice_args)
-            self.logger.log("backup_slice_item_cmd is:{0}".format(backup_slice_item_cmd))
-
-            """
-            third, copy the data in the middle cache to the target device.
-            """
-            dd_cmd = str(self.copy_command) + ' if=' + self.slice_file_path + ' of=' + to_device + ' bs=' + str(block_size) + ' seek=' + str(seek) + ' count=' + str(count)
-            return_code = self.command_executer.Execute(dd_cmd)
-            if return_code != CommonVariables.process_success:
-                self.logger.log(msg=("{0} is: {1}".format(dd_cmd, return_code)), level = CommonVariables.ErrorLevel)
-            else:
-                #the copy done correctly, so clear the backup slice file item.
-                backup_process.kill()
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    self.logger.log(msg = "clean up the backup file")
-                    os.remove(self.encryption_environment.copy_slice_item_backup_file)
-                if os.path.exists(self.slice_file_path):
-                    self.logger.log(msg = "clean up the slice file")
-                    os.remove(self.slice_file_path)
-            return return_code
-
-    def prepare_mem_fs(self):
-        self.disk_util.make_sure_path_exists(self.tmpfs_mount_point)
-        commandToExecute = self.patching.mount_path + " -t tmpfs -o size=" + str(self.block_size + 1024) + " tmpfs " + self.tmpfs_mount_point
-        self.logger.log("prepare mem fs script is: {0}".format(commandToExecute))
-        return_code = self.command_executer.Execute(commandToExecute)
-        return return_code
-
-    def clear_mem_fs(self):
-        commandToExecute = self.patching.umount_path + " " + self.tmpfs_mount_point
-        return_code = self.command_executer.Execute(commandToExecute)
-        return return_code
+        finally:
+            reader.stop()
@@ -28,6 +28,7 @@ import tempfile
 import traceback
 import uuid
 import shutil
+import threading
 
 from Utils import HandlerUtil
 from Common import CommonVariables, CryptItem
@@ -44,6 +45,8 @@ from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from EncryptionEnvironment import EncryptionEnvironment
 from OnGoingItemConfig import OnGoingItemConfig
+from EncryptionScheduler import EncryptionScheduler, MergedStatusReporter, VolumeEncryptionJob
+from SliceController import IOThrottle
 from ProcessLock import ProcessLock
 from CommandExecutor import CommandExecutor, ProcessCommunicator
 from __builtin__ import int
@@ -397,15 +400,29 @@ def none_or_empty(obj):
         return False
 
 
+se_linux_lock = threading.Lock()
+se_linux_disable_count = 0
+
+
 def toggle_se_linux_for_centos7(disable):
+    """
+    volumes encrypted concurrently each disable se linux for a while, it is enabled again
+    once the last of them is done.
+    """
+    global se_linux_disable_count
     if DistroPatcher.distro_info[0].lower() == 'centos' and DistroPatcher.distro_info[1].startswith('7.0'):
-        if disable:
-            se_linux_status = encryption_environment.get_se_linux()
-            if se_linux_status.lower() == 'enforcing':
-                encryption_environment.disable_se_linux()
-                return True
-        else:
-            encryption_environment.enable_se_linux()
+        with se_linux_lock:
+            if disable:
+                se_linux_disable_count += 1
+                if se_linux_disable_count == 1:
+                    se_linux_status = encryption_environment.get_se_linux()
+                    if se_linux_status.lower() == 'enforcing':
+                        encryption_environment.disable_se_linux()
+                        return True
+            else:
+                se_linux_disable_count = max(se_linux_disable_count - 1, 0)
+                if se_linux_disable_count == 0:
+                    encryption_environment.enable_se_linux()
     return False
 
 
@@ -888,16 +905,19 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
                                                  disk_util,
                                                  bek_util,
                                                  status_prefix='',
-                                                 ongoing_item_config=None):
+                                                 ongoing_item_config=None,
+                                                 volume_environment=None):
     """
     if ongoing_item_config is not None, then this is a resume case.
+    volume_environment holds the state files of the volume, the global ones by default.
     this function will return the phase
     """
     logger.log("encrypt_inplace_without_seperate_header_file")
+    volume_environment = volume_environment or encryption_environment
     current_phase = CommonVariables.EncryptionPhaseBackupHeader
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
-        ongoing_item_config.current_block_size = CommonVariables.default_block_size
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=volume_environment, logger=logger)
+        ongoing_item_config.current_block_size = CommonVariables.copy_unit_size
         ongoing_item_config.current_slice_index = 0
         ongoing_item_config.device_size = device_item.size
         ongoing_item_config.file_system = device_item.file_system
@@ -957,15 +977,15 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
             else:
                 ongoing_item_config.current_slice_index = 0
                 ongoing_item_config.current_source_path = original_dev_path
-                ongoing_item_config.current_destination = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.current_destination = volume_environment.copy_header_slice_file_path
                 ongoing_item_config.current_total_copy_size = CommonVariables.default_block_size
                 ongoing_item_config.from_end = False
-                ongoing_item_config.header_slice_file_path = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.header_slice_file_path = volume_environment.copy_header_slice_file_path
                 ongoing_item_config.original_dev_path = original_dev_path
                 ongoing_item_config.commit()
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
+                if os.path.exists(volume_environment.copy_header_slice_file_path):
                     logger.log(msg="the header slice file is there, remove it.", level=CommonVariables.WarningLevel)
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                    os.remove(volume_environment.copy_header_slice_file_path)
 
                 copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
 
@@ -1062,8 +1082,8 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
                     logger.log(msg=original_dev_name_path + " is not defined in fstab, no need to update",
                                level=CommonVariables.InfoLevel)
 
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                if os.path.exists(volume_environment.copy_header_slice_file_path):
+                    os.remove(volume_environment.copy_header_slice_file_path)
 
                 current_phase = CommonVariables.EncryptionPhaseDone
                 ongoing_item_config.phase = current_phase
@@ -1091,17 +1111,20 @@ def encrypt_inplace_with_seperate_header_file(passphrase_file,
                                               disk_util,
                                               bek_util,
                                               status_prefix='',
-                                              ongoing_item_config=None):
+                                              ongoing_item_config=None,
+                                              volume_environment=None):
     """
     if ongoing_item_config is not None, then this is a resume case.
+    volume_environment holds the state files of the volume, the global ones by default.
     """
     logger.log("encrypt_inplace_with_seperate_header_file")
+    volume_environment = volume_environment or encryption_environment
     current_phase = CommonVariables.EncryptionPhaseEncryptDevice
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment,
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=volume_environment,
                                                 logger=logger)
         mapper_name = str(uuid.uuid4())
-        ongoing_item_config.current_block_size = CommonVariables.default_block_size
+        ongoing_item_config.current_block_size = CommonVariables.copy_unit_size
         ongoing_item_config.current_slice_index = 0
         ongoing_item_config.device_size = device_item.size
         ongoing_item_config.file_system = device_item.file_system
@@ -1253,7 +1276,7 @@ def decrypt_inplace_copy_data(passphrase_file,
         ongoing_item_config.from_end = True
         ongoing_item_config.phase = CommonVariables.DecryptionPhaseCopyData
         ongoing_item_config.current_slice_index = 0
-        ongoing_item_config.current_block_size = CommonVariables.default_block_size
+        ongoing_item_config.current_block_size = CommonVariables.copy_unit_size
         ongoing_item_config.mount_point = crypt_item.mount_point
         ongoing_item_config.commit()
 
@@ -1411,9 +1434,10 @@ def encrypt_format_device_items(passphrase, device_items, disk_util, force=False
 
 
 def find_all_devices_to_encrypt(encryption_marker, disk_util, bek_util):
-    device_items = disk_util.get_device_items(None)
+    topology = disk_util.get_topology()
+    device_items = topology.get_device_items()
     device_items_to_encrypt = []
-    special_azure_devices_to_skip = disk_util.get_azure_devices()
+    special_azure_devices_to_skip = topology.get_azure_devices()
     for device_item in device_items:
         logger.log("device_item == " + str(device_item))
 
@@ -1424,6 +1448,92 @@ def find_all_devices_to_encrypt(encryption_marker, disk_util, bek_util):
     return device_items_to_encrypt
 
 
+def get_volume_key(device_item):
+    if not none_or_empty(device_item.uuid):
+        return device_item.uuid
+    return device_item.name
+
+
+def get_encryption_scheduler():
+    """
+    volumes on different disks are encrypted concurrently, up to EncryptionMaxParallelVolumes
+    of them, and their copies share EncryptionTotalThroughputLimitMBps when it is set.
+    """
+    max_parallel = CommonVariables.default_max_parallel_volumes
+    shared_copy_throttle = None
+    try:
+        public_settings = hutil.get_public_settings() or {}
+        if public_settings.get(CommonVariables.EncryptionMaxParallelVolumesKey):
+            max_parallel = int(public_settings.get(CommonVariables.EncryptionMaxParallelVolumesKey))
+        if public_settings.get(CommonVariables.EncryptionTotalThroughputLimitKey):
+            shared_copy_throttle = IOThrottle(bytes_per_second=float(public_settings.get(CommonVariables.EncryptionTotalThroughputLimitKey)) * 1048576)
+    except Exception as e:
+        logger.log(msg="ignoring the encryption parallelism settings: {0}".format(e),
+                   level=CommonVariables.WarningLevel)
+    return EncryptionScheduler(logger, max_parallel), shared_copy_throttle
+
+
+def encrypt_volumes_in_place(jobs, passphrase_file, bek_util):
+    """
+    encrypts the volumes of the jobs through an EncryptionScheduler, each with its own state
+    files, DiskUtil and status line. returns the jobs that failed.
+    """
+    scheduler, shared_copy_throttle = get_encryption_scheduler()
+    parallel_copies = scheduler.get_parallelism(jobs)
+    merged_status_reporter = MergedStatusReporter(hutil)
+    no_header_file_support = not_support_header_option_distro(DistroPatcher)
+
+    def encrypt_volume(job):
+        volume_environment = encryption_environment.get_volume_environment(job.volume_key)
+        volume_disk_util = DiskUtil(hutil=merged_status_reporter.for_volume(job.volume_key),
+                                    patching=DistroPatcher,
+                                    logger=logger,
+                                    encryption_environment=volume_environment)
+        volume_disk_util.shared_copy_throttle = shared_copy_throttle
+        volume_disk_util.parallel_copies = parallel_copies
+
+        if job.ongoing_item_config is None:
+            mount_point = job.device_item.mount_point
+            use_header_file = not no_header_file_support
+        else:
+            mount_point = job.ongoing_item_config.get_mount_point()
+            use_header_file = not none_or_empty(job.ongoing_item_config.get_header_file_path())
+
+        if not none_or_empty(mount_point):
+            umount_status_code = volume_disk_util.umount(mount_point)
+            if umount_status_code != CommonVariables.success and job.ongoing_item_config is None:
+                logger.log("error occured when do the umount for: {0} with code: {1}".format(mount_point, umount_status_code))
+                # skipped like before the volumes were encrypted concurrently, the other volumes go on
+                return None
+
+        # TODO check the file system before encrypting it.
+        if use_header_file:
+            encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=passphrase_file,
+                                                                                device_item=job.device_item,
+                                                                                disk_util=volume_disk_util,
+                                                                                bek_util=bek_util,
+                                                                                status_prefix=job.status_prefix,
+                                                                                ongoing_item_config=job.ongoing_item_config,
+                                                                                volume_environment=volume_environment)
+        else:
+            logger.log(msg="this is the centos 6 or redhat 6 or sles 11 series, need to resize data drive",
+                       level=CommonVariables.WarningLevel)
+            encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=passphrase_file,
+                                                                                   device_item=job.device_item,
+                                                                                   disk_util=volume_disk_util,
+                                                                                   bek_util=bek_util,
+                                                                                   status_prefix=job.status_prefix,
+                                                                                   ongoing_item_config=job.ongoing_item_config,
+                                                                                   volume_environment=volume_environment)
+        if encryption_result_phase != CommonVariables.EncryptionPhaseDone:
+            return False
+        if job.ongoing_item_config is not None:
+            job.ongoing_item_config.clear_config()
+        return True
+
+    return scheduler.run(jobs, encrypt_volume)
+
+
 def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util, bek_util):
     """
     if return None for the success case, or return the device item which failed.
@@ -1439,40 +1549,19 @@ def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util
                            status_code=str(CommonVariables.success),
                            message=msg)
 
+    jobs = []
     for device_num, device_item in enumerate(device_items_to_encrypt):
-        umount_status_code = CommonVariables.success
-        if device_item.mount_point is not None and device_item.mount_point != "":
-            umount_status_code = disk_util.umount(device_item.mount_point)
-        if umount_status_code != CommonVariables.success:
-            logger.log("error occured when do the umount for: {0} with code: {1}".format(device_item.mount_point, umount_status_code))
-        else:
-            logger.log(msg=("encrypting: {0}".format(device_item)))
-            no_header_file_support = not_support_header_option_distro(DistroPatcher)
-            status_prefix = "Encrypting data volume {0}/{1}".format(device_num + 1,
-                                                                    len(device_items_to_encrypt))
-
-            # TODO check the file system before encrypting it.
-            if no_header_file_support:
-                logger.log(msg="this is the centos 6 or redhat 6 or sles 11 series, need to resize data drive",
-                           level=CommonVariables.WarningLevel)
-
-                encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=passphrase_file,
-                                                                                       device_item=device_item,
-                                                                                       disk_util=disk_util,
-                                                                                       bek_util=bek_util,
-                                                                                       status_prefix=status_prefix)
-            else:
-                encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=passphrase_file,
-                                                                                    device_item=device_item,
-                                                                                    disk_util=disk_util,
-                                                                                    bek_util=bek_util,
-                                                                                    status_prefix=status_prefix)
-
-            if encryption_result_phase == CommonVariables.EncryptionPhaseDone:
-                continue
-            else:
-                # do exit to exit from this round
-                return device_item
+        logger.log(msg=("encrypting: {0}".format(device_item)))
+        device_path = disk_util.get_device_path(device_item.name) or os.path.join('/dev/', device_item.name)
+        jobs.append(VolumeEncryptionJob(volume_key=get_volume_key(device_item),
+                                        disk_key=disk_util.get_physical_disk_name(device_path),
+                                        device_item=device_item,
+                                        status_prefix="Encrypting data volume {0}/{1}".format(device_num + 1, len(device_items_to_encrypt))))
+
+    failed_jobs = encrypt_volumes_in_place(jobs, passphrase_file, bek_util)
+    if failed_jobs:
+        # do exit to exit from this round
+        return failed_jobs[0].device_item
     return None
 
 
@@ -1748,8 +1837,28 @@ def daemon_encrypt_data_volumes(encryption_marker, encryption_config, disk_util,
         identified.
         """
         ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
-
-        if ongoing_item_config.config_file_exists():
+        volume_keys = encryption_environment.get_volume_keys()
+
+        if volume_keys:
+            logger.log("OngoingItemConfig exists for the volumes {0}.".format(volume_keys))
+            jobs = []
+            for volume_key in volume_keys:
+                volume_ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment.get_volume_environment(volume_key),
+                                                               logger=logger)
+                volume_ongoing_item_config.load_value_from_file()
+                original_dev_name_path = volume_ongoing_item_config.get_original_dev_name_path()
+                jobs.append(VolumeEncryptionJob(volume_key=volume_key,
+                                                disk_key=disk_util.get_physical_disk_name(original_dev_name_path or volume_key),
+                                                ongoing_item_config=volume_ongoing_item_config,
+                                                status_prefix="Resuming encryption after reboot"))
+            failed_jobs = encrypt_volumes_in_place(jobs, bek_passphrase_file, bek_util)
+            """
+            if the resuming failed, we should fail.
+            """
+            if failed_jobs:
+                message = 'EnableEncryption: resuming encryption for {0} failed'.format(', '.join(job.ongoing_item_config.get_original_dev_path() or job.volume_key for job in failed_jobs))
+                raise Exception(message)
+        elif ongoing_item_config.config_file_exists():
             logger.log("OngoingItemConfig exists.")
             ongoing_item_config.load_value_from_file()
             header_file_path = ongoing_item_config.get_header_file_path()
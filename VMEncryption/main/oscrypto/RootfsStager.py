@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import errno
+import os
+import os.path
+import Queue
+import stat
+import threading
+import time
+import traceback
+
+
+class RootfsManifest(object):
+    """
+    what the stripped down root needs from the old one, shared by the distro state machines.
+    trees are copied like cp -ax, trees missing on a distro are skipped, nothing below an
+    excluded path is copied.
+    """
+    empty_directories = ['proc', 'sys', 'dev', 'run', 'usr', 'var', 'tmp', 'root', 'oldroot', 'boot', 'var/log']
+    trees = ['bin', 'etc', 'mnt', 'sbin', 'lib', 'lib64', 'root',
+             'usr/bin', 'usr/sbin', 'usr/libexec', 'usr/lib', 'usr/lib64', 'usr/share',
+             'var/lib', 'var/local', 'var/lock', 'var/opt', 'var/run', 'var/spool', 'var/tmp',
+             'var/log/azure']
+    # nothing run from the stripped down root reads the documentation
+    excluded = ['usr/share/doc', 'usr/share/man', 'usr/share/info', 'usr/share/gtk-doc', 'usr/share/help']
+
+
+class TreeStats(object):
+    def __init__(self, tree):
+        self.tree = tree
+        self.files = 0
+        self.bytes = 0
+        self.pending = 0
+        self.start_time = None
+        self.end_time = None
+
+
+class RootfsStager(object):
+    """
+    builds the stripped down root from a manifest in process. directories are copied by a pool
+    of threads, so the big trees do not wait for each other; files hardlinked to each other
+    stay hardlinked, also across trees, and sparse files stay sparse like with cp -a, the root
+    lives in memory. owners, modes and times are kept, extended attributes are not, python 2
+    has no call for them. entries that disappear while the root is copied, as files below
+    var/run and var/lib do, are skipped.
+    """
+    threads = 4
+    buffer_size = 1048576
+    # python 2 has no os.SEEK_DATA and os.SEEK_HOLE, these are the linux values
+    seek_data = getattr(os, 'SEEK_DATA', 3)
+    seek_hole = getattr(os, 'SEEK_HOLE', 4)
+
+    def __init__(self, logger, manifest=RootfsManifest, source_root='/'):
+        self.logger = logger
+        self.manifest = manifest
+        self.source_root = source_root
+        self.lock = threading.Lock()
+        self.directories = Queue.Queue()
+        # (st_dev, st_ino) of a file with several links -> (path in the staged root, copied event)
+        self.linked_files = {}
+        # directories get their times back once everything below them is copied
+        self.copied_directories = []
+        self.stats = {}
+        self.errors = []
+
+    def stage(self, target_root):
+        """
+        copies the manifest into target_root, raises when anything could not be copied.
+        """
+        start_time = time.time()
+        for directory in self.manifest.empty_directories:
+            self.make_directory(os.path.join(target_root, directory))
+
+        for tree in self.manifest.trees:
+            source_path = os.path.join(self.source_root, tree)
+            if not os.path.lexists(source_path):
+                self.logger.log("{0} does not exist, not staging it".format(source_path))
+                continue
+            if self.is_excluded(tree):
+                continue
+            tree_stats = TreeStats(tree)
+            self.stats[tree] = tree_stats
+            target_path = os.path.join(target_root, tree)
+            self.make_directory(os.path.dirname(target_path))
+            source_stat = os.lstat(source_path)
+            if stat.S_ISDIR(source_stat.st_mode):
+                self.make_directory(target_path, source_stat)
+                self.add_directory(tree_stats, tree, source_path, target_path, source_stat.st_dev)
+            else:
+                tree_stats.start_time = time.time()
+                self.copy_entry(tree_stats, source_path, target_path, source_stat)
+                tree_stats.end_time = time.time()
+
+        workers = []
+        for i in range(RootfsStager.threads):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.directories.join()
+        for i in range(len(workers)):
+            self.directories.put(None)
+        for worker in workers:
+            worker.join()
+
+        if self.errors:
+            raise Exception("staging the root failed: {0}".format(self.errors[0]))
+
+        for target_path, source_stat in reversed(self.copied_directories):
+            os.utime(target_path, (source_stat.st_atime, source_stat.st_mtime))
+
+        for tree in self.manifest.trees:
+            tree_stats = self.stats.get(tree)
+            if tree_stats is not None:
+                self.logger.log("staged {0}: {1} files, {2} bytes in {3:.2f}s".format(tree,
+                                                                                    tree_stats.files,
+                                                                                    tree_stats.bytes,
+                                                                                    (tree_stats.end_time or tree_stats.start_time or 0) - (tree_stats.start_time or 0)))
+        self.logger.log("staged {0} bytes into {1} in {2:.2f}s".format(sum(tree_stats.bytes for tree_stats in self.stats.values()),
+                                                                      target_root,
+                                                                      time.time() - start_time))
+        return self.stats
+
+    def is_excluded(self, relative_path):
+        return any(relative_path == excluded or relative_path.startswith(excluded + '/') for excluded in self.manifest.excluded)
+
+    def add_directory(self, tree_stats, relative_path, source_path, target_path, root_dev):
+        with self.lock:
+            tree_stats.pending += 1
+            if tree_stats.start_time is None:
+                tree_stats.start_time = time.time()
+        self.directories.put((tree_stats, relative_path, source_path, target_path, root_dev))
+
+    def work(self):
+        while True:
+            item = self.directories.get()
+            if item is None:
+                self.directories.task_done()
+                return
+            tree_stats = item[0]
+            try:
+                if not self.errors:
+                    self.copy_directory(*item)
+            except Exception as e:
+                self.logger.log("staging {0} failed: {1}, stack trace: {2}".format(item[2], e, traceback.format_exc()))
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                with self.lock:
+                    tree_stats.pending -= 1
+                    if tree_stats.pending == 0:
+                        tree_stats.end_time = time.time()
+                self.directories.task_done()
+
+    def copy_directory(self, tree_stats, relative_path, source_path, target_path, root_dev):
+        try:
+            names = sorted(os.listdir(source_path))
+        except OSError as e:
+            if not self.is_vanished(e, source_path):
+                raise
+            return
+        for name in names:
+            entry_relative_path = relative_path + '/' + name
+            if self.is_excluded(entry_relative_path):
+                continue
+            entry_source_path = os.path.join(source_path, name)
+            entry_target_path = os.path.join(target_path, name)
+            try:
+                source_stat = os.lstat(entry_source_path)
+                if stat.S_ISDIR(source_stat.st_mode):
+                    self.make_directory(entry_target_path, source_stat)
+                    # like cp -x, a mount point is copied but not what is mounted on it
+                    if source_stat.st_dev == root_dev:
+                        self.add_directory(tree_stats, entry_relative_path, entry_source_path, entry_target_path, root_dev)
+                else:
+                    self.copy_entry(tree_stats, entry_source_path, entry_target_path, source_stat)
+            except (IOError, OSError) as e:
+                if not self.is_vanished(e, entry_source_path):
+                    raise
+
+    def is_vanished(self, e, source_path):
+        """
+        true when e comes from source_path having been removed since it was listed.
+        """
+        if e.errno != errno.ENOENT or os.path.lexists(source_path):
+            return False
+        self.logger.log("{0} disappeared while staging, skipping it".format(source_path))
+        return True
+
+    def make_directory(self, target_path, source_stat=None):
+        try:
+            os.makedirs(target_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if source_stat is not None:
+            os.lchown(target_path, source_stat.st_uid, source_stat.st_gid)
+            os.chmod(target_path, stat.S_IMODE(source_stat.st_mode))
+            with self.lock:
+                self.copied_directories.append((target_path, source_stat))
+
+    def copy_entry(self, tree_stats, source_path, target_path, source_stat):
+        mode = source_stat.st_mode
+        if stat.S_ISLNK(mode):
+            os.symlink(os.readlink(source_path), target_path)
+            os.lchown(target_path, source_stat.st_uid, source_stat.st_gid)
+            return
+
+        copied = None
+        if source_stat.st_nlink > 1:
+            with self.lock:
+                linked_file = self.linked_files.get((source_stat.st_dev, source_stat.st_ino))
+                if linked_file is None:
+                    copied = threading.Event()
+                    self.linked_files[(source_stat.st_dev, source_stat.st_ino)] = (target_path, copied)
+            if linked_file is not None:
+                linked_file[1].wait()
+                # the first name may have disappeared before it was copied, then this one is copied on its own
+                if os.path.lexists(linked_file[0]):
+                    os.link(linked_file[0], target_path)
+                    with self.lock:
+                        tree_stats.files += 1
+                    return
+
+        try:
+            if stat.S_ISREG(mode):
+                self.copy_file(source_path, target_path)
+                with self.lock:
+                    tree_stats.bytes += source_stat.st_size
+            else:
+                os.mknod(target_path, mode, source_stat.st_rdev)
+            os.lchown(target_path, source_stat.st_uid, source_stat.st_gid)
+            # after the chown, which clears the setuid bits
+            os.chmod(target_path, stat.S_IMODE(mode))
+            os.utime(target_path, (source_stat.st_atime, source_stat.st_mtime))
+            with self.lock:
+                tree_stats.files += 1
+        finally:
+            if copied is not None:
+                copied.set()
+
+    def copy_file(self, source_path, target_path):
+        """
+        copies only the data of the file, its holes are left as holes in the copy.
+        """
+        with open(source_path, 'rb') as source:
+            with open(target_path, 'wb') as target:
+                source_fd = source.fileno()
+                target_fd = target.fileno()
+                size = os.fstat(source_fd).st_size
+                offset = 0
+                while offset < size:
+                    try:
+                        data_start = os.lseek(source_fd, offset, RootfsStager.seek_data)
+                        data_end = os.lseek(source_fd, data_start, RootfsStager.seek_hole)
+                    except OSError as e:
+                        if e.errno == errno.ENXIO:
+                            # only a hole is left up to the end of the file
+                            break
+                        if e.errno != errno.EINVAL:
+                            raise
+                        # the file system cannot tell where the holes are, copy it all
+                        data_start, data_end = offset, size
+                    self.copy_range(source_fd, target_fd, data_start, min(data_end, size))
+                    offset = data_end
+                os.ftruncate(target_fd, size)
+
+    def copy_range(self, source_fd, target_fd, start, end):
+        os.lseek(source_fd, start, os.SEEK_SET)
+        os.lseek(target_fd, start, os.SEEK_SET)
+        while start < end:
+            data = os.read(source_fd, min(RootfsStager.buffer_size, end - start))
+            if not data:
+                break
+            while data:
+                written = os.write(target_fd, data)
+                start += written
+                data = data[written:]
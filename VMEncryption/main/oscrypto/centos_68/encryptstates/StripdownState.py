@@ -23,6 +23,7 @@ import os
 import sys
 
 from OSEncryptionState import *
+from RootfsStager import RootfsStager
 
 class StripdownState(OSEncryptionState):
     def __init__(self, context):
@@ -50,12 +51,7 @@ class StripdownState(OSEncryptionState):
         self.command_executor.Execute('umount -a')
         self.command_executor.Execute('mkdir /tmp/tmproot', True)
         self.command_executor.Execute('mount -t tmpfs none /tmp/tmproot', True)
-        self.command_executor.ExecuteInBash('for i in proc sys dev run usr var tmp root oldroot boot; do mkdir /tmp/tmproot/$i; done', True)
-        self.command_executor.ExecuteInBash('for i in bin etc mnt sbin lib lib64 root; do cp -ax /$i /tmp/tmproot/; done', True)
-        self.command_executor.ExecuteInBash('for i in bin sbin libexec lib lib64 share; do cp -ax /usr/$i /tmp/tmproot/usr/; done', True)
-        self.command_executor.ExecuteInBash('for i in lib local lock opt run spool tmp; do cp -ax /var/$i /tmp/tmproot/var/; done', True)
-        self.command_executor.ExecuteInBash('mkdir /tmp/tmproot/var/log', True)
-        self.command_executor.ExecuteInBash('cp -ax /var/log/azure /tmp/tmproot/var/log/', True)
+        RootfsStager(self.context.logger).stage('/tmp/tmproot')
         self.command_executor.Execute('mount --make-rprivate /', True)
         self.command_executor.ExecuteInBash('[ -e "/tmp/tmproot/var/lib/azure_disk_encryption_config/azure_crypt_request_queue.ini" ]', True)
         self.command_executor.Execute('service waagent stop', True)
@@ -23,6 +23,7 @@ import os
 import sys
 
 from OSEncryptionState import *
+from RootfsStager import RootfsStager
 from time import sleep
 
 class StripdownState(OSEncryptionState):
@@ -52,12 +53,7 @@ class StripdownState(OSEncryptionState):
         self.command_executor.Execute('umount -a')
         self.command_executor.Execute('mkdir /usr/tmproot', True)
         self.command_executor.Execute('mount -t tmpfs none /usr/tmproot', True)
-        self.command_executor.ExecuteInBash('for i in proc sys dev run usr var tmp root oldroot boot; do mkdir /usr/tmproot/$i; done', True)
-        self.command_executor.ExecuteInBash('for i in bin etc mnt sbin lib lib64 root; do cp -ax /$i /usr/tmproot/; done', True)
-        self.command_executor.ExecuteInBash('for i in bin sbin libexec lib lib64 share; do cp -ax /usr/$i /usr/tmproot/usr/; done', True)
-        self.command_executor.ExecuteInBash('for i in lib local lock opt run spool tmp; do cp -ax /var/$i /usr/tmproot/var/; done', True)
-        self.command_executor.ExecuteInBash('mkdir /usr/tmproot/var/log', True)
-        self.command_executor.ExecuteInBash('cp -ax /var/log/azure /usr/tmproot/var/log/', True)
+        RootfsStager(self.context.logger).stage('/usr/tmproot')
         self.command_executor.Execute('mount --make-rprivate /', True)
         self.command_executor.ExecuteInBash('[ -e "/usr/tmproot/var/lib/azure_disk_encryption_config/azure_crypt_request_queue.ini" ]', True)
         self.command_executor.Execute('systemctl stop waagent', True)
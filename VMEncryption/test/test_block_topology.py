@@ -0,0 +1,58 @@
+import unittest
+import mock
+
+from main.BlockTopology import BlockTopology
+from main.Common import DeviceItem
+
+
+class TestBlockTopology(unittest.TestCase):
+    """ unit tests for the block device snapshot """
+    def _create_device_item(self, name, majmin, device_type='disk'):
+        device_item = DeviceItem()
+        device_item.name = name
+        device_item.majmin = majmin
+        device_item.type = device_type
+        return device_item
+
+    def setUp(self):
+        self.topology = BlockTopology()
+        self.topology.device_items = [self._create_device_item('sda', '8:0'),
+                                      self._create_device_item('sda1', '8:1', 'part'),
+                                      self._create_device_item('sdc', '8:32'),
+                                      self._create_device_item('sdc1', '8:33', 'part'),
+                                      self._create_device_item('dataencrypt', '253:0', 'crypt'),
+                                      self._create_device_item('sdd', '8:48')]
+        self.topology.children = {'8:0': ['8:1'], '8:32': ['8:33'], '8:33': ['253:0']}
+        self.topology.ide_devices = ['sda']
+        self.topology.pv_names = ['/dev/mapper/osencrypt']
+        self.topology.signature = ('10', 'digest')
+        self.topology.timestamp = 100
+
+    def test_sub_items(self):
+        sub_items = self.topology.get_sub_items(self.topology.device_items[2])
+        self.assertEqual([item.name for item in sub_items], ['sdc', 'sdc1', 'dataencrypt'])
+        self.assertEqual(len(self.topology.get_sub_items(self.topology.device_items[5])), 1)
+
+    def test_azure_devices(self):
+        self.assertEqual([item.name for item in self.topology.get_azure_devices()], ['sda', 'sda1'])
+
+    def test_pv(self):
+        self.assertTrue(self.topology.has_pv('/dev/mapper/osencrypt'))
+        self.assertFalse(self.topology.has_pv('/dev/mapper/dataencrypt'))
+
+    def test_device_items_are_copies(self):
+        self.topology.get_device_items()[0].name = 'changed'
+        self.assertEqual(self.topology.device_items[0].name, 'sda')
+
+    @mock.patch('time.time', return_value=110)
+    @mock.patch('main.BlockTopology.BlockTopology.get_change_signature')
+    def test_is_current(self, get_change_signature_mock, time_mock):
+        get_change_signature_mock.return_value = ('10', 'digest')
+        self.assertTrue(self.topology.is_current())
+        # a uevent was sent
+        get_change_signature_mock.return_value = ('11', 'digest')
+        self.assertFalse(self.topology.is_current())
+        # too old
+        get_change_signature_mock.return_value = ('10', 'digest')
+        time_mock.return_value = 1000
+        self.assertFalse(self.topology.is_current())
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from main.ConfigUtil import ConfigUtil, ConfigKeyValuePair
+from console_logger import ConsoleLogger
+
+
+class TestConfigUtil(unittest.TestCase):
+    """ unit tests for the cached config files """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_file_path = os.path.join(self.temp_dir, 'test.ini')
+        self.config_util = ConfigUtil(self.config_file_path, 'test_section', ConsoleLogger())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_missing_file(self):
+        self.assertIsNone(self.config_util.get_config('key'))
+        self.assertIsNone(self.config_util.get_long_config('key'))
+
+    def test_save_configs(self):
+        self.config_util.save_configs([ConfigKeyValuePair('first', 'a'), ConfigKeyValuePair('second', None)])
+        self.config_util.save_configs([ConfigKeyValuePair('second', 42)])
+
+        other_config_util = ConfigUtil(self.config_file_path, 'test_section', ConsoleLogger())
+        self.assertEqual(other_config_util.get_config('first'), 'a')
+        self.assertEqual(other_config_util.get_config('second'), '42')
+        self.assertEqual(other_config_util.get_long_config('second'), 42)
+        self.assertIsNone(other_config_util.get_config('third'))
+        # only the config file is left behind
+        self.assertEqual(os.listdir(self.temp_dir), ['test.ini'])
+
+    def test_parsed_once(self):
+        self.config_util.save_configs([ConfigKeyValuePair('first', 'a')])
+        ConfigUtil.parsed_configs.clear()
+        with mock.patch('main.ConfigUtil.ConfigParser.read') as read:
+            self.config_util.get_config('first')
+            self.config_util.get_config('first')
+            self.assertEqual(read.call_count, 1)
+
+    def test_external_change_is_read(self):
+        self.config_util.save_configs([ConfigKeyValuePair('first', 'a')])
+        self.assertEqual(self.config_util.get_config('first'), 'a')
+        with open(self.config_file_path, 'w') as f:
+            f.write('[test_section]\nfirst = changed\n')
+        self.assertEqual(self.config_util.get_config('first'), 'changed')
+
+        os.remove(self.config_file_path)
+        self.assertIsNone(self.config_util.get_config('first'))
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+
+from main.EncryptionEnvironment import EncryptionEnvironment
+from main.EncryptionScheduler import EncryptionScheduler, MergedStatusReporter, VolumeEncryptionJob
+from console_logger import ConsoleLogger
+
+
+class TestEncryptionScheduler(unittest.TestCase):
+    """ unit tests for encrypting data volumes concurrently """
+    def setUp(self):
+        self.logger = ConsoleLogger()
+
+    def test_disks_run_concurrently(self):
+        jobs = [VolumeEncryptionJob('a1', 'sdc'), VolumeEncryptionJob('b1', 'sdd')]
+        # each volume waits for the other one to start, which only works when both run at once
+        started = dict((job.volume_key, threading.Event()) for job in jobs)
+        def encrypt_volume(job):
+            started[job.volume_key].set()
+            return all(event.wait(5) for event in started.values())
+
+        scheduler = EncryptionScheduler(self.logger, max_parallel=2)
+        self.assertEqual(scheduler.run(jobs, encrypt_volume), [])
+        self.assertTrue(all(job.succeeded for job in jobs))
+
+    def test_volumes_of_one_disk_run_serially(self):
+        jobs = [VolumeEncryptionJob('a1', 'sdc'), VolumeEncryptionJob('a2', 'sdc'), VolumeEncryptionJob('b1', 'sdd')]
+        lock = threading.Lock()
+        running = set()
+        order = []
+        def encrypt_volume(job):
+            with lock:
+                self.assertNotIn(job.disk_key, running)
+                running.add(job.disk_key)
+                order.append(job.volume_key)
+            threading.Event().wait(0.01)
+            with lock:
+                running.remove(job.disk_key)
+            return True
+
+        scheduler = EncryptionScheduler(self.logger, max_parallel=4)
+        self.assertEqual(scheduler.get_parallelism(jobs), 2)
+        self.assertEqual(scheduler.run(jobs, encrypt_volume), [])
+        self.assertLess(order.index('a1'), order.index('a2'))
+
+    def test_no_new_volume_after_failure(self):
+        jobs = [VolumeEncryptionJob('a1', 'sdc'), VolumeEncryptionJob('a2', 'sdc'), VolumeEncryptionJob('a3', 'sdc')]
+        def encrypt_volume(job):
+            if job.volume_key == 'a2':
+                raise Exception("injected failure")
+            return True
+
+        scheduler = EncryptionScheduler(self.logger, max_parallel=1)
+        self.assertEqual(scheduler.run(jobs, encrypt_volume), [jobs[1]])
+        self.assertTrue(jobs[0].succeeded)
+        self.assertIsNone(jobs[2].succeeded)
+
+    def test_skipped_volume_is_not_a_failure(self):
+        jobs = [VolumeEncryptionJob('a1', 'sdc'), VolumeEncryptionJob('a2', 'sdc')]
+        def encrypt_volume(job):
+            if job.volume_key == 'a1':
+                return None
+            return True
+
+        scheduler = EncryptionScheduler(self.logger, max_parallel=1)
+        self.assertEqual(scheduler.run(jobs, encrypt_volume), [])
+        self.assertIsNone(jobs[0].succeeded)
+        self.assertTrue(jobs[1].succeeded)
+
+    def test_merged_status(self):
+        hutil = mock.MagicMock()
+        merged_status_reporter = MergedStatusReporter(hutil)
+        first = merged_status_reporter.for_volume('a1')
+        second = merged_status_reporter.for_volume('b1')
+
+        first.do_status_report(operation='EnableEncryption', status='transitioning', status_code='0', message='a1 10%')
+        second.do_status_report(operation='EnableEncryption', status='transitioning', status_code='0', message='b1 5%')
+        first.do_status_report(operation='EnableEncryption', status='transitioning', status_code='0', message='a1 20%')
+
+        self.assertEqual(hutil.do_status_report.call_args[1]['message'], 'a1 20%; b1 5%')
+        # everything else goes to hutil
+        first.log('message')
+        hutil.log.assert_called_with('message')
+
+
+class TestVolumeEnvironment(unittest.TestCase):
+    """ unit tests for the per volume state files """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.encryption_environment = EncryptionEnvironment(patching=mock.MagicMock(), logger=ConsoleLogger())
+        self.encryption_environment.encryption_config_path = self.temp_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_volume_paths(self):
+        volume_environment = self.encryption_environment.get_volume_environment('1234-abcd/x')
+        self.assertEqual(volume_environment.azure_crypt_ongoing_item_config_path,
+                         os.path.join(self.temp_dir, 'azure_crypt_ongoing_item_1234-abcd_x.ini'))
+        self.assertEqual(os.path.dirname(volume_environment.copy_slice_checkpoint_file), self.temp_dir)
+        self.assertNotEqual(volume_environment.copy_slice_item_backup_file,
+                            self.encryption_environment.copy_slice_item_backup_file)
+        self.assertIsNone(self.encryption_environment.volume_key)
+
+    def test_volume_keys(self):
+        for volume_key in ['b1', 'a1']:
+            volume_environment = self.encryption_environment.get_volume_environment(volume_key)
+            open(volume_environment.azure_crypt_ongoing_item_config_path, 'w').close()
+        # archived configs are not resumed
+        open(os.path.join(self.temp_dir, 'azure_crypt_ongoing_item_c1.ini_2016-01-01'), 'w').close()
+        self.assertEqual(self.encryption_environment.get_volume_keys(), ['a1', 'b1'])
@@ -0,0 +1,105 @@
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import mock
+
+# the oscrypto states import their modules from the oscrypto directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main', 'oscrypto'))
+
+from RootfsStager import RootfsStager
+from console_logger import ConsoleLogger
+
+
+class TestManifest(object):
+    empty_directories = ['proc', 'oldroot', 'var/log']
+    trees = ['bin', 'lib64', 'usr/share', 'var/run', 'var/log/azure']
+    excluded = ['usr/share/doc']
+
+
+class TestRootfsStager(unittest.TestCase):
+    """ unit tests for staging the stripped down root """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_root = os.path.join(self.temp_dir, 'source')
+        self.target_root = os.path.join(self.temp_dir, 'target')
+        os.makedirs(self.target_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, relative_path, data, mode=0o644):
+        path = os.path.join(self.source_root, relative_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+        return path
+
+    def test_stage(self):
+        self._write_file('bin/sh', b'shell', 0o755)
+        os.link(os.path.join(self.source_root, 'bin/sh'), os.path.join(self.source_root, 'bin/bash'))
+        self._write_file('usr/share/zoneinfo/UTC', b'utc' * 1000)
+        self._write_file('usr/share/doc/README', b'readme')
+        self._write_file('var/log/azure/extension.log', b'log')
+        os.makedirs(os.path.join(self.source_root, 'run'))
+        os.symlink('/run', os.path.join(self.source_root, 'var/run'))
+        os.utime(os.path.join(self.source_root, 'usr/share/zoneinfo'), (1000000000, 1000000000))
+
+        stats = RootfsStager(ConsoleLogger(), TestManifest, self.source_root).stage(self.target_root)
+
+        target = lambda relative_path: os.path.join(self.target_root, relative_path)
+        for directory in TestManifest.empty_directories:
+            self.assertTrue(os.path.isdir(target(directory)))
+        with open(target('bin/sh'), 'rb') as f:
+            self.assertEqual(f.read(), b'shell')
+        self.assertEqual(os.stat(target('bin/sh')).st_mode & 0o777, 0o755)
+        self.assertEqual(os.stat(target('bin/sh')).st_ino, os.stat(target('bin/bash')).st_ino)
+        self.assertEqual(os.path.getsize(target('usr/share/zoneinfo/UTC')), 3000)
+        self.assertEqual(os.stat(target('usr/share/zoneinfo')).st_mtime, 1000000000)
+        self.assertFalse(os.path.exists(target('usr/share/doc')))
+        self.assertEqual(os.readlink(target('var/run')), '/run')
+        self.assertTrue(os.path.exists(target('var/log/azure/extension.log')))
+        # lib64 does not exist on the source
+        self.assertFalse(os.path.exists(target('lib64')))
+
+        self.assertEqual(stats['usr/share'].files, 1)
+        self.assertEqual(stats['usr/share'].bytes, 3000)
+        self.assertEqual(stats['bin'].files, 2)
+
+    def test_stage_error(self):
+        self._write_file('bin/sh', b'shell')
+        os.makedirs(os.path.join(self.target_root, 'bin/sh'))
+        self.assertRaises(Exception, RootfsStager(ConsoleLogger(), TestManifest, self.source_root).stage, self.target_root)
+
+    def test_stage_sparse_file(self):
+        path = self._write_file('var/run/sparse', b'')
+        with open(path, 'wb') as f:
+            f.write(b'head')
+            f.seek(8 * 1048576)
+            f.write(b'tail')
+        RootfsStager(ConsoleLogger(), TestManifest, self.source_root).stage(self.target_root)
+
+        target_path = os.path.join(self.target_root, 'var/run/sparse')
+        with open(path, 'rb') as source:
+            with open(target_path, 'rb') as target:
+                self.assertEqual(source.read(), target.read())
+        # the copy takes no more space than the source, which has a hole of 8 MB
+        self.assertLessEqual(os.stat(target_path).st_blocks, os.stat(path).st_blocks)
+
+    def test_stage_vanished_entry(self):
+        self._write_file('bin/sh', b'shell')
+        vanished_path = self._write_file('bin/vanished', b'gone')
+        lstat = os.lstat
+        def lstat_vanishing(path):
+            if path == vanished_path:
+                raise OSError(errno.ENOENT, 'No such file or directory', path)
+            return lstat(path)
+
+        with mock.patch('os.lstat', side_effect=lstat_vanishing):
+            RootfsStager(ConsoleLogger(), TestManifest, self.source_root).stage(self.target_root)
+        self.assertTrue(os.path.exists(os.path.join(self.target_root, 'bin/sh')))
+        self.assertFalse(os.path.exists(os.path.join(self.target_root, 'bin/vanished')))
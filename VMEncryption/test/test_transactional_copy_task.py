@@ -0,0 +1,241 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from main.Common import CommonVariables
+from main.TransactionalCopyTask import TransactionalCopyTask
+from main.SliceController import SliceSizeController, IOThrottle
+from console_logger import ConsoleLogger
+
+
+class TestTransactionalCopyTask(unittest.TestCase):
+    """ unit tests for the in process slice copy of TransactionalCopyTask """
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, 'source')
+        self.destination = os.path.join(self.temp_dir, 'destination')
+        self.encryption_environment = mock.MagicMock()
+        self.encryption_environment.copy_slice_item_backup_file = os.path.join(self.temp_dir, 'copy_slice_item.bak')
+        self.encryption_environment.copy_slice_checkpoint_file = os.path.join(self.temp_dir, 'copy_slice_checkpoint')
+        self.ongoing_item_config = mock.MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def _read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _create_task(self, total_size, block_size, slice_index=0, from_end='False', pipeline_depth=3, max_slice_size=None):
+        ongoing_item_config = self.ongoing_item_config
+        ongoing_item_config.get_current_total_copy_size.return_value = total_size
+        ongoing_item_config.get_current_block_size.return_value = block_size
+        ongoing_item_config.get_current_source_path.return_value = self.source
+        ongoing_item_config.get_current_destination.return_value = self.destination
+        ongoing_item_config.get_current_slice_index.return_value = slice_index
+        ongoing_item_config.get_from_end.return_value = from_end
+        return TransactionalCopyTask(logger=self.logger,
+                                     hutil=mock.MagicMock(),
+                                     disk_util=mock.MagicMock(),
+                                     ongoing_item_config=ongoing_item_config,
+                                     patching=mock.MagicMock(),
+                                     encryption_environment=self.encryption_environment,
+                                     status_prefix='copying',
+                                     pipeline_depth=pipeline_depth,
+                                     max_slice_size=max_slice_size or block_size)
+
+    def test_copy_from_start(self):
+        data = os.urandom(4096 * 5 + 1024)
+        self._write_file(self.source, data)
+
+        task = self._create_task(len(data), 4096)
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+        self.assertEqual(task.ongoing_item_config.current_slice_index, 6)
+
+    def test_copy_from_end(self):
+        data = os.urandom(4096 * 4 + 512)
+        self._write_file(self.source, data)
+        self._write_file(self.destination, b'\0' * len(data))
+
+        task = self._create_task(len(data), 4096, from_end='True')
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+
+    def test_resume_from_partial_backup(self):
+        # slice 1 was interrupted after half of it reached the backup file; the source of that
+        # half is already overwritten and must come from the backup
+        data = os.urandom(4096 * 3)
+        self._write_file(self.encryption_environment.copy_slice_item_backup_file, data[4096:4096 + 2048])
+        self._write_file(self.source, data[:4096] + b'\xff' * 2048 + data[4096 + 2048:])
+        self._write_file(self.destination, data[:4096])
+
+        task = self._create_task(len(data), 4096, slice_index=1)
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_copy_error(self):
+        self._write_file(self.source, os.urandom(4096))
+        self.destination = os.path.join(self.temp_dir, 'missing', 'destination')
+
+        task = self._create_task(4096, 4096)
+        self.assertNotEqual(task.begin_copy(), 0)
+
+    def test_serial_copy(self):
+        data = os.urandom(4096 * 3 + 512)
+        self._write_file(self.source, data)
+
+        task = self._create_task(len(data), 4096, pipeline_depth=1)
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+
+    def test_failed_write_leaves_one_slice_at_risk(self):
+        data = os.urandom(4096 * 6)
+        self._write_file(self.source, data)
+
+        task = self._create_task(len(data), 4096)
+        copier = task.get_copier()
+        original_write_from = copier.destination.write_from
+        def write_from(slice_buffer, offset, length, buffer_offset=0):
+            if offset == 4096 * 2:
+                raise IOError("injected write failure")
+            return original_write_from(slice_buffer, offset, length, buffer_offset)
+        copier.destination.write_from = write_from
+
+        self.assertEqual(task.begin_copy(), CommonVariables.copy_data_error)
+
+        # slices ahead of the failed one were only read, the backup holds the failed slice
+        self.assertTrue(task.checkpoint.load())
+        self.assertEqual((task.checkpoint.slice_index, task.checkpoint.backup_slice_index), (2, 2))
+        self.assertEqual(self._read_file(self.encryption_environment.copy_slice_item_backup_file), data[4096 * 2:4096 * 3])
+        self.assertEqual(self._read_file(self.destination), data[:4096 * 2])
+
+        # the interrupted write may have clobbered the source of the slice, the retry takes it from the backup
+        with open(self.source, 'r+b') as f:
+            f.seek(4096 * 2)
+            f.write(b'\xff' * 4096)
+        task = self._create_task(len(data), 4096, slice_index=0)
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+        self.assertEqual(task.ongoing_item_config.current_slice_index, 7)
+
+    def test_stale_backup_is_not_replayed(self):
+        # the crash hit after slice 1 was committed but before its backup was removed
+        data = os.urandom(4096 * 3)
+        self._write_file(self.source, data)
+        self._write_file(self.destination, data[:4096 * 2])
+        self._write_file(self.encryption_environment.copy_slice_item_backup_file, b'\xff' * 4096)
+
+        task = self._create_task(len(data), 4096, slice_index=1)
+        task.checkpoint.save(2)
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_progress_is_throttled(self):
+        data = os.urandom(4096 * 100)
+        self._write_file(self.source, data)
+
+        task = self._create_task(len(data), 4096)
+        task.progress_reporter.percent_step = 10
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+        # a report and a config commit every 10%, and the final one
+        self.assertEqual(task.hutil.do_status_report.call_count, 11)
+        self.assertEqual(self.ongoing_item_config.commit.call_count, 11)
+        self.assertEqual(task.ongoing_item_config.current_slice_index, 101)
+
+    def test_multi_unit_slices_from_end(self):
+        data = os.urandom(4096 * 9 + 512)
+        self._write_file(self.source, data)
+        self._write_file(self.destination, b'\0' * len(data))
+
+        task = self._create_task(len(data), 4096, from_end='True', max_slice_size=4096 * 4)
+        task.slice_size_controller.units = 4
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+        self.assertEqual(task.ongoing_item_config.current_slice_index, 10)
+
+    def test_resume_multi_unit_backup(self):
+        # units 1 and 2 were backed up as one slice before the crash
+        data = os.urandom(4096 * 4)
+        self._write_file(self.encryption_environment.copy_slice_item_backup_file, data[4096:4096 * 3])
+        self._write_file(self.source, data[:4096] + b'\xff' * 4096 * 2 + data[4096 * 3:])
+        self._write_file(self.destination, data[:4096])
+
+        task = self._create_task(len(data), 4096, slice_index=1)
+        self.assertEqual(task.begin_copy(), 0)
+
+        self.assertEqual(self._read_file(self.destination), data)
+
+    def test_resume_mismatched_backup(self):
+        data = os.urandom(4096 * 4)
+        self._write_file(self.source, data)
+        self._write_file(self.encryption_environment.copy_slice_item_backup_file, data[:4096 + 100])
+
+        task = self._create_task(len(data), 4096, slice_index=1)
+        self.assertEqual(task.begin_copy(), CommonVariables.backup_slice_file_error)
+
+
+class TestSliceSizeController(unittest.TestCase):
+    """ unit tests for the adaptive slice size """
+    def setUp(self):
+        self.logger = ConsoleLogger()
+
+    def test_grows_while_faster(self):
+        controller = SliceSizeController(self.logger, unit_size=1048576, initial_units=4, max_units=16)
+        for throughput in [100, 100, 200, 200, 400, 400]:
+            units = controller.next_units()
+            controller.record(units, units * 1048576, units * 1048576 / float(throughput * 1048576), 0.1)
+        self.assertEqual(controller.next_units(), 16)
+
+    def test_returns_when_no_gain(self):
+        controller = SliceSizeController(self.logger, unit_size=1048576, initial_units=4, max_units=16)
+        for i in range(4):
+            units = controller.next_units()
+            controller.record(units, units * 1048576, units / 100.0, 0.1)
+        self.assertEqual(controller.next_units(), 4)
+
+    def test_shrinks_on_slow_commit(self):
+        controller = SliceSizeController(self.logger, unit_size=1048576, initial_units=8, max_units=16, max_commit_seconds=1)
+        for i in range(2):
+            controller.record(8, 8 * 1048576, 5, 5)
+        self.assertEqual(controller.next_units(), 4)
+
+
+class TestIOThrottle(unittest.TestCase):
+    """ unit tests for the copy IO caps """
+    def test_from_public_settings(self):
+        logger = ConsoleLogger()
+        self.assertIsNone(IOThrottle.from_public_settings(logger, {}))
+        self.assertIsNone(IOThrottle.from_public_settings(logger, {CommonVariables.EncryptionIopsLimitKey: 'many'}))
+
+        throttle = IOThrottle.from_public_settings(logger, {CommonVariables.EncryptionThroughputLimitKey: 10,
+                                                            CommonVariables.EncryptionIopsLimitKey: '50'})
+        self.assertEqual(throttle.bytes_per_second, 10 * 1048576)
+        self.assertEqual(throttle.ios_per_second, 50)
+
+    @mock.patch('time.sleep')
+    def test_acquire_paces_requests(self, sleep):
+        throttle = IOThrottle(bytes_per_second=1048576, ios_per_second=1000)
+        throttle.acquire(524288)
+        throttle.acquire(524288)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)